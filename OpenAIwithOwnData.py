@@ -2,6 +2,23 @@
 # The script takes a user input question and sends it to the Azure OpenAI API for completion.
 # The completion request includes a data source configuration that specifies an Azure Search index to retrieve additional information.
 # The script prints the response from the OpenAI API, which includes the answer to the question based on the data retrieved from Azure Search.
+# With --batch the script instead reads many questions from a JSONL file (or stdin) and answers them concurrently
+# with AsyncAzureOpenAI over one pooled HTTP client, writing answers, citations and per-request latency to a JSONL file
+# and printing a throughput and latency summary at the end.
+# With --stream the answer is requested with stream=True and printed as tokens arrive, and the time to first token
+# and total latency are recorded (per question in batch mode).
+# With --cache answers are kept in an in-memory answer cache (lib/answercache.py): a question is answered from
+# the cache when its normalized text matches a cached question, or when its embedding is close enough to the
+# embedding of one (set AZURE_OPENAI_EMBEDDING_DEPLOYMENT_ID to enable the similarity lookup). The cache is
+# invalidated when the index, system prompt or deployment changes, and --cache-file keeps it between runs.
+# With --local-index the passages are instead retrieved from a local memory-mapped vector store written by
+# aisearchindexer.py --local-store (lib/localretrieval.py) and sent in the prompt, so no Azure AI Search round trip is made.
+# The clients come from lib/clients.py and the OpenAI SDK is only imported once the first client is created.
+# Requests go through the shared adaptive rate limiter in lib/ratelimit.py, which retries throttled and transient
+# failures and adjusts the requests in flight; its counters are logged on exit.
+# Answers are printed on stdout and progress and summaries are logged on stderr (--log-level). With --trace every question,
+# embedding, retrieval, completion and HTTP request is timed with its token usage (lib/tracing.py) and the time spent in
+# each stage is logged at the end.
 # You will need to set up an Azure Search service and index with the required data for this script to work.
 # You will also need to set the following environment variables:
 # - AZURE_OPENAI_ENDPOINT: The endpoint for the Azure OpenAI API
@@ -10,58 +27,457 @@
 # - AZURE_SEARCH_SERVICE_ENDPOINT: The endpoint for the Azure Search service
 # - AZURE_SEARCH_INDEX: The name of the Azure Search index to query
 # - AZURE_SEARCH_ADMIN_KEY: The admin key for the Azure Search service
+# - AZURE_OPENAI_EMBEDDING_DEPLOYMENT_ID: (optional) The embedding deployment used for similar-question cache lookups and --local-index
 
-       
+
+import argparse
+import asyncio
+import json
+import logging
 import os
-import openai
+import sys
+import time
+from functools import partial
+
 import dotenv
 
+from lib.answercache import AnswerCache, cache_namespace
+from lib.clients import aclose_clients, async_openai_client, openai_client, run_main
+from lib.localretrieval import LocalVectorStore
+from lib.stats import format_latency_summary, latency_summary
+from lib import tracing
+
 dotenv.load_dotenv()
-# Set up the OpenAI client with Azure credentials
-# The endpoint, API key, and deployment name are read from environment variables
-endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT")
-api_key = os.environ.get("AZURE_OPENAI_KEY")
+
+logger = logging.getLogger(__name__)
+# The deployment names are read from environment variables; the clients (lib/clients.py) read the endpoint and API key
 deployment = os.environ.get("AZURE_OAI_DEPLOYMENT")
+embedding_deployment = os.environ.get("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_ID")
+api_version = "2024-02-01"
+# Streamed responses only report token usage when asked with stream_options; turned off if the API version rejects it
+stream_usage = True
 
-# Create an instance of the Azure OpenAI client
-client = openai.AzureOpenAI(
-    azure_endpoint=endpoint,
-    api_key=api_key,
-    api_version="2024-02-01",
-)
-
-
-
-# Get user input question
-text = input('\nEnter a question:\n')
-
-# Send the question to the OpenAI API for completion
-# The completion request includes a data source configuration for Azure Search
-completion = client.chat.completions.create(
-    model=deployment,
-    messages=[
-         {"role": "system", "content": "Provide a single answer limited to 200 characters."},
-        {
-            "role": "user",
-            "content": text,
-        },
-    ],
-    extra_body={
-        "data_sources":[
+system_prompt = "Provide a single answer limited to 200 characters."
+
+
+def build_request(text, passages=None):
+    if passages is not None:
+        # Local retrieval: the retrieved passages are sent in the prompt instead of an azure_search data source
+        sources = "\n\n".join(f"[doc{number}] {passage['title']}\n{passage['chunk']}"
+                               for number, passage in enumerate(passages, start=1))
+        return dict(
+            model=deployment,
+            messages=[
+                {"role": "system", "content": f"{system_prompt}\nAnswer only from the sources below and cite them as [docN].\n\nSources:\n{sources}"},
+                {"role": "user", "content": text},
+            ],
+        )
+    # The completion request includes a data source configuration for Azure Search
+    return dict(
+        model=deployment,
+        messages=[
+            {"role": "system", "content": system_prompt},
             {
-                "type": "azure_search",
-                "parameters": {
-                    "endpoint": os.environ["AZURE_SEARCH_SERVICE_ENDPOINT"],
-                    "index_name": os.environ["AZURE_SEARCH_INDEX"],
-                    "authentication": {
-                        "type": "api_key",
-                        "key": os.environ["AZURE_SEARCH_ADMIN_KEY"],
+                "role": "user",
+                "content": text,
+            },
+        ],
+        extra_body={
+            "data_sources":[
+                {
+                    "type": "azure_search",
+                    "parameters": {
+                        "endpoint": os.environ["AZURE_SEARCH_SERVICE_ENDPOINT"],
+                        "index_name": os.environ["AZURE_SEARCH_INDEX"],
+                        "authentication": {
+                            "type": "api_key",
+                            "key": os.environ["AZURE_SEARCH_ADMIN_KEY"],
+                        }
                     }
                 }
-            }
-        ],
+            ],
+        }
+    )
+
+
+def get_citations(message):
+    # The azure_search data source returns the retrieved documents in message.context
+    context = getattr(message, "context", None) or {}
+    return [
+        {key: citation.get(key) for key in ("title", "url", "filepath", "chunk_id")}
+        for citation in context.get("citations", [])
+    ]
+
+
+def passage_citations(passages):
+    return [{"title": passage["title"], "url": None, "filepath": None, "chunk_id": passage["chunk_id"]} for passage in passages]
+
+
+def stream_answer(client, text, out=sys.stdout, passages=None):
+    # Print the answer as it arrives; returns the answer, citations, time to first token and total latency
+    start = time.perf_counter()
+    first_token = None
+    parts = []
+    citations = passage_citations(passages) if passages is not None else []
+    with tracing.span("complete", stream=True) as complete_span:
+        for chunk in client.chat.completions.create(**build_request(text, passages), stream=True):
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            # the citations arrive once, in the context of an early chunk
+            if getattr(delta, "context", None):
+                citations = get_citations(delta) or citations
+            if delta.content:
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                    complete_span.set(first_token_ms=round(first_token * 1000, 1))
+                parts.append(delta.content)
+                out.write(delta.content)
+                out.flush()
+    return "".join(parts), citations, first_token, time.perf_counter() - start
+
+
+async def create_stream_async(client, request):
+    # Asks for the token usage in the last chunk; stream_options goes in extra_body, as the pinned SDK has no
+    # argument for it, and is dropped for the rest of the run if the API version does not accept it
+    global stream_usage
+    import openai
+
+    if stream_usage:
+        extra_body = dict(request.get("extra_body") or {}, stream_options={"include_usage": True})
+        try:
+            return await client.chat.completions.create(**dict(request, extra_body=extra_body), stream=True)
+        except openai.BadRequestError as e:
+            if "stream_options" not in str(e):
+                raise
+            stream_usage = False
+            logger.warning("The API version does not accept stream_options; streamed answers will not report token usage")
+    return await client.chat.completions.create(**request, stream=True)
+
+
+async def stream_answer_async(client, text, passages=None):
+    # Same as stream_answer without printing, for batch mode
+    start = time.perf_counter()
+    first_token = None
+    parts = []
+    citations = passage_citations(passages) if passages is not None else []
+    usage = None
+    with tracing.span("complete", stream=True) as complete_span:
+        stream = await create_stream_async(client, build_request(text, passages))
+        async for chunk in stream:
+            # the usage comes in a last chunk without choices; older SDKs keep it as a dict
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage if isinstance(chunk.usage, dict) else chunk.usage.model_dump()
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if getattr(delta, "context", None):
+                citations = get_citations(delta) or citations
+            if delta.content:
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                    complete_span.set(first_token_ms=round(first_token * 1000, 1))
+                parts.append(delta.content)
+        complete_span.usage(usage)
+    return "".join(parts), citations, usage, first_token
+
+
+def create_answer_cache(args):
+    # Cached answers are only valid for the index, retrieval settings, system prompt and models they were produced with;
+    # similar questions are matched by embedding, so vectors of another embedding model must never be compared
+    index = f"local:{os.path.abspath(args.local_index)}" if args.local_index else os.environ.get("AZURE_SEARCH_INDEX")
+    retrieval = {"top_k": args.top_k, "nprobe": args.nprobe} if args.local_index else None
+    namespace = cache_namespace(index, retrieval, system_prompt, deployment, embedding_deployment)
+    cache = AnswerCache(similarity_threshold=args.cache_threshold, max_entries=args.cache_size,
+                        ttl_seconds=args.cache_ttl, namespace=namespace)
+    if args.cache_file:
+        cache.load(args.cache_file)
+    return cache
+
+
+def cache_value(answer, citations, usage, latency):
+    return {
+        "answer": answer,
+        "citations": citations,
+        "latency": latency,
+        "tokens": (usage or {}).get("total_tokens", 0),
     }
-)
-# Print the response from the OpenAI API
-print("\n" + completion.choices[0].message.content + "\n")
-# print(completion.model_dump_json(indent=2))
\ No newline at end of file
+
+
+def embed_question(client, text):
+    with tracing.span("embed", inputs=1, chars=len(text)) as embed_span:
+        response = client.embeddings.create(model=embedding_deployment, input=[text])
+        embed_span.usage(response.usage)
+    return response.data[0].embedding
+
+
+async def embed_question_async(client, text):
+    with tracing.span("embed", inputs=1, chars=len(text)) as embed_span:
+        response = await client.embeddings.create(model=embedding_deployment, input=[text])
+        embed_span.usage(response.usage)
+    return response.data[0].embedding
+
+
+def retrieve_passages(retrieve, embedding):
+    with tracing.span("retrieve", source="local") as retrieve_span:
+        passages = retrieve(embedding)
+        retrieve_span.add(passages=len(passages))
+    return passages
+
+
+def lookup_answer(cache, client, text):
+    # Returns (cached value or None, how it was found, question embedding or None)
+    value = cache.get_exact(text)
+    if value is not None:
+        return value, "exact", None
+    if not embedding_deployment:
+        return None, None, None
+    embedding = embed_question(client, text)
+    value = cache.get_similar(embedding)
+    return value, "similar" if value is not None else None, embedding
+
+
+async def lookup_answer_async(cache, client, text):
+    value = cache.get_exact(text)
+    if value is not None:
+        return value, "exact", None
+    if not embedding_deployment:
+        return None, None, None
+    embedding = await embed_question_async(client, text)
+    value = cache.get_similar(embedding)
+    return value, "similar" if value is not None else None, embedding
+
+
+def read_questions(path):
+    # JSONL lines with a "question" (and optional "id"), or plain text lines; "-" reads stdin.
+    # A line that cannot be read as a question is yielded with an "error" instead, so it does not stop the batch.
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        for number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                try:
+                    item = json.loads(line)
+                    question = item["question"]
+                    if not isinstance(question, str) or not question.strip():
+                        raise ValueError("question must be a non-empty string")
+                except (ValueError, KeyError, TypeError) as e:
+                    error = f"missing key {e}" if isinstance(e, KeyError) else str(e)
+                    yield {"id": number, "line": number, "error": f"invalid question record: {error}"}
+                    continue
+                yield {"id": item.get("id", number), "question": question}
+            else:
+                yield {"id": number, "question": line}
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+async def answer_batch(input_path, output_path, workers, stream=False, cache=None, retrieve=None):
+    import httpx
+
+    # One pooled HTTP client shared by every request, sized to the number of workers; the rate limiter
+    # retries throttled requests and backs off the requests in flight, so the SDK's own retries are off
+    client = async_openai_client(
+        api_version,
+        limits=httpx.Limits(max_connections=workers, max_keepalive_connections=workers),
+        initial=workers,
+    )
+
+    queue = asyncio.Queue(maxsize=workers * 2)
+    latencies = []
+    first_token_latencies = []
+    cache_latencies = []
+    failures = 0
+    invalid = 0
+
+    async def worker(out):
+        nonlocal failures
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            record = {"id": item["id"], "question": item["question"]}
+            start = time.perf_counter()
+            # One trace per question, with the cache lookup, retrieval and completion under it
+            with tracing.span("question", id=item["id"]) as question_span:
+                try:
+                    embedding = None
+                    if cache is not None:
+                        cached, how, embedding = await lookup_answer_async(cache, client, item["question"])
+                        if cached is not None:
+                            record["answer"] = cached["answer"]
+                            record["citations"] = cached["citations"]
+                            record["cache"] = how
+                            question_span.set(cache=how)
+                            cache_latencies.append(time.perf_counter() - start)
+                            continue
+                        cache.record_miss()
+                    passages = None
+                    if retrieve is not None:
+                        if embedding is None:
+                            embedding = await embed_question_async(client, item["question"])
+                        passages = await asyncio.to_thread(retrieve_passages, retrieve, embedding)
+                    if stream:
+                        answer, citations, usage, first_token = await stream_answer_async(client, item["question"], passages)
+                        record["answer"] = answer
+                        record["citations"] = citations
+                        if usage:
+                            record["usage"] = usage
+                        if first_token is not None:
+                            first_token_latencies.append(first_token)
+                            record["first_token_ms"] = round(first_token * 1000, 1)
+                    else:
+                        with tracing.span("complete", stream=False) as complete_span:
+                            completion = await client.chat.completions.create(**build_request(item["question"], passages))
+                            complete_span.usage(completion.usage)
+                        message = completion.choices[0].message
+                        record["answer"] = message.content
+                        record["citations"] = passage_citations(passages) if passages is not None else get_citations(message)
+                        if completion.usage:
+                            record["usage"] = completion.usage.model_dump()
+                    if cache is not None:
+                        cache.put(item["question"], cache_value(record["answer"], record["citations"], record.get("usage"),
+                                                                time.perf_counter() - start), embedding)
+                except Exception as e:
+                    failures += 1
+                    record["error"] = str(e)
+                    question_span.fail(e)
+                finally:
+                    latency = time.perf_counter() - start
+                    latencies.append(latency)
+                    record["latency_ms"] = round(latency * 1000, 1)
+                    out.write(json.dumps(record) + "\n")
+
+    start = time.perf_counter()
+    with open(output_path, "w", encoding="utf-8") as out:
+        tasks = [asyncio.create_task(worker(out)) for _ in range(workers)]
+        # Questions are read lazily so very large input files are not loaded at once, on a worker thread so a slow
+        # file or stdin does not hold up the requests in flight
+        questions = read_questions(input_path)
+        while True:
+            item = await asyncio.to_thread(next, questions, None)
+            if item is None:
+                break
+            if "error" in item:
+                invalid += 1
+                out.write(json.dumps(item) + "\n")
+                continue
+            await queue.put(item)
+        for _ in tasks:
+            await queue.put(None)
+        await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    await aclose_clients()
+
+    summary = latency_summary(latencies, elapsed)
+    logger.info("Answered %d of %d questions in %.1fs, %d failed; answers written to %s",
+                len(latencies) - failures, len(latencies), elapsed, failures, output_path)
+    logger.info(format_latency_summary(summary, unit="questions"))
+    if invalid:
+        logger.error("%d input lines were not valid questions; see the error records in %s", invalid, output_path)
+    if first_token_latencies:
+        logger.info("Time to first token: " + format_latency_summary(latency_summary(first_token_latencies), unit="questions"))
+    if cache is not None:
+        logger.info(cache.report())
+        if cache_latencies:
+            logger.info("Cached answers: " + format_latency_summary(latency_summary(cache_latencies), unit="questions"))
+    return failures == 0 and invalid == 0
+
+
+def ask_question(args, cache=None, retrieve=None):
+    # Create the Azure OpenAI client before prompting, so the first request does not wait for the SDK import
+    client = openai_client(api_version)
+
+    # Get user input question
+    text = input('\nEnter a question:\n')
+
+    embedding = None
+    if cache is not None:
+        start = time.perf_counter()
+        cached, how, embedding = lookup_answer(cache, client, text)
+        if cached is not None:
+            print("\n" + cached["answer"] + "\n")
+            logger.info("Answered from the cache, %s match, in %.0f ms", how, (time.perf_counter() - start) * 1000)
+            logger.info(cache.report())
+            return 0
+        cache.record_miss()
+
+    passages = None
+    if retrieve is not None:
+        start = time.perf_counter()
+        if embedding is None:
+            embedding = embed_question(client, text)
+        passages = retrieve_passages(retrieve, embedding)
+        logger.info("Retrieved %d passages locally in %.0f ms", len(passages), (time.perf_counter() - start) * 1000)
+
+    if args.stream:
+        # Print tokens as they arrive instead of waiting for the complete answer
+        print()
+        answer, citations, first_token, total = stream_answer(client, text, passages=passages)
+        first_token_ms = f"{first_token * 1000:.0f} ms" if first_token is not None else "n/a"
+        print("\n")
+        logger.info("First token %s, total %.0f ms", first_token_ms, total * 1000)
+        if cache is not None:
+            cache.put(text, cache_value(answer, citations, None, total), embedding)
+        return 0
+
+    # Send the question to the OpenAI API for completion
+    start = time.perf_counter()
+    with tracing.span("complete", stream=False) as complete_span:
+        completion = client.chat.completions.create(**build_request(text, passages))
+        complete_span.usage(completion.usage)
+    message = completion.choices[0].message
+    # Print the response from the OpenAI API
+    print("\n" + message.content + "\n")
+    if cache is not None:
+        usage = completion.usage.model_dump() if completion.usage else None
+        citations = passage_citations(passages) if passages is not None else get_citations(message)
+        cache.put(text, cache_value(message.content, citations, usage, time.perf_counter() - start), embedding)
+    # print(completion.model_dump_json(indent=2))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ask questions grounded in an Azure AI Search index.")
+    parser.add_argument("--batch", metavar="FILE", help="answer every question in a JSONL or text file ('-' for stdin)")
+    parser.add_argument("--output", default="answers.jsonl", help="JSONL file the batch answers are written to")
+    parser.add_argument("--workers", type=int, default=8, help="questions answered at the same time in batch mode")
+    parser.add_argument("--stream", action="store_true", help="stream the answer and record time to first token")
+    parser.add_argument("--cache", action="store_true", help="answer repeated and similar questions from an answer cache")
+    parser.add_argument("--cache-file", metavar="FILE", help="load the answer cache from and save it to this file (implies --cache)")
+    parser.add_argument("--cache-threshold", type=float, default=0.92, help="cosine similarity at which a cached question matches")
+    parser.add_argument("--cache-ttl", type=float, default=3600, help="seconds a cached answer stays valid")
+    parser.add_argument("--cache-size", type=int, default=1000, help="maximum number of cached answers")
+    parser.add_argument("--local-index", metavar="DIR", help="retrieve from this local vector store (see aisearchindexer.py --local-store) instead of Azure AI Search")
+    parser.add_argument("--top-k", type=int, default=5, help="passages retrieved from the local index")
+    parser.add_argument("--nprobe", type=int, default=8, help="IVF lists scanned per query when the local index is partitioned")
+    tracing.add_arguments(parser)
+    args = parser.parse_args()
+    tracing.setup(args, "OpenAIwithOwnData")
+    if args.local_index and not embedding_deployment:
+        parser.error("--local-index needs AZURE_OPENAI_EMBEDDING_DEPLOYMENT_ID to embed the questions")
+    if args.top_k < 1 or args.nprobe < 1:
+        parser.error("--top-k and --nprobe must be at least 1")
+    if args.cache_size < 1:
+        parser.error("--cache-size must be at least 1")
+
+    retrieve = None
+    if args.local_index:
+        store = LocalVectorStore(args.local_index)
+        retrieve = partial(store.search, k=args.top_k, nprobe=args.nprobe)
+    cache = create_answer_cache(args) if args.cache or args.cache_file else None
+    try:
+        if args.batch:
+            ok = asyncio.run(answer_batch(args.batch, args.output, args.workers, stream=args.stream, cache=cache, retrieve=retrieve))
+            return 0 if ok else 1
+        return ask_question(args, cache, retrieve)
+    finally:
+        if cache is not None and args.cache_file:
+            cache.save(args.cache_file)
+
+
+if __name__ == "__main__":
+    sys.exit(run_main(main))
@@ -1,5 +1,21 @@
 # Description: This script is used to create an Azure Search index, datasource, skillset, and indexer to index PDF documents stored in an Azure Blob Storage container.
 # The script uses the Azure SDK for Python to interact with Azure Search and Blob Storage services.
+# PDFs from a directory or glob are uploaded concurrently; files whose MD5 matches the blob already in the container are skipped.
+# With --push the PDFs are instead chunked locally, embedded in batches and uploaded straight to the index (see lib/pushindexing.py),
+# and --analyze / --analyze-index report chunk token lengths so chunk sizes can be tuned before indexing.
+# With --push --incremental a manifest of page and chunk hashes per document (lib/indexmanifest.py) is kept between runs: unchanged
+# files are skipped, only the chunks of changed pages are embedded and uploaded, chunks that disappeared are deleted from the index,
+# and the embedding calls and tokens saved are logged for the run.
+# --local-store writes the chunks and their vectors to a local memory-mapped vector store (lib/localretrieval.py) for
+# OpenAIwithOwnData.py --local-index, either while pushing or by exporting the chunks already in the index.
+# The Azure clients come from lib/clients.py, which creates them on first use, imports each SDK only when its client is
+# needed and shares one credential and connection pool between them, so e.g. --analyze does not load the Blob Storage,
+# identity or OpenAI SDKs.
+# Every Azure client goes through the shared adaptive rate limiter in lib/ratelimit.py, which retries throttled and
+# transient failures and adjusts the requests in flight to what each service allows.
+# With --monitor the script waits for the indexer run, streams progress, prints per-document errors and warnings and exits non-zero on failure.
+# Progress is logged on stderr (--log-level). With --trace every blob upload, page, chunk, embedding request, index upload batch
+# and HTTP request is timed (lib/tracing.py) and the time spent in each stage is logged at the end.
 # The Azure Search index is configured with a custom skillset that leverages the Azure Cognitive Search built-in skills for text extraction and language detection.
 # The datasource is set up to connect to the Azure Blob Storage container containing the PDF documents for indexing.
 # The skillset includes the built-in skills for text extraction and language detection, as well as custom skills for entity recognition and key phrase extraction.
@@ -12,26 +28,41 @@
 # The Azure Search service offers scalable and reliable document indexing capabilities for building search applications and knowledge discovery solutions.
 
 
+import argparse
+import asyncio
+import glob
+import hashlib
+import logging
+import sys
+import time
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from dotenv import load_dotenv
-from azure.identity import DefaultAzureCredential
-from azure.core.credentials import AzureKeyCredential
 import os
-from azure.storage.blob import BlobServiceClient
-from azure.search.documents.indexes import SearchIndexClient, SearchIndexerClient
+from azure.core.exceptions import ResourceExistsError
+from lib import clients
 from lib.common import (
     create_search_index,
     create_search_datasource, 
     create_search_skillset,
     create_search_indexer,
+    describe_lengths,
     get_chunks,
     get_token_length,
     plot_chunk_histogram
 )
-import matplotlib.pyplot as plt
+from lib.indexmanifest import DEFAULT_MANIFEST_PATH, IndexManifest
+from lib.localretrieval import LocalVectorStoreWriter, write_store
+from lib.pdfextract import page_pool
+from lib.pushindexing import IncrementalPush, PushStats, iter_document_chunks, push_documents
+from lib import tracing
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 search_endpoint = os.environ["AZURE_SEARCH_SERVICE_ENDPOINT"]
 search_index = os.environ["AZURE_SEARCH_INDEX"]
 search_datasource = os.environ["AZURE_SEARCH_DATASOURCE"] 
@@ -41,43 +72,103 @@ azure_openai_endpoint = os.environ["AZURE_OPENAI_ENDPOINT"]
 azure_openai_embedding_deployment_id = os.environ["AZURE_OPENAI_EMBEDDING_DEPLOYMENT_ID"]
 blob_container = os.environ["AZURE_BLOB_CONTAINER"]
 blob_connection_string = os.environ["AZURE_BLOB_CONNECTION_STRING"]
-blob_account_url = os.environ["AZURE_BLOB_ACCOUNT_URL"]
 
-search_credential = AzureKeyCredential(os.environ["AZURE_SEARCH_ADMIN_KEY"]) if len(os.environ["AZURE_SEARCH_ADMIN_KEY"]) > 0 else DefaultAzureCredential()
+# The clients are created on first use by lib/clients.py, which reads the endpoints and keys from the same variables;
+# the search key falls back to DefaultAzureCredential when it is empty
 azure_openai_key = os.environ["AZURE_OPENAI_KEY"] if len(os.environ["AZURE_OPENAI_KEY"]) > 0 else None
 
-def open_blob_client():
-    if not blob_connection_string.startswith("ResourceId"):
-        print("Using connection string")
-        return BlobServiceClient.from_connection_string(
-            blob_connection_string,
-            max_block_size=1024*1024*8,
-            max_single_put_size=1024*1024*8
-        )
-    return BlobServiceClient(
-        account_url=blob_account_url,
-        credential=blob_connection_string,
-        max_block_size=1024*1024*8,
-        max_single_put_size=1024*1024*8
-    )
+def glob_base(pattern):
+    # the directory a glob pattern searches from: its leading path components without wildcards
+    base = os.path.dirname(pattern)
+    while glob.has_magic(base):
+        base = os.path.dirname(base)
+    return base
+
+def find_pdfs(source):
+    # source can be a directory (searched recursively), a glob pattern or a single file
+    # returns (local path, blob name) pairs; blob names keep the path relative to the directory, or to the
+    # directory a glob searches from, so docs/**/*.pdf keeps a/report.pdf and b/report.pdf apart
+    if os.path.isdir(source):
+        base = source
+        paths = glob.glob(os.path.join(source, "**", "*.pdf"), recursive=True)
+    else:
+        base = glob_base(source)
+        paths = glob.glob(source, recursive=True) if glob.has_magic(source) else [source]
+    return sorted((path, os.path.relpath(path, base or os.curdir).replace(os.sep, "/"))
+                  for path in paths if os.path.isfile(path))
+
+def file_md5(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024*1024*8), b""):
+            md5.update(block)
+    return md5.digest()
+
+def upload_pdfs(source=os.path.join("data", "*.pdf"), workers=8, block_concurrency=2):
+    files = find_pdfs(source)
+    logger.info("Found %d PDF files in %s", len(files), source)
+    from azure.storage.blob import ContentSettings
 
-def upload_pdf():
-    blob_client = open_blob_client()
-    print(blob_client)
+    blob_client = clients.blob_service_client(pool_size=workers * block_concurrency)
     container_client = blob_client.get_container_client(blob_container)
-    print(container_client)
-    if not container_client.exists():
+    try:
         container_client.create_container()
-        
-    file_path = os.path.join("earth_at_night_508.pdf")
-    blob_name = os.path.basename(file_path)
-    blob_client = container_client.get_blob_client(blob_name)
-    if not blob_client.exists():
-        with open(file_path, "rb") as f:
-            blob_client.upload_blob(data=f, overwrite=True)
+    except ResourceExistsError:
+        pass
+
+    # One container listing gives the content MD5 of every existing blob instead of one HEAD per file
+    remote_md5 = {}
+    for blob in container_client.list_blobs():
+        if blob.content_settings.content_md5:
+            remote_md5[blob.name] = bytes(blob.content_settings.content_md5)
+
+    def upload(file_path, blob_name):
+        with tracing.span("blob.upload", blob=blob_name) as upload_span:
+            md5 = file_md5(file_path)
+            if remote_md5.get(blob_name) == md5:
+                upload_span.set(skipped=True)
+                return 0, False
+            # Files above max_single_put_size are sent as 8 MiB blocks, block_concurrency at a time.
+            # Content-MD5 is set explicitly because the service does not compute it for block uploads.
+            with open(file_path, "rb") as f:
+                container_client.upload_blob(
+                    name=blob_name,
+                    data=f,
+                    overwrite=True,
+                    max_concurrency=block_concurrency,
+                    content_settings=ContentSettings(content_type="application/pdf", content_md5=bytearray(md5)),
+                )
+            size = os.path.getsize(file_path)
+            upload_span.add(bytes=size)
+            return size, True
+
+    uploaded = skipped = failed = 0
+    uploaded_bytes = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(tracing.bind(upload), file_path, blob_name): blob_name for file_path, blob_name in files}
+        for future in as_completed(futures):
+            try:
+                size, changed = future.result()
+            except Exception as e:
+                failed += 1
+                logger.error("Failed to upload %s: %s", futures[future], e)
+                continue
+            if changed:
+                uploaded += 1
+                uploaded_bytes += size
+            else:
+                skipped += 1
+    elapsed = time.perf_counter() - start
+
+    megabytes = uploaded_bytes / (1024 * 1024)
+    logger.info("Uploaded %d files (%.1f MB), skipped %d unchanged, %d failed in %.1fs", uploaded, megabytes, skipped, failed, elapsed)
+    if elapsed > 0:
+        logger.info("Throughput: %.2f MB/s, %.1f files/s", megabytes / elapsed, (uploaded + skipped) / elapsed)
+    return failed == 0
 
 def setup_search_resources():
-    search_index_client = SearchIndexClient(endpoint=search_endpoint, credential=search_credential)
+    search_index_client = clients.search_index_client()
     index = create_search_index(
         search_index,
         azure_openai_endpoint,
@@ -86,7 +177,7 @@ def setup_search_resources():
     )
     search_index_client.create_or_update_index(index)
     
-    search_indexer_client = SearchIndexerClient(endpoint=search_endpoint, credential=search_credential)
+    search_indexer_client = clients.search_indexer_client()
     
     data_source = create_search_datasource(
         search_datasource,
@@ -114,20 +205,255 @@ def setup_search_resources():
         skillset_name=search_skillset
     )
     search_indexer_client.create_or_update_indexer(indexer)
-    search_indexer_client.run_indexer(search_indexer)
-    
-    print("Running indexer")
+    # remember the previous run so the monitor can tell when the new run has started
+    previous_run = search_indexer_client.get_indexer_status(search_indexer).last_result
+    with tracing.span("indexer.run", indexer=search_indexer):
+        search_indexer_client.run_indexer(search_indexer)
+
+    logger.info("Running indexer %s", search_indexer)
+    return previous_run.start_time if previous_run else None
+
+def count_source_documents(modified_after=None):
+    # number of blobs the run will process, used to estimate the time left: the indexer only picks up
+    # blobs changed since the previous run, so after an incremental upload that is usually a handful
+    try:
+        container_client = clients.blob_service_client().get_container_client(blob_container)
+        return sum(1 for blob in container_client.list_blobs()
+                   if modified_after is None or blob.last_modified > modified_after)
+    except Exception as e:
+        logger.warning("Could not count source documents, no ETA will be shown: %s", e)
+        return None
 
+def monitor_current_run(timeout=None):
+    # Watch the current (or last) run, which only processes the blobs changed since the run before it
+    history = clients.search_indexer_client().get_indexer_status(search_indexer).execution_history or []
+    modified_after = history[1].start_time if len(history) > 1 else None
+    return monitor_indexer(total_documents=count_source_documents(modified_after), timeout=timeout)
+
+def monitor_indexer(previous_start_time=None, total_documents=None, min_interval=2, max_interval=30, timeout=None):
+    # Poll the indexer status until the run started after previous_start_time finishes.
+    # The interval resets to min_interval while documents are being processed and doubles
+    # up to max_interval while nothing changes. Returns 0 if the run succeeded with no failed documents.
+    search_indexer_client = clients.search_indexer_client()
+    interval = min_interval
+    last_count = None
+    started = time.monotonic()
+    result = None
+    while True:
+        status = search_indexer_client.get_indexer_status(search_indexer)
+        result = status.last_result
+        if result is not None and result.start_time != previous_start_time:
+            processed = result.item_count or 0
+            failed = result.failed_item_count or 0
+            end_time = result.end_time or datetime.now(timezone.utc)
+            elapsed = max((end_time - result.start_time).total_seconds(), 1e-6)
+            rate = processed / elapsed
+            line = f"[{result.status}] {processed} documents processed, {failed} failed, {rate:.2f} docs/s"
+            if total_documents and rate > 0 and result.status == "inProgress":
+                remaining = max(total_documents - processed, 0)
+                line += f", ETA {remaining / rate:.0f}s"
+            logger.info(line)
+            if result.status != "inProgress":
+                break
+            if processed != last_count:
+                interval = min_interval
+                last_count = processed
+            else:
+                interval = min(interval * 2, max_interval)
+        else:
+            logger.info("Waiting for the indexer run to start")
+        if timeout is not None and time.monotonic() - started > timeout:
+            logger.error("Gave up waiting for indexer %s after %ss", search_indexer, timeout)
+            return 2
+        time.sleep(interval)
+
+    logger.info("Indexer %s finished with status '%s'", search_indexer, result.status)
+    if result.error_message:
+        logger.error("Error: %s", result.error_message)
+    logger.info("Processed %s documents, %s failed, in %.1fs", result.item_count, result.failed_item_count, elapsed)
+    if result.errors:
+        logger.error("%d errors:", len(result.errors))
+        for error in result.errors:
+            logger.error("  %s: [%s] %s", error.key, error.status_code, error.error_message)
+    if result.warnings:
+        logger.warning("%d warnings:", len(result.warnings))
+        for warning in result.warnings:
+            logger.warning("  %s: %s", warning.key, warning.message)
+    return 0 if result.status == "success" and not result.failed_item_count else 1
+
+
+def analyze_chunking(source, max_tokens, overlap_tokens, histogram_path=None):
+    # Chunk the PDFs locally and report chunk token lengths without calling any Azure service,
+    # so chunk sizes can be tuned before paying for embeddings and indexing
+    files = find_pdfs(source)
+    with page_pool() as pool:
+        chunks = [document["chunk"] for document in
+                  iter_document_chunks(files, max_tokens=max_tokens, overlap_tokens=overlap_tokens, pool=pool)]
+    logger.info("Chunked %d PDF files into %d chunks (max %d tokens, %d overlap)", len(files), len(chunks), max_tokens, overlap_tokens)
+    lengths = plot_chunk_histogram(chunks, length_fn=get_token_length, title=f"Local chunks ({max_tokens} max tokens)", output_path=histogram_path)
+    print(describe_lengths(lengths))
+
+def analyze_index(histogram_path=None):
+    # Report token lengths of the chunks already in the index, e.g. the ones the skillset produced
+    chunks = get_chunks(clients.search_client(search_index))
+    logger.info("Read %d chunks from index %s", len(chunks), search_index)
+    lengths = plot_chunk_histogram(chunks, length_fn=get_token_length, title=f"Chunks in {search_index}", output_path=histogram_path)
+    print(describe_lengths(lengths))
+
+def export_local_store(path, nlist=None):
+    # Copy the chunks and vectors already in the index, e.g. the ones the skillset produced, into a local vector store
+    chunks = get_chunks(clients.search_client(search_index), select=("chunk_id", "parent_id", "title", "chunk", "vector"))
+    count = write_store(path, (chunk for chunk in chunks if chunk.get("vector")), nlist=nlist)
+    logger.info("Wrote %d of %d chunks from index %s to local store %s", count, len(chunks), search_index, path)
+
+async def push_pdfs(source, max_tokens, overlap_tokens, embed_batch_size=16, max_embedding_requests=4, max_uploads_in_flight=2,
+                    local_store=None, local_only=False, nlist=None, manifest_path=None, prune=False, reset_manifest=False):
+    # Client-side alternative to the skillset: chunk locally, embed in batches and upload the chunks to the index.
+    # With local_store the embedded chunks are also written to a local vector store; local_only skips the index.
+    # With manifest_path only the chunks that changed since the previous run are embedded and uploaded (see IncrementalPush).
+    if not local_only:
+        search_index_client = clients.search_index_client()
+        index = create_search_index(
+            search_index,
+            azure_openai_endpoint,
+            azure_openai_embedding_deployment_id,
+            azure_openai_key
+        )
+        search_index_client.create_or_update_index(index)
+
+    # Without AZURE_OPENAI_KEY the embeddings are requested with Entra ID tokens from the shared credential
+    openai_client = clients.async_openai_client("2024-02-01")
+
+    stats = PushStats()
+    # One pool extracts the pages of every PDF, instead of a pool started for each document
+    pool = page_pool()
+    manifest = incremental = None
+    if manifest_path:
+        manifest = IndexManifest(manifest_path, search_index)
+        if reset_manifest:
+            manifest.clear()
+        incremental = IncrementalPush(manifest, azure_openai_embedding_deployment_id, max_tokens=max_tokens, overlap_tokens=overlap_tokens,
+                                      pool=pool)
+        documents = incremental.iter_chunks(find_pdfs(source), stats=stats)
+    else:
+        documents = iter_document_chunks(find_pdfs(source), max_tokens=max_tokens, overlap_tokens=overlap_tokens, stats=stats, pool=pool)
+    writer = LocalVectorStoreWriter(local_store) if local_store else None
+    search_client = None
+    if not local_only:
+        search_client = clients.async_search_client(search_index)
+    try:
+        await push_documents(
+            documents,
+            openai_client,
+            search_client,
+            azure_openai_embedding_deployment_id,
+            stats=stats,
+            embed_batch_size=embed_batch_size,
+            max_embedding_requests=max_embedding_requests,
+            max_uploads_in_flight=max_uploads_in_flight,
+            on_embedded=writer.add if writer else None,
+        )
+        if writer:
+            writer.close(nlist=nlist)
+            logger.info("Wrote %d chunks to local store %s", writer.count, local_store)
+        if incremental:
+            await incremental.finish(search_client, stats, prune=prune)
+    finally:
+        pool.shutdown(cancel_futures=True)
+        await clients.aclose_clients()
+        if manifest:
+            manifest.close()
+    logger.info(stats.report())
+    if incremental:
+        logger.info(incremental.stats.report())
+    for error in stats.errors[:20]:
+        logger.error("  %s", error)
+    return stats.failed == 0 and not (incremental and incremental.stats.delete_failed)
 
 def main():
-    # Upload PDF file to Azure Blob Storage
-    # recommend commenting out this line after the first run to avoid re-uploading the same file
-    upload_pdf()
+    parser = argparse.ArgumentParser(description="Upload PDFs to Azure Blob Storage and set up the Azure AI Search indexer.")
+    parser.add_argument("--source", default=os.path.join("data", "*.pdf"), help="directory, glob pattern or file of PDFs to upload")
+    parser.add_argument("--workers", type=int, default=8, help="files uploaded at the same time")
+    parser.add_argument("--block-concurrency", type=int, default=2, help="8 MiB blocks uploaded at the same time per file")
+    parser.add_argument("--skip-upload", action="store_true", help="do not upload PDFs")
+    parser.add_argument("--skip-setup", action="store_true", help="do not create or run the search resources")
+    parser.add_argument("--monitor", action="store_true", help="wait for the indexer run to finish, report progress and errors, and exit non-zero on failure")
+    parser.add_argument("--monitor-only", action="store_true", help="only monitor the current (or last) indexer run")
+    parser.add_argument("--monitor-timeout", type=float, default=None, help="stop monitoring after this many seconds")
+    parser.add_argument("--push", action="store_true", help="chunk, embed and upload the PDFs from --source directly instead of using the skillset")
+    parser.add_argument("--analyze", action="store_true", help="only chunk the PDFs from --source locally and report chunk token lengths")
+    parser.add_argument("--analyze-index", action="store_true", help="only report token lengths of the chunks already in the index")
+    parser.add_argument("--histogram", default=None, help="save the chunk length histogram to this file instead of showing it")
+    parser.add_argument("--max-tokens", type=int, default=512, help="maximum tokens per chunk for --push and --analyze")
+    parser.add_argument("--overlap-tokens", type=int, default=128, help="tokens of overlap between chunks for --push and --analyze")
+    parser.add_argument("--embed-batch-size", type=int, default=16, help="chunks per embedding request for --push")
+    parser.add_argument("--embedding-requests", type=int, default=4, help="embedding requests in flight for --push")
+    parser.add_argument("--upload-batches", type=int, default=2, help="index upload batches in flight for --push")
+    parser.add_argument("--local-store", metavar="DIR", help="with --push also write the embedded chunks to this local vector store; "
+                        "without --push export the chunks already in the index to it")
+    parser.add_argument("--local-only", action="store_true", help="with --push and --local-store do not upload to the index")
+    parser.add_argument("--incremental", action="store_true", help="with --push only embed and upload the chunks of pages that changed "
+                        "since the last incremental push and delete the chunks that disappeared; chunks never cross a page boundary")
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST_PATH, help="page and chunk hashes of the documents pushed with --incremental")
+    parser.add_argument("--prune", action="store_true", help="with --incremental also delete the chunks of documents that are no longer in --source")
+    parser.add_argument("--reset-manifest", action="store_true", help="with --incremental forget the manifest of the index and push every document again, "
+                        "e.g. after the index was recreated")
+    parser.add_argument("--ivf-lists", type=int, default=None, help="partition the local store into this many IVF lists (about sqrt of the chunk count)")
+    tracing.add_arguments(parser)
+    args = parser.parse_args()
+    if args.incremental and (not args.push or args.local_store):
+        parser.error("--incremental needs --push and cannot be combined with --local-store")
+    tracing.setup(args, "aisearchindexer")
+
+    if args.analyze:
+        analyze_chunking(args.source, args.max_tokens, args.overlap_tokens, args.histogram)
+        return 0
+    if args.analyze_index:
+        analyze_index(args.histogram)
+        return 0
+    if args.push:
+        succeeded = asyncio.run(push_pdfs(
+            args.source,
+            args.max_tokens,
+            args.overlap_tokens,
+            embed_batch_size=args.embed_batch_size,
+            max_embedding_requests=args.embedding_requests,
+            max_uploads_in_flight=args.upload_batches,
+            local_store=args.local_store,
+            local_only=args.local_only,
+            nlist=args.ivf_lists,
+            manifest_path=args.manifest if args.incremental else None,
+            prune=args.prune,
+            reset_manifest=args.reset_manifest,
+        ))
+        return 0 if succeeded else 1
+    if args.local_store:
+        export_local_store(args.local_store, nlist=args.ivf_lists)
+        return 0
+
+    # Only watch the current (or last) run: nothing is uploaded or created
+    if args.monitor_only:
+        return monitor_current_run(args.monitor_timeout)
+
+    # Upload PDF files to Azure Blob Storage
+    # files whose content MD5 matches the blob already in the container are skipped
+    if not args.skip_upload:
+        if not upload_pdfs(args.source, workers=args.workers, block_concurrency=args.block_concurrency):
+            return 1
     # Setup Azure Search resources including indexer 
     # only needs to be run once to create the resources
-    # recommend running upload_pdf first by itself, the commenting it out, and run below line separately
+    # recommend running the upload first by itself (--skip-setup), then run the setup separately (--skip-upload)
     # after running check in azure that blob storage created and search index created
-    setup_search_resources()
+    if not args.skip_setup:
+        previous_start_time = setup_search_resources()
+        # wait for the run so a deployment step can be gated on the exit code
+        if args.monitor:
+            return monitor_indexer(previous_start_time, total_documents=count_source_documents(previous_start_time),
+                                   timeout=args.monitor_timeout)
+    elif args.monitor:
+        # No run was started here, so watch the current (or last) one as --monitor-only does
+        return monitor_current_run(args.monitor_timeout)
+    return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(clients.run_main(main))
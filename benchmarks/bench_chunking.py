@@ -0,0 +1,125 @@
+# Description: Benchmark comparing the original character-based create_chunks from largedocsummary.py
+# with the token-aware streaming chunker in lib/chunking.py on large synthetic documents.
+# The original function is copied here unchanged so it can be measured after it was replaced.
+# Its prints are sent to os.devnull, which still pays the formatting and write cost on every line.
+# Run from the repository root:
+#   python benchmarks/bench_chunking.py --sizes 1 10 50
+# Sizes are in millions of characters. Roughly 2,000 pages of contract text is about 6 million.
+
+import argparse
+import contextlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.chunking import chunk_text, get_encoding  # noqa: E402
+
+
+def legacy_create_chunks(text, chunk_size=10000, overlap=2000):  # 800KB chunks with 200 char overlap
+    print("Creating chunks...")
+    chunks = []
+    start = 0
+    text_length = len(text)
+    print(f"Text length: {text_length}")
+
+    while start < text_length:
+        print(f"Starting new chunk at position {start}")
+        end = start + chunk_size
+        print(f"Initial end position: {end}")
+
+        # If this is not the last chunk, adjust end to not break words
+        if end < text_length:
+            # Adjust end to the last space within the chunk
+            original_end = end
+            while end > start and not text[end-1].isspace():
+                end -= 1
+            print(f"Adjusted end from {original_end} to {end} to avoid breaking words")
+        else:
+            end = text_length
+            print(f"Last chunk, using text_length as end: {end}")
+
+        # Create chunk and add to list
+        chunk = text[start:end].strip()
+        if chunk:  # Only add non-empty chunks
+            # Store chunk as plain string, not in a list
+            chunks.append(chunk)
+            print(f"Added chunk of length: {len(chunk)}")
+
+        # Move start position for next chunk, including overlap
+        old_start = start
+        start = end - overlap
+        print(f"Moving start position from {old_start} to {start} (overlap: {overlap})")
+
+        if start <= old_start:
+            print("Warning: Start position not advancing!")
+            # Force advancement to avoid infinite loop
+            start = end
+            print(f"Forced start position to {start}")
+
+    print(f"Final number of chunks: {len(chunks)}")
+    return chunks
+
+
+WORDS = (
+    "the contractor shall provide services under this agreement including all deliverables "
+    "described in schedule a subject to acceptance by the client within thirty days of receipt "
+    "payment terms liability indemnification termination confidentiality governing law"
+).split()
+
+
+def make_document(num_chars, seed=0):
+    # Builds prose with sentences, paragraphs and page breaks similar to extracted PDF text.
+    rng = random.Random(seed)
+    parts = []
+    size = 0
+    while size < num_chars:
+        sentences = []
+        for _ in range(rng.randint(2, 8)):
+            words = [rng.choice(WORDS) for _ in range(rng.randint(6, 30))]
+            sentences.append(" ".join(words).capitalize() + ".")
+        paragraph = " ".join(sentences) + ("\n\n" if rng.random() < 0.7 else "\n")
+        parts.append(paragraph)
+        size += len(paragraph)
+    return "".join(parts)[:num_chars]
+
+
+def time_call(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the legacy and streaming chunkers.")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 5, 10],
+                        help="document sizes in millions of characters")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="legacy chunk size in characters")
+    parser.add_argument("--overlap", type=int, default=2000, help="legacy overlap in characters")
+    parser.add_argument("--max-tokens", type=int, default=2500, help="streaming chunk size in tokens")
+    parser.add_argument("--overlap-tokens", type=int, default=500, help="streaming overlap in tokens")
+    args = parser.parse_args()
+
+    encoding = get_encoding()
+    print(f"{'chars':>12} {'impl':>10} {'seconds':>9} {'MB/s':>8} {'chunks':>7} {'max tokens':>11}")
+    for size in args.sizes:
+        text = make_document(int(size * 1_000_000))
+        megabytes = len(text.encode("utf-8")) / (1024 * 1024)
+
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            legacy_seconds, legacy = time_call(
+                lambda: legacy_create_chunks(text, args.chunk_size, args.overlap))
+        streaming_seconds, streaming = time_call(
+            lambda: list(chunk_text(text, args.max_tokens, args.overlap_tokens, encoding=encoding)))
+
+        for name, seconds, chunks in (("legacy", legacy_seconds, legacy),
+                                      ("streaming", streaming_seconds, streaming)):
+            max_tokens = max(len(encoding.encode_ordinary(chunk)) for chunk in chunks)
+            print(f"{len(text):>12} {name:>10} {seconds:>9.3f} {megabytes / seconds:>8.1f} "
+                  f"{len(chunks):>7} {max_tokens:>11}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# Description: Benchmark of the local vector store in lib/localretrieval.py against corpus size.
+# For every size a store of synthetic clustered embeddings is written to a temporary directory, once
+# with exact search and once with an IVF partition of about sqrt(size) lists, and the script reports
+# build time, size on disk, resident memory after the queries, queries per second and the recall of
+# the IVF search against exact search.
+# Run from the repository root:
+#   python benchmarks/bench_localretrieval.py --sizes 10000 100000 --dimensions 1536
+
+import argparse
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.localretrieval import LocalVectorStore, write_store  # noqa: E402
+
+
+def resident_mb():
+    # Current resident set size on Linux, peak resident size elsewhere
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def make_documents(size, dimensions, clusters=256, block=10000, seed=0):
+    # Chunks drawn around random cluster centers, generated a block at a time
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimensions)).astype(np.float32)
+    for start in range(0, size, block):
+        count = min(block, size - start)
+        vectors = centers[rng.integers(clusters, size=count)] + rng.standard_normal((count, dimensions)).astype(np.float32)
+        for offset, vector in enumerate(vectors):
+            row = start + offset
+            yield {
+                "chunk_id": f"doc{row // 20}_pages_{row % 20}",
+                "parent_id": f"doc{row // 20}",
+                "title": f"document-{row // 20}.pdf",
+                "chunk": f"Synthetic chunk {row} of the benchmark corpus. " * 8,
+                "vector": vector,
+            }
+
+
+def run_queries(store, queries, k, nprobe):
+    start = time.perf_counter()
+    results = [[document["chunk_id"] for document in store.search(query, k=k, nprobe=nprobe)] for query in queries]
+    return len(queries) / (time.perf_counter() - start), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure local vector retrieval against corpus size.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000, 100000], help="chunks per corpus")
+    parser.add_argument("--dimensions", type=int, default=1536, help="embedding dimensions")
+    parser.add_argument("--queries", type=int, default=200, help="queries per measurement")
+    parser.add_argument("--k", type=int, default=5, help="results per query")
+    parser.add_argument("--nprobe", type=int, default=8, help="IVF lists scanned per query")
+    args = parser.parse_args()
+
+    print(f"{'chunks':>9} {'mode':>6} {'build s':>8} {'disk MB':>8} {'RSS MB':>8} {'queries/s':>10} {'recall':>7}")
+    for size in args.sizes:
+        nlist = max(1, int(math.sqrt(size)))
+        exact_results = exact_queries = None
+        for mode, lists in (("exact", None), ("ivf", nlist)):
+            path = tempfile.mkdtemp(prefix="localretrieval-")
+            try:
+                start = time.perf_counter()
+                write_store(path, make_documents(size, args.dimensions), nlist=lists)
+                build_seconds = time.perf_counter() - start
+
+                store = LocalVectorStore(path)
+                rng = np.random.default_rng(1)
+                rows = rng.integers(size, size=args.queries)
+                queries = store.vectors[np.sort(rows)] + 0.5 * rng.standard_normal((args.queries, args.dimensions)).astype(np.float32) / math.sqrt(args.dimensions)
+                if lists:
+                    # the stored matrix is sorted by list, so the same rows are different chunks; query the exact store's chunks
+                    queries = exact_queries
+                else:
+                    exact_queries = queries
+                per_second, results = run_queries(store, queries, args.k, args.nprobe)
+                if exact_results is None:
+                    exact_results = results
+                    recall = 1.0
+                else:
+                    recall = np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(results, exact_results)])
+                print(f"{size:>9} {mode:>6} {build_seconds:>8.1f} {store.nbytes / (1024 * 1024):>8.1f} "
+                      f"{resident_mb():>8.0f} {per_second:>10.0f} {recall:>7.3f}")
+                del store
+            finally:
+                shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+# Description: Offline benchmark of the pipelines against the local stand-in Azure services in fakeazure.py.
+# Every scenario generates its input in a temporary directory, starts the script with the environment
+# pointing at the fake services and records the wall time, throughput, peak resident memory of the
+# script (taken from os.wait4, so POSIX only) and the requests the fake services received, by operation
+# and status. Latency, throttling and injected failures of the fake services are set with the same flags
+# as fakeazure.py, so the scripts can be compared under the same, repeatable conditions.
+# The results are written as JSON; --compare prints the change against an earlier results file, e.g. one
+# taken on the previous commit.
+# Run from the repository root:
+#   python benchmarks/bench_pipelines.py --output bench_pipelines.json
+#   python benchmarks/bench_pipelines.py --scenarios ask push --latency-ms 80 --set openai.max_concurrency=4 --compare old.json
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_startup import write_pdf  # noqa: E402
+from fakeazure import DEFAULT_CONFIG, FakeAzure, build_config, client_environment  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def summarize_scenario(directory, scale):
+    pages = 40 * scale
+    path = os.path.join(directory, "large.pdf")
+    write_pdf(path, pages=pages)
+    return ["largedocsummary.py", path, "--no-cache"], pages, "pages"
+
+
+def upload_scenario(directory, scale):
+    files = 20 * scale
+    source = os.path.join(directory, "upload")
+    os.makedirs(source)
+    for number in range(files):
+        write_pdf(os.path.join(source, f"document-{number}.pdf"), pages=5)
+    return ["aisearchindexer.py", "--source", source, "--skip-setup"], files, "files"
+
+
+def indexer_scenario(directory, scale):
+    return ["aisearchindexer.py", "--skip-upload", "--monitor"], None, "runs"
+
+
+def push_scenario(directory, scale):
+    files = 10 * scale
+    source = os.path.join(directory, "push")
+    os.makedirs(source)
+    for number in range(files):
+        write_pdf(os.path.join(source, f"document-{number}.pdf"), pages=5)
+    return ["aisearchindexer.py", "--push", "--source", source], files, "files"
+
+
+def ask_scenario(directory, scale):
+    questions = 100 * scale
+    path = os.path.join(directory, "questions.jsonl")
+    with open(path, "w", encoding="utf-8") as f:
+        for number in range(questions):
+            f.write(json.dumps({"id": number, "question": f"What does section {number} of the contract require?"}) + "\n")
+    return ["OpenAIwithOwnData.py", "--batch", path, "--output", os.path.join(directory, "answers.jsonl")], questions, "questions"
+
+
+def chat_scenario(directory, scale):
+    # Streamed turns in which the model first calls the search plugin, then answers from its results
+    turns = 5 * scale
+    path = os.path.join(directory, "turns.txt")
+    with open(path, "w", encoding="utf-8") as f:
+        f.writelines(f"What does section {number} of the contract require?\n" for number in range(turns))
+        f.write("exit\n")
+    # Semantic Kernel only accepts an https OpenAI endpoint
+    return ["semantickernelwithaisearch.py", "--stream"], turns, "turns", {"stdin": path, "tls": True}
+
+
+def agents_scenario(directory, scale):
+    rfps = 4 * scale
+    source = os.path.join(directory, "rfps")
+    os.makedirs(source)
+    for number in range(rfps):
+        write_pdf(os.path.join(source, f"rfp-{number}.pdf"), pages=3)
+    return (["filesearchagent.py", source, "--no-registry", "--output", os.path.join(directory, "rfp_summaries.jsonl")],
+            rfps, "RFPs")
+
+
+SCENARIOS = {
+    "summarize": summarize_scenario,
+    "upload": upload_scenario,
+    "indexer": indexer_scenario,
+    "push": push_scenario,
+    "ask": ask_scenario,
+    "chat": chat_scenario,
+    "agents": agents_scenario,
+}
+
+
+def run_script(arguments, env, cwd, log_path, stdin_path=None):
+    # Returns wall seconds, exit code and peak resident memory in MB of the script and the processes it waited for
+    with open(log_path, "wb") as log, open(stdin_path or os.devnull, "rb") as stdin:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.join(ROOT, arguments[0]), *arguments[1:]], env=env, cwd=cwd,
+                                   stdin=stdin, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    peak_kb = usage.ru_maxrss / 1024 if sys.platform == "darwin" else usage.ru_maxrss
+    return wall, process.returncode, peak_kb / 1024
+
+
+def log_tail(path, lines=10):
+    with open(path, encoding="utf-8", errors="replace") as f:
+        return f.read().strip().splitlines()[-lines:]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_scenario(fake, name, env, scale, repeat):
+    with tempfile.TemporaryDirectory(prefix=f"bench-{name}-") as directory:
+        # A scenario may also return options: a file for the script's stdin, and tls to call OpenAI over https
+        arguments, items, unit, *options = SCENARIOS[name](directory, scale)
+        options = options[0] if options else {}
+        if options.get("tls"):
+            env = dict(env, AZURE_OPENAI_ENDPOINT=env["AZURE_SEARCH_SERVICE_ENDPOINT"])
+        if items is None:
+            items = int(fake.setting("search", "indexer_documents"))
+            unit = "documents"
+        walls = []
+        for attempt in range(repeat):
+            # Every run starts from empty fake services, so reruns see the same state
+            fake.reset()
+            log_path = os.path.join(directory, f"run-{attempt}.log")
+            wall, exit_code, peak_mb = run_script(arguments, env, directory, log_path, options.get("stdin"))
+            walls.append(wall)
+            if exit_code != 0:
+                break
+        wall = statistics.median(walls)
+        result = {
+            "command": arguments,
+            "exit_code": exit_code,
+            "wall_seconds": round(wall, 3),
+            "wall_seconds_runs": [round(w, 3) for w in walls],
+            "items": items,
+            "unit": unit,
+            "throughput_per_second": round(items / wall, 3) if wall > 0 else None,
+            "peak_rss_mb": round(peak_mb, 1),
+        }
+        # The counters are those of the last run
+        result.update(fake.stats())
+        if exit_code != 0:
+            result["log_tail"] = log_tail(log_path)
+        return result
+
+
+def compare(previous, current):
+    print(f"\n{'scenario':<10} {'wall s':>22} {'throughput/s':>24} {'peak MB':>22} {'requests':>12}")
+    for name, result in current["scenarios"].items():
+        before = previous.get("scenarios", {}).get(name)
+        if before is None:
+            continue
+
+        def change(key):
+            old, new = before.get(key), result.get(key)
+            if not old or new is None:
+                return f"{new}"
+            return f"{old:g}->{new:g} ({(new - old) / old:+.0%})"
+
+        requests = f"{sum(before.get('requests', {}).values())}->{sum(result.get('requests', {}).values())}"
+        print(f"{name:<10} {change('wall_seconds'):>22} {change('throughput_per_second'):>24} {change('peak_rss_mb'):>22} {requests:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipelines against local stand-in Azure services.")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS), help="scenarios to run")
+    parser.add_argument("--scale", type=int, default=1, help="multiply the size of every workload")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per scenario; the median wall time is reported")
+    parser.add_argument("--output", default="bench_pipelines.json", help="JSON file the results are written to")
+    parser.add_argument("--compare", metavar="FILE", help="print the change against an earlier results file")
+    parser.add_argument("--latency-ms", type=float, default=DEFAULT_CONFIG["latency_ms"], help="added to every request")
+    parser.add_argument("--jitter-ms", type=float, default=DEFAULT_CONFIG["jitter_ms"], help="random extra latency up to this")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=DEFAULT_CONFIG["retry_after"], help="seconds sent in Retry-After")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="requests in flight per service above which 429 is returned")
+    parser.add_argument("--set", action="append", default=[], metavar="[SERVICE.]KEY=VALUE",
+                        help="override a fake service setting, e.g. openai.max_concurrency=8 (see fakeazure.py)")
+    args = parser.parse_args()
+
+    config = build_config({"latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "throttle_rate": args.throttle_rate,
+                           "retry_after": args.retry_after, "error_rate": args.error_rate,
+                           "max_concurrency": args.max_concurrency}, args.set)
+    fake = FakeAzure(config)
+    url, https_url, certificate = fake.start()
+    env = dict(os.environ, **client_environment(url, https_url, certificate))
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "scale": args.scale,
+        "fake_config": config,
+        "scenarios": {},
+    }
+    print(f"{'scenario':<10} {'exit':>4} {'wall s':>8} {'throughput':>18} {'peak MB':>8} {'requests':>9} {'429':>5} {'5xx':>5}")
+    try:
+        for name in args.scenarios:
+            result = run_scenario(fake, name, env, args.scale, args.repeat)
+            results["scenarios"][name] = result
+            statuses = result["statuses"]
+            server_errors = sum(count for status, count in statuses.items() if status.startswith("5"))
+            throughput = f"{result['throughput_per_second']:.2f} {result['unit']}/s"
+            print(f"{name:<10} {result['exit_code']:>4} {result['wall_seconds']:>8.2f} {throughput:>18} {result['peak_rss_mb']:>8.0f} "
+                  f"{sum(result['requests'].values()):>9} {statuses.get('429', 0):>5} {server_errors:>5}")
+            for line in result.get("log_tail", []):
+                print(f"    {line}")
+    finally:
+        fake.stop()
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), results)
+    return 0 if all(result["exit_code"] == 0 for result in results["scenarios"].values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+# Description: Startup benchmark of the entry-point scripts.
+# For every script it reports the module import time measured with python -X importtime (the sum of the
+# top-level imports and the heaviest of them), the wall time of running it with --help, and the time from
+# starting the process to its first HTTP request. The first request goes to a local HTTP server that all
+# endpoints in the environment point at; it answers every request with an empty JSON object and the
+# script is stopped once the request has arrived. Questions for the interactive scripts are sent on stdin.
+# filesearchagent.py only talks to https project endpoints, so only its import time is measured.
+# Run from the repository root:
+#   python benchmarks/bench_startup.py --runs 5
+#   python benchmarks/bench_startup.py --scripts aisearchindexer.py --json startup.json
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# script -> (arguments, stdin, measure the first request)
+ENTRY_POINTS = {
+    "OpenAIwithOwnData.py": ([], "What is the project deadline?\n", True),
+    "aisearchindexer.py": (["--analyze-index"], "", True),
+    "largedocsummary.py": (["{pdf}", "--no-cache"], "", True),
+    "semantickernelwithaisearch.py": ([], "What is the project deadline?\nexit\n", True),
+    "filesearchagent.py": (["--gc", "--no-registry"], "", False),
+}
+
+
+class FirstRequestHandler(BaseHTTPRequestHandler):
+    def _answer(self):
+        self.server.first_request.set()
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        body = b"{}"
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except ConnectionError:
+            # the script was already stopped
+            pass
+
+    do_GET = do_POST = do_PUT = do_DELETE = _answer
+
+    def log_message(self, *args):
+        pass
+
+
+def benchmark_environment(url):
+    env = dict(os.environ)
+    env.update({
+        "AZURE_OPENAI_ENDPOINT": url,
+        "AZURE_OPENAI_KEY": "benchmark",
+        "AZURE_OPENAI_API_VERSION": "2024-02-01",
+        "AZURE_OPENAI_DEPLOYMENT": "benchmark",
+        "AZURE_OAI_DEPLOYMENT": "benchmark",
+        "AZURE_OPENAI_EMBEDDING_DEPLOYMENT_ID": "benchmark",
+        "AZURE_SEARCH_SERVICE_ENDPOINT": url,
+        "AZURE_SEARCH_ADMIN_KEY": "benchmark",
+        "AZURE_SEARCH_INDEX": "benchmark",
+        "AZURE_SEARCH_DATASOURCE": "benchmark",
+        "AZURE_SEARCH_SKILLSET": "benchmark",
+        "AZURE_SEARCH_INDEXER": "benchmark",
+        "AZURE_BLOB_CONTAINER": "benchmark",
+        "AZURE_BLOB_CONNECTION_STRING": f"DefaultEndpointsProtocol=http;AccountName=benchmark;AccountKey=YmVuY2htYXJr;BlobEndpoint={url}/benchmark;",
+        "AZURE_BLOB_ACCOUNT_URL": f"{url}/benchmark",
+        "AZURE_LANGUAGE_ENDPOINT": url,
+        "AZURE_LANGUAGE_KEY": "benchmark",
+        "PROJECT_CONNECTION_STRING": "127.0.0.1;00000000-0000-0000-0000-000000000000;benchmark;benchmark",
+        "PYTHONUNBUFFERED": "1",
+    })
+    return env
+
+
+def write_pdf(path, pages=3):
+    # A small text PDF, so largedocsummary.py has something to chunk before its first request
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in range(pages):
+        lines = " ".join(f"(Section {page}.{line}: the supplier shall deliver the benchmark services on time.) Tj T*"
+                         for line in range(40))
+        stream = zlib.compress(f"BT /F1 10 Tf 12 TL 40 760 Td {lines} ET".encode("latin-1"))
+        objects.append(f"<< /Length {len(stream)} /Filter /FlateDecode >>\nstream\n".encode("latin-1") + stream + b"\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {len(objects)} 0 R "
+                       f"/Resources << /Font << /F1 3 0 R >> >> >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(f"{number} 0 obj\n".encode("latin-1"))
+            f.write(body if isinstance(body, bytes) else body.encode("latin-1"))
+            f.write(b"\nendobj\n")
+        xref = f.tell()
+        f.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1"))
+        f.writelines(f"{offset:010d} 00000 n \n".encode("latin-1") for offset in offsets)
+        f.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1"))
+
+
+def import_time(script, env, cwd):
+    # Microseconds spent in top-level imports, and the three heaviest of them
+    result = subprocess.run([sys.executable, "-X", "importtime", os.path.join(ROOT, script), "--help"],
+                            env=env, cwd=cwd, capture_output=True, text=True)
+    top_level = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):
+            top_level.append((int(cumulative), name.strip()))
+    top_level.sort(reverse=True)
+    return sum(us for us, _ in top_level) / 1000, [(name, us / 1000) for us, name in top_level[:3]], result.returncode
+
+
+def help_time(script, env, cwd):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(ROOT, script), "--help"], env=env, cwd=cwd, capture_output=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def first_request_time(server, script, arguments, stdin, env, cwd, timeout):
+    server.first_request.clear()
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.join(ROOT, script), *arguments], env=env, cwd=cwd,
+                                   stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr)
+        process.stdin.write(stdin.encode("utf-8"))
+        process.stdin.close()
+        arrived = server.first_request.wait(timeout)
+        elapsed = (time.perf_counter() - start) * 1000
+        process.kill()
+        process.wait()
+        stderr.seek(0)
+        output = stderr.read()
+    if not arrived:
+        lines = output.decode("utf-8", "replace").strip().splitlines()
+        return None, lines[-1] if lines else f"no request within {timeout}s"
+    return elapsed, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure import time and time to first request of the entry-point scripts.")
+    parser.add_argument("--scripts", nargs="+", default=list(ENTRY_POINTS), choices=list(ENTRY_POINTS), help="scripts to measure")
+    parser.add_argument("--runs", type=int, default=3, help="runs per measurement; the median is reported")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the first request")
+    parser.add_argument("--json", default=None, help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FirstRequestHandler)
+    server.first_request = threading.Event()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    env = benchmark_environment(f"http://127.0.0.1:{server.server_port}")
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="bench-startup-") as cwd:
+        pdf = os.path.join(cwd, "benchmark.pdf")
+        write_pdf(pdf)
+        print(f"{'script':<32} {'imports ms':>10} {'--help ms':>10} {'1st request ms':>15}  heaviest imports")
+        for script in args.scripts:
+            arguments, stdin, measure_request = ENTRY_POINTS[script]
+            arguments = [argument.format(pdf=pdf) for argument in arguments]
+            imports = [import_time(script, env, cwd) for _ in range(args.runs)]
+            if any(returncode for _, _, returncode in imports):
+                print(f"{script:<32} could not be imported (missing packages?)")
+                results.append({"script": script, "error": "import failed"})
+                continue
+            import_ms = statistics.median(total for total, _, _ in imports)
+            help_ms = statistics.median(help_time(script, env, cwd) for _ in range(args.runs))
+            request_ms = error = None
+            if measure_request:
+                times = []
+                for _ in range(args.runs):
+                    elapsed, error = first_request_time(server, script, arguments, stdin, env, cwd, args.timeout)
+                    if elapsed is None:
+                        break
+                    times.append(elapsed)
+                request_ms = statistics.median(times) if times and error is None else None
+            heaviest = ", ".join(f"{name} {ms:.0f}" for name, ms in imports[0][1])
+            request = f"{request_ms:.0f}" if request_ms is not None else ("n/a" if error is None else "failed")
+            print(f"{script:<32} {import_ms:>10.0f} {help_ms:>10.0f} {request:>15}  {heaviest}")
+            if error:
+                print(f"    {error}")
+            results.append({"script": script, "import_ms": round(import_ms, 1), "help_ms": round(help_ms, 1),
+                            "first_request_ms": None if request_ms is None else round(request_ms, 1),
+                            "heaviest_imports": imports[0][1], "error": error})
+    server.shutdown()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
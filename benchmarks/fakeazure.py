@@ -0,0 +1,753 @@
+# Description: Local stand-ins for the Azure services the scripts call, for offline benchmarks.
+# One aiohttp application answers the Azure OpenAI chat completions (plain and streamed) and embeddings,
+# the Azure AI Search documents, index, data source, skillset and indexer operations, the Text Analytics
+# abstractive summarization jobs, the Blob Storage container and upload operations, the Azure AI Foundry
+# agents operations (files, vector stores, agents, threads, messages and runs) and an App Service style
+# managed identity token endpoint, so DefaultAzureCredential works against it.
+# State is kept in memory: uploaded documents can be searched, uploaded blobs are listed with their MD5, the
+# indexer and summarization jobs and agent runs finish after a configurable time.
+# When the request offers tools and the last message is the user's, the chat completion calls the first tool with the
+# question (plain or streamed), and answers once the tool results are sent back, so function calling is exercised too.
+# Every service can be given latency (latency_ms, jitter_ms), throttling (throttle_rate of requests answered
+# with 429 and a Retry-After of retry_after seconds, or every request above max_concurrency in flight) and
+# injected failures (error_rate of requests answered with 503). Requests are counted per operation and
+# status; GET /_fake/stats returns the counters and POST /_fake/reset clears them and the state.
+# The Search and agents SDKs only call https endpoints, so the server also listens with TLS on a second port,
+# using a self-signed certificate that clients trust through REQUESTS_CA_BUNDLE and SSL_CERT_FILE.
+# Run standalone and point the scripts at it with the printed environment variables:
+#   python benchmarks/fakeazure.py --port 8080 --tls-port 8443 --latency-ms 50 --set openai.max_concurrency=8
+# or start it from a benchmark with FakeAzure(config).start().
+
+import argparse
+import asyncio
+import base64
+import collections
+import datetime
+import hashlib
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import uuid
+from xml.sax.saxutils import escape
+
+import numpy as np
+from aiohttp import web
+
+SERVICES = ("openai", "search", "blob", "language", "agents", "identity")
+
+DEFAULT_CONFIG = {
+    "latency_ms": 20.0,
+    "jitter_ms": 0.0,
+    "throttle_rate": 0.0,
+    "retry_after": 1.0,
+    "error_rate": 0.0,
+    "max_concurrency": 0,
+    # service behaviour
+    "embedding_dimensions": 1536,
+    "stream_chunks": 8,
+    "job_seconds": 0.5,
+    "indexer_seconds": 1.0,
+    "indexer_documents": 10,
+    "vector_store_seconds": 0.5,
+    "run_seconds": 1.0,
+}
+
+AGENTS_PREFIX = r"/agents/v1\.0/subscriptions/[^/]+/resourceGroups/[^/]+/providers/Microsoft\.MachineLearningServices/workspaces/[^/]+"
+
+
+def parse_setting(text):
+    # "service.key=value" or "key=value" (all services)
+    name, _, value = text.partition("=")
+    service, _, key = name.rpartition(".")
+    if key not in DEFAULT_CONFIG:
+        raise ValueError(f"unknown setting {key}")
+    if service and service not in SERVICES:
+        raise ValueError(f"unknown service {service}")
+    return service or None, key, type(DEFAULT_CONFIG[key])(float(value))
+
+
+def build_config(defaults=None, settings=()):
+    # {"default": {...}, service: {overrides}}
+    config = {"default": dict(DEFAULT_CONFIG, **(defaults or {}))}
+    for setting in settings:
+        service, key, value = parse_setting(setting)
+        config.setdefault(service or "default", {})[key] = value
+    return config
+
+
+def now_iso():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def fake_embedding(text, dimensions):
+    seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def fake_summary(text, limit=200):
+    sentence = text.strip().split(". ")[0]
+    return sentence[:limit] or "Empty document."
+
+
+def self_signed_certificate(directory):
+    # Certificate and key for 127.0.0.1 and localhost; returns (certificate path, key path)
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+    import ipaddress
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "fakeazure")])
+    issued = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=5)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(issued)
+        .not_valid_after(issued + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName("localhost"), x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+        .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(key.public_key()), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path = os.path.join(directory, "fakeazure.pem")
+    key_path = os.path.join(directory, "fakeazure.key")
+    with open(cert_path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+def error_response(status, code, message, headers=None):
+    return web.json_response({"error": {"code": code, "message": message}}, status=status, headers=headers)
+
+
+class FakeAzure:
+    def __init__(self, config=None):
+        self.config = config or build_config()
+        self.routes = [
+            # Semantic Kernel addresses the deployment from the resource endpoint, without the /openai prefix
+            ("POST", r"(?:/openai)?/deployments/(?P<deployment>[^/]+)/chat/completions", "openai", "openai.chat", self.chat_completions),
+            ("POST", r"/openai/deployments/(?P<deployment>[^/]+)/embeddings", "openai", "openai.embeddings", self.embeddings),
+            ("POST", r"/indexes\('(?P<index>[^']+)'\)/docs/search\.post\.search", "search", "search.query", self.search_documents),
+            ("POST", r"/indexes\('(?P<index>[^']+)'\)/docs/search\.index", "search", "search.index_documents", self.index_documents),
+            ("PUT", r"/indexes\('(?P<index>[^']+)'\)", "search", "search.create_index", self.create_index),
+            ("PUT", r"/(?P<kind>datasources|skillsets)\('(?P<name>[^']+)'\)", "search", "search.create_resource", self.create_search_resource),
+            ("PUT", r"/indexers\('(?P<name>[^']+)'\)", "search", "search.create_indexer", self.create_search_resource),
+            ("POST", r"/indexers\('(?P<name>[^']+)'\)/search\.run", "search", "search.run_indexer", self.run_indexer),
+            ("GET", r"/indexers\('(?P<name>[^']+)'\)/search\.status", "search", "search.indexer_status", self.indexer_status),
+            ("POST", r"/language/analyze-text/jobs", "language", "language.submit_job", self.submit_job),
+            ("GET", r"/language/analyze-text/jobs/(?P<job>[^/]+)", "language", "language.job_status", self.job_status),
+            ("PUT", r"/blob/(?P<container>[^/]+)", "blob", "blob.create_container", self.create_container),
+            ("GET", r"/blob/(?P<container>[^/]+)", "blob", "blob.list_blobs", self.list_blobs),
+            ("PUT", r"/blob/(?P<container>[^/]+)/(?P<blob>.+)", "blob", "blob.put", self.put_blob),
+            ("GET", r"/identity/token", "identity", "identity.token", self.identity_token),
+            ("POST", AGENTS_PREFIX + r"/files", "agents", "agents.upload_file", self.upload_file),
+            ("POST", AGENTS_PREFIX + r"/vector_stores", "agents", "agents.create_vector_store", self.create_vector_store),
+            ("POST", AGENTS_PREFIX + r"/assistants", "agents", "agents.create_agent", self.create_agent),
+            ("POST", AGENTS_PREFIX + r"/threads", "agents", "agents.create_thread", self.create_thread),
+            ("POST", AGENTS_PREFIX + r"/threads/(?P<thread>[^/]+)/messages", "agents", "agents.create_message", self.create_message),
+            ("GET", AGENTS_PREFIX + r"/threads/(?P<thread>[^/]+)/messages", "agents", "agents.list_messages", self.list_messages),
+            ("POST", AGENTS_PREFIX + r"/threads/(?P<thread>[^/]+)/runs", "agents", "agents.create_run", self.create_run),
+            ("GET", AGENTS_PREFIX + r"/threads/(?P<thread>[^/]+)/runs/(?P<run>[^/]+)", "agents", "agents.get_run", self.get_run),
+            ("GET", AGENTS_PREFIX + r"/(?P<kind>files|vector_stores|assistants|threads)/(?P<id>[^/]+)", "agents", "agents.get", self.get_agents_resource),
+            ("DELETE", AGENTS_PREFIX + r"/(?P<kind>files|vector_stores|assistants|threads)/(?P<id>[^/]+)", "agents", "agents.delete", self.delete_agents_resource),
+        ]
+        self.routes = [(method, re.compile(pattern + "$"), service, operation, handler)
+                       for method, pattern, service, operation, handler in self.routes]
+        self._random = random.Random(0)
+        self._thread = None
+        self._loop = None
+        self._runner = None
+        self.reset()
+
+    def reset(self):
+        self.requests = collections.Counter()
+        self.statuses = collections.Counter()
+        self.injected = collections.Counter()
+        self.in_flight = collections.Counter()
+        self.peak_in_flight = collections.Counter()
+        self.indexes = {}
+        self.indexers = {}
+        self.search_resources = {}
+        self.jobs = {}
+        self.containers = {}
+        self.blocks = collections.defaultdict(dict)
+        self.agents = {"files": {}, "vector_stores": {}, "assistants": {}, "threads": {}}
+        self.messages = collections.defaultdict(list)
+        self.runs = {}
+
+    def stats(self):
+        return {
+            "requests": dict(sorted(self.requests.items())),
+            "statuses": dict(sorted(self.statuses.items())),
+            "injected": dict(sorted(self.injected.items())),
+            "peak_in_flight": dict(sorted(self.peak_in_flight.items())),
+        }
+
+    def setting(self, service, key):
+        return self.config.get(service, {}).get(key, self.config["default"][key])
+
+    # Dispatch and fault injection
+
+    async def dispatch(self, request):
+        if request.path == "/_fake/stats":
+            return web.json_response(self.stats())
+        if request.path == "/_fake/reset" and request.method == "POST":
+            self.reset()
+            return web.json_response({})
+        for method, pattern, service, operation, handler in self.routes:
+            match = pattern.match(request.path)
+            if match and method == request.method:
+                break
+        else:
+            self.requests["unknown"] += 1
+            self.statuses["404"] += 1
+            return error_response(404, "NotFound", f"{request.method} {request.path} is not implemented by the fake")
+
+        self.requests[operation] += 1
+        self.in_flight[service] += 1
+        self.peak_in_flight[service] = max(self.peak_in_flight[service], self.in_flight[service])
+        try:
+            response = self.inject_fault(service, operation)
+            if response is None:
+                latency = self.setting(service, "latency_ms") + self._random.uniform(0, self.setting(service, "jitter_ms"))
+                if latency > 0:
+                    await asyncio.sleep(latency / 1000)
+                response = await handler(request, **match.groupdict())
+        finally:
+            self.in_flight[service] -= 1
+        self.statuses[str(response.status)] += 1
+        return response
+
+    def inject_fault(self, service, operation):
+        max_concurrency = self.setting(service, "max_concurrency")
+        throttled = max_concurrency and self.in_flight[service] > max_concurrency
+        if throttled or self._random.random() < self.setting(service, "throttle_rate"):
+            self.injected[f"{operation}.429"] += 1
+            retry_after = self.setting(service, "retry_after")
+            headers = {"Retry-After": str(max(1, round(retry_after))), "retry-after-ms": str(int(retry_after * 1000)),
+                       "x-ms-error-code": "TooManyRequests"}
+            return error_response(429, "429", f"Rate limit is exceeded. Try again in {retry_after:g} seconds.", headers)
+        if self._random.random() < self.setting(service, "error_rate"):
+            self.injected[f"{operation}.503"] += 1
+            return error_response(503, "ServiceUnavailable", "Injected failure.")
+        return None
+
+    # Azure OpenAI
+
+    async def chat_completions(self, request, deployment):
+        body = await request.json()
+        question = next((m["content"] for m in reversed(body["messages"]) if m["role"] == "user"), "")
+        answer = f"Benchmark answer to: {question[:120]}"
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in body["messages"]) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(answer) // 4,
+                 "total_tokens": prompt_tokens + len(answer) // 4}
+        context = None
+        if body.get("data_sources"):
+            context = {"citations": [{"content": "Benchmark passage.", "title": "benchmark.pdf", "url": None,
+                                      "filepath": "benchmark.pdf", "chunk_id": "0"}], "intent": "[]"}
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        if body.get("tools") and body["messages"][-1]["role"] == "user":
+            return await self.chat_tool_call(request, body, deployment, completion_id, question, usage)
+        if not body.get("stream"):
+            message = {"role": "assistant", "content": answer}
+            if context:
+                message["context"] = context
+            return web.json_response({
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": deployment,
+                "choices": [{"index": 0, "finish_reason": "stop", "message": message}], "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        pieces = self.setting("openai", "stream_chunks")
+        size = max(1, -(-len(answer) // pieces))
+        delay = self.setting("openai", "latency_ms") / 1000 / pieces
+        for start in range(0, len(answer), size):
+            delta = {"content": answer[start:start + size]}
+            if start == 0:
+                delta["role"] = "assistant"
+                if context:
+                    delta["context"] = context
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": deployment,
+                     "choices": [{"index": 0, "finish_reason": None, "delta": delta}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            if delay:
+                await asyncio.sleep(delay)
+        final = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": deployment,
+                 "choices": [{"index": 0, "finish_reason": "stop", "delta": {}}]}
+        await response.write(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+        # Like the service, usage is only streamed when asked for, in a last chunk without choices
+        if (body.get("stream_options") or {}).get("include_usage"):
+            final = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": deployment,
+                     "choices": [], "usage": usage}
+            await response.write(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def chat_tool_call(self, request, body, deployment, completion_id, question, usage):
+        function = body["tools"][0]["function"]
+        # The question goes into the first parameter; the other required ones get a value of their type
+        parameters = function.get("parameters", {})
+        properties = parameters.get("properties", {}) or {"query": {"type": "string"}}
+        first = next(iter(properties))
+        values = {"integer": 3, "number": 3, "boolean": True, "array": [], "object": {}}
+        arguments = {name: question[:120] if name == first else values.get(properties[name].get("type"), question[:120])
+                     for name in properties if name == first or name in parameters.get("required", ())}
+        call = {"id": f"call_{uuid.uuid4().hex[:12]}", "type": "function",
+                "function": {"name": function["name"], "arguments": json.dumps(arguments)}}
+        if not body.get("stream"):
+            return web.json_response({
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": deployment,
+                "choices": [{"index": 0, "finish_reason": "tool_calls",
+                             "message": {"role": "assistant", "content": None, "tool_calls": [call]}}],
+                "usage": usage,
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        arguments = call["function"]["arguments"]
+        half = len(arguments) // 2
+        deltas = [
+            {"role": "assistant", "content": None, "tool_calls": [
+                {"index": 0, "id": call["id"], "type": "function", "function": {"name": function["name"], "arguments": arguments[:half]}}]},
+            {"tool_calls": [{"index": 0, "function": {"arguments": arguments[half:]}}]},
+        ]
+        for number, delta in enumerate(deltas):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": deployment,
+                     "choices": [{"index": 0, "finish_reason": "tool_calls" if number == len(deltas) - 1 else None, "delta": delta}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def embeddings(self, request, deployment):
+        body = await request.json()
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        dimensions = body.get("dimensions") or self.setting("openai", "embedding_dimensions")
+        data = []
+        for index, text in enumerate(texts):
+            vector = fake_embedding(str(text), dimensions)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.astype("<f4").tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+        tokens = sum(len(str(text)) for text in texts) // 4
+        return web.json_response({"object": "list", "data": data, "model": deployment,
+                                  "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+    # Azure AI Search
+
+    def index_state(self, name):
+        return self.indexes.setdefault(name, {"definition": None, "key": "chunk_id", "documents": {}})
+
+    async def create_index(self, request, index):
+        definition = await request.json()
+        state = self.index_state(index)
+        state["definition"] = definition
+        state["key"] = next((field["name"] for field in definition.get("fields", []) if field.get("key")), "chunk_id")
+        return web.json_response(dict(definition, **{"@odata.etag": f'"{uuid.uuid4().hex}"'}), status=201)
+
+    async def index_documents(self, request, index):
+        body = await request.json()
+        state = self.index_state(index)
+        results = []
+        for document in body["value"]:
+            action = document.pop("@search.action", "upload")
+            key = document.get(state["key"])
+            if action == "delete":
+                state["documents"].pop(key, None)
+            elif action in ("merge", "mergeOrUpload"):
+                state["documents"].setdefault(key, {}).update(document)
+            else:
+                state["documents"][key] = document
+            results.append({"key": key, "status": True, "errorMessage": None, "statusCode": 200 if action != "upload" else 201})
+        return web.json_response({"value": results})
+
+    async def search_documents(self, request, index):
+        body = await request.json()
+        documents = list(self.index_state(index)["documents"].values())
+        text = (body.get("search") or "*").lower()
+        if text != "*":
+            words = set(text.split())
+            documents = [d for d in documents if words & set(str(d.get("chunk", "")).lower().split())] or documents
+        top = body.get("top") or 50
+        select = [field.strip() for field in body["select"].split(",")] if body.get("select") else None
+        value = []
+        for rank, document in enumerate(documents[:top]):
+            result = {key: document.get(key) for key in select} if select else dict(document)
+            result["@search.score"] = 1.0 / (rank + 1)
+            value.append(result)
+        return web.json_response({"value": value})
+
+    async def create_search_resource(self, request, name, kind="indexers"):
+        definition = await request.json()
+        self.search_resources[(kind, name)] = definition
+        return web.json_response(dict(definition, **{"@odata.etag": f'"{uuid.uuid4().hex}"'}), status=201)
+
+    async def run_indexer(self, request, name):
+        self.indexers.setdefault(name, []).append(time.monotonic())
+        return web.Response(status=202)
+
+    async def indexer_status(self, request, name):
+        runs = self.indexers.get(name, [])
+        history = []
+        for started in reversed(runs):
+            elapsed = time.monotonic() - started
+            duration = self.setting("search", "indexer_seconds")
+            total = int(self.setting("search", "indexer_documents"))
+            done = elapsed >= duration
+            start_time = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=elapsed)
+            history.append({
+                "status": "success" if done else "inProgress",
+                "errorMessage": None,
+                "startTime": start_time.isoformat().replace("+00:00", "Z"),
+                "endTime": (start_time + datetime.timedelta(seconds=duration)).isoformat().replace("+00:00", "Z") if done else None,
+                "itemsProcessed": total if done else int(total * elapsed / duration),
+                "itemsFailed": 0,
+                "errors": [],
+                "warnings": [],
+            })
+        return web.json_response({
+            "status": "running",
+            "lastResult": history[0] if history else None,
+            "executionHistory": history,
+            "limits": {"maxRunTime": "PT2H", "maxDocumentExtractionSize": 16777216, "maxDocumentContentCharactersToExtract": 4000000},
+        })
+
+    # Text Analytics
+
+    async def submit_job(self, request):
+        body = await request.json()
+        job_id = str(uuid.uuid4())
+        self.jobs[job_id] = {"created": time.monotonic(), "created_at": now_iso(), "body": body}
+        location = f"{request.scheme}://{request.host}/language/analyze-text/jobs/{job_id}?api-version={request.query.get('api-version', '2023-04-01')}"
+        return web.Response(status=202, headers={"Operation-Location": location, "retry-after-ms": "100"})
+
+    async def job_status(self, request, job):
+        state = self.jobs.get(job)
+        if state is None:
+            return error_response(404, "NotFound", f"job {job} not found")
+        done = time.monotonic() - state["created"] >= self.setting("language", "job_seconds")
+        body = state["body"]
+        items = []
+        if done:
+            for task in body.get("tasks", []):
+                documents = [{"id": document["id"], "summaries": [{"text": fake_summary(document["text"]), "contexts": []}],
+                              "warnings": []} for document in body["analysisInput"]["documents"]]
+                items.append({"kind": "AbstractiveSummarizationLROResults", "taskName": task.get("taskName"),
+                              "lastUpdateDateTime": now_iso(), "status": "succeeded",
+                              "results": {"documents": documents, "errors": [], "modelVersion": "2023-05-15"}})
+        tasks = len(body.get("tasks", []))
+        return web.json_response({
+            "jobId": job,
+            "createdDateTime": state["created_at"],
+            "lastUpdatedDateTime": now_iso(),
+            "status": "succeeded" if done else "running",
+            "errors": [],
+            "tasks": {"completed": tasks if done else 0, "failed": 0, "inProgress": 0 if done else tasks, "total": tasks, "items": items},
+        }, headers={"retry-after-ms": "100"})
+
+    # Blob Storage
+
+    async def create_container(self, request, container):
+        if container in self.containers:
+            return web.Response(status=409, headers={"x-ms-error-code": "ContainerAlreadyExists"})
+        self.containers[container] = {}
+        return web.Response(status=201, headers={"ETag": f'"{uuid.uuid4().hex}"', "Last-Modified": self.http_date()})
+
+    async def list_blobs(self, request, container):
+        blobs = "".join(
+            f"<Blob><Name>{escape(name)}</Name><Properties><Last-Modified>{blob['modified']}</Last-Modified>"
+            f"<Etag>{blob['etag']}</Etag><Content-Length>{blob['size']}</Content-Length>"
+            f"<Content-Type>{escape(blob['content_type'])}</Content-Type>"
+            + (f"<Content-MD5>{blob['md5']}</Content-MD5>" if blob["md5"] else "")
+            + "<BlobType>BlockBlob</BlobType></Properties></Blob>"
+            for name, blob in sorted(self.containers.get(container, {}).items())
+        )
+        xml = (f'<?xml version="1.0" encoding="utf-8"?><EnumerationResults ServiceEndpoint="{request.scheme}://{request.host}/blob/" '
+               f'ContainerName="{escape(container)}"><Blobs>{blobs}</Blobs><NextMarker /></EnumerationResults>')
+        return web.Response(text=xml, content_type="application/xml")
+
+    async def put_blob(self, request, container, blob):
+        data = await request.read()
+        blobs = self.containers.setdefault(container, {})
+        comp = request.query.get("comp")
+        if comp == "block":
+            self.blocks[(container, blob)][request.query["blockid"]] = len(data)
+            return web.Response(status=201)
+        if comp == "blocklist":
+            size = sum(self.blocks.pop((container, blob), {}).values())
+        else:
+            size = len(data)
+        etag = f'"{uuid.uuid4().hex}"'
+        blobs[blob] = {
+            "size": size,
+            "md5": request.headers.get("x-ms-blob-content-md5"),
+            "content_type": request.headers.get("x-ms-blob-content-type", "application/octet-stream"),
+            "etag": etag,
+            "modified": self.http_date(),
+        }
+        headers = {"ETag": etag, "Last-Modified": self.http_date(), "x-ms-request-server-encrypted": "true"}
+        if comp is None:
+            headers["Content-MD5"] = base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+        return web.Response(status=201, headers=headers)
+
+    @staticmethod
+    def http_date():
+        return datetime.datetime.now(datetime.timezone.utc).strftime("%a, %d %b %Y %H:%M:%S GMT")
+
+    # Managed identity
+
+    async def identity_token(self, request):
+        return web.json_response({"access_token": "fake-token", "expires_on": str(int(time.time()) + 3600),
+                                  "resource": request.query.get("resource"), "token_type": "Bearer"})
+
+    # Azure AI Foundry agents
+
+    def new_id(self, prefix):
+        return f"{prefix}_{uuid.uuid4().hex[:24]}"
+
+    async def upload_file(self, request):
+        size = 0
+        filename = None
+        purpose = None
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name == "file":
+                filename = part.filename
+                size += len(await part.read())
+            elif part.name == "purpose":
+                purpose = await part.text()
+        file = {"id": self.new_id("assistant-file"), "object": "file", "bytes": size, "filename": filename,
+                "purpose": purpose, "created_at": int(time.time()), "status": "processed"}
+        self.agents["files"][file["id"]] = file
+        return web.json_response(file)
+
+    def vector_store_view(self, store):
+        done = time.monotonic() - store["created"] >= self.setting("agents", "vector_store_seconds")
+        count = len(store["file_ids"])
+        return dict(store["body"], status="completed" if done else "in_progress",
+                    file_counts={"in_progress": 0 if done else count, "completed": count if done else 0,
+                                 "failed": 0, "cancelled": 0, "total": count})
+
+    async def create_vector_store(self, request):
+        body = await request.json()
+        store_id = self.new_id("vs")
+        self.agents["vector_stores"][store_id] = {
+            "created": time.monotonic(),
+            "file_ids": body.get("file_ids") or [],
+            "body": {"id": store_id, "object": "vector_store", "name": body.get("name"), "created_at": int(time.time()),
+                     "usage_bytes": 0, "metadata": body.get("metadata") or {}, "expires_after": body.get("expires_after"),
+                     "last_active_at": int(time.time())},
+        }
+        return web.json_response(self.vector_store_view(self.agents["vector_stores"][store_id]))
+
+    async def create_agent(self, request):
+        body = await request.json()
+        agent = dict(body, id=self.new_id("asst"), object="assistant", created_at=int(time.time()),
+                     tool_resources=body.get("tool_resources") or {}, metadata=body.get("metadata") or {})
+        self.agents["assistants"][agent["id"]] = agent
+        return web.json_response(agent)
+
+    async def create_thread(self, request):
+        body = await request.json() if request.can_read_body else {}
+        thread = {"id": self.new_id("thread"), "object": "thread", "created_at": int(time.time()),
+                  "tool_resources": body.get("tool_resources") or {}, "metadata": body.get("metadata") or {}}
+        self.agents["threads"][thread["id"]] = thread
+        return web.json_response(thread)
+
+    def message(self, thread, role, text, run_id=None, assistant_id=None):
+        return {"id": self.new_id("msg"), "object": "thread.message", "created_at": int(time.time()), "thread_id": thread,
+                "role": role, "status": "completed", "content": [{"type": "text", "text": {"value": text, "annotations": []}}],
+                "assistant_id": assistant_id, "run_id": run_id, "attachments": [], "metadata": {}}
+
+    async def create_message(self, request, thread):
+        if thread not in self.agents["threads"]:
+            return error_response(404, "NotFound", f"thread {thread} not found")
+        body = await request.json()
+        message = self.message(thread, body.get("role", "user"), body.get("content", ""))
+        self.messages[thread].append(message)
+        return web.json_response(message)
+
+    async def list_messages(self, request, thread):
+        # newest first, as the service returns them by default
+        data = list(reversed(self.messages.get(thread, [])))
+        return web.json_response({"object": "list", "data": data, "first_id": data[0]["id"] if data else None,
+                                  "last_id": data[-1]["id"] if data else None, "has_more": False})
+
+    def run_view(self, run):
+        done = time.monotonic() - run["created"] >= self.setting("agents", "run_seconds")
+        view = dict(run["body"], status="completed" if done else "in_progress")
+        if done:
+            view["completed_at"] = int(time.time())
+            view["usage"] = {"prompt_tokens": 1200, "completion_tokens": 300, "total_tokens": 1500}
+            if not run["answered"]:
+                run["answered"] = True
+                summary = json.dumps({"Requestor": "Benchmark", "Project Title": "Benchmark RFP", "Summary": "Benchmark summary."})
+                self.messages[run["body"]["thread_id"]].append(
+                    self.message(run["body"]["thread_id"], "assistant", summary, run["body"]["id"], run["body"]["assistant_id"]))
+        return view
+
+    async def create_run(self, request, thread):
+        if thread not in self.agents["threads"]:
+            return error_response(404, "NotFound", f"thread {thread} not found")
+        body = await request.json()
+        run_id = self.new_id("run")
+        self.runs[run_id] = {"created": time.monotonic(), "answered": False, "body": {
+            "id": run_id, "object": "thread.run", "thread_id": thread, "assistant_id": body.get("assistant_id"),
+            "created_at": int(time.time()), "model": "benchmark", "instructions": "", "tools": [], "metadata": {},
+            "last_error": None, "required_action": None, "tool_resources": {},
+        }}
+        return web.json_response(self.run_view(self.runs[run_id]))
+
+    async def get_run(self, request, thread, run):
+        if run not in self.runs:
+            return error_response(404, "NotFound", f"run {run} not found")
+        return web.json_response(self.run_view(self.runs[run]))
+
+    async def get_agents_resource(self, request, kind, id):
+        resource = self.agents[kind].get(id)
+        if resource is None:
+            return error_response(404, "NotFound", f"{kind} {id} not found")
+        if kind == "vector_stores":
+            resource = self.vector_store_view(resource)
+        return web.json_response(resource)
+
+    async def delete_agents_resource(self, request, kind, id):
+        if self.agents[kind].pop(id, None) is None:
+            return error_response(404, "NotFound", f"{kind} {id} not found")
+        objects = {"files": "file", "vector_stores": "vector_store.deleted", "assistants": "assistant.deleted", "threads": "thread.deleted"}
+        return web.json_response({"id": id, "object": objects[kind], "deleted": True})
+
+    # Serving
+
+    def application(self):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_route("*", "/{tail:.*}", self.dispatch)
+        return app
+
+    async def serve(self, host, port, tls_port, certificate):
+        # Returns the bound http and https ports
+        import ssl
+
+        self._runner = web.AppRunner(self.application(), access_log=None)
+        await self._runner.setup()
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*certificate)
+        ports = []
+        for site in (web.TCPSite(self._runner, host, port), web.TCPSite(self._runner, host, tls_port, ssl_context=context)):
+            await site.start()
+            ports.append(site._server.sockets[0].getsockname()[1])
+        return ports
+
+    def start(self, host="127.0.0.1", port=0, tls_port=0, directory=None):
+        # Serve on a background thread; returns the http URL, the https URL and the certificate path
+        certificate = self_signed_certificate(directory or tempfile.mkdtemp(prefix="fakeazure-"))
+        started = threading.Event()
+        result = {}
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            result["ports"] = self._loop.run_until_complete(self.serve(host, port, tls_port, certificate))
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="fakeazure", daemon=True)
+        self._thread.start()
+        started.wait()
+        http_port, https_port = result["ports"]
+        return f"http://{host}:{http_port}", f"https://{host}:{https_port}", certificate[0]
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+
+def client_environment(url, https_url, certificate):
+    # Environment variables pointing every script at the fake services
+    env = {
+        "AZURE_OPENAI_ENDPOINT": url,
+        "AZURE_OPENAI_KEY": "fake",
+        "AZURE_OPENAI_API_VERSION": "2024-02-01",
+        "AZURE_OPENAI_DEPLOYMENT": "benchmark",
+        "AZURE_OAI_DEPLOYMENT": "benchmark",
+        "AZURE_OPENAI_EMBEDDING_DEPLOYMENT_ID": "embedding",
+        "AZURE_SEARCH_SERVICE_ENDPOINT": https_url,
+        "AZURE_SEARCH_ADMIN_KEY": "fake",
+        "AZURE_SEARCH_INDEX": "benchmark-index",
+        "AZURE_SEARCH_DATASOURCE": "benchmark-datasource",
+        "AZURE_SEARCH_SKILLSET": "benchmark-skillset",
+        "AZURE_SEARCH_INDEXER": "benchmark-indexer",
+        "AZURE_BLOB_CONTAINER": "benchmark",
+        "AZURE_BLOB_CONNECTION_STRING": f"DefaultEndpointsProtocol=http;AccountName=fake;AccountKey=ZmFrZQ==;BlobEndpoint={url}/blob;",
+        "AZURE_BLOB_ACCOUNT_URL": f"{url}/blob",
+        "AZURE_LANGUAGE_ENDPOINT": url,
+        "AZURE_LANGUAGE_KEY": "fake",
+        "PROJECT_CONNECTION_STRING": f"{https_url.split('://', 1)[1]};00000000-0000-0000-0000-000000000000;benchmark;benchmark",
+        "MODEL_DEPLOYMENT_NAME": "benchmark",
+        # DefaultAzureCredential picks up an App Service style managed identity
+        "IDENTITY_ENDPOINT": f"{url}/identity/token",
+        "IDENTITY_HEADER": "fake",
+        # requests reads REQUESTS_CA_BUNDLE, the ssl module (aiohttp) SSL_CERT_FILE
+        "REQUESTS_CA_BUNDLE": certificate,
+        "SSL_CERT_FILE": certificate,
+    }
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve local stand-ins for the Azure services used by the scripts.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080, help="http port")
+    parser.add_argument("--tls-port", type=int, default=8443, help="https port, used by the Search and agents clients")
+    parser.add_argument("--latency-ms", type=float, default=DEFAULT_CONFIG["latency_ms"], help="added to every request")
+    parser.add_argument("--jitter-ms", type=float, default=DEFAULT_CONFIG["jitter_ms"], help="random extra latency up to this")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=DEFAULT_CONFIG["retry_after"], help="seconds sent in Retry-After")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="requests in flight per service above which 429 is returned")
+    parser.add_argument("--set", action="append", default=[], metavar="[SERVICE.]KEY=VALUE",
+                        help=f"override a setting, e.g. openai.max_concurrency=8; settings: {', '.join(DEFAULT_CONFIG)}")
+    args = parser.parse_args()
+
+    config = build_config({"latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "throttle_rate": args.throttle_rate,
+                           "retry_after": args.retry_after, "error_rate": args.error_rate,
+                           "max_concurrency": args.max_concurrency}, args.set)
+    fake = FakeAzure(config)
+    certificate = self_signed_certificate(tempfile.mkdtemp(prefix="fakeazure-"))
+
+    async def run():
+        ports = await fake.serve(args.host, args.port, args.tls_port, certificate)
+        url = f"http://{args.host}:{ports[0]}"
+        https_url = f"https://{args.host}:{ports[1]}"
+        for name, value in client_environment(url, https_url, certificate[0]).items():
+            print(f"export {name}='{value}'")
+        print(f"# serving on {url} and {https_url}; Ctrl+C to stop", flush=True)
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
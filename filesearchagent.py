@@ -3,40 +3,55 @@
 # The agent will use a File Search Tool to search for the RFP file in the knowledge store.
 # The agent will generate a summary of the RFP based on the template provided in the instructions.
 # The agent will create a thread, send a message to generate the summary, and create a run to process the message.
-# The agent will delete the vector store and the agent after processing the message.
-# The script will print the text messages from the agent in the thread.
+# The agent will delete the thread after processing the message; the vector store and the agent are kept for reuse (see below).
+# The script prints the outcome of every RFP as it completes and a duration and token summary at the end.
+# The source can be a single RFP file or a folder of RFPs: every file in the folder is one RFP, and every subfolder is one
+# RFP made of all the files in it. RFPs are processed concurrently (--workers at a time) with one shared agent definition:
+# the files are uploaded on a thread pool, each RFP gets its own vector store created with all its files in one call, and
+# the RFP's thread is bound to that vector store so file search only sees that RFP.
+# Every summary is written to a JSONL file together with the upload, vector store and run durations and the run's token usage.
+# Uploaded files, vector stores and the agent are recorded in a local registry keyed by content hashes (lib/agentregistry.py),
+# so a later run over an RFP that was already indexed reuses them and goes straight to creating the thread. Registered
+# resources unused for --max-age-days are deleted at the start of the next run (or with --gc); --no-registry creates and
+# deletes everything within the run.
+# The project client comes from lib/clients.py and goes through the adaptive rate limiter in lib/ratelimit.py.
+# Progress is logged on stderr (--log-level). With --trace every RFP is a trace of its file uploads, vector store, agent run
+# (with its token usage) and HTTP requests (lib/tracing.py), and the time spent in each stage is logged at the end.
 
 
+import argparse
+import json
+import logging
 import os
-from azure.ai.projects import AIProjectClient
-from azure.ai.projects.models import FileSearchTool, MessageAttachment, FilePurpose
-from azure.identity import DefaultAzureCredential
-import dotenv
-
-dotenv.load_dotenv()
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# Create an Azure AI Client from a connection string, copied from your Azure AI Foundry project.
-# At the moment, it should be in the format "<HostName>;<AzureSubscriptionId>;<ResourceGroup>;<ProjectName>"
-# Customer needs to login to Azure subscription via Azure CLI and set the environment variables
+from functools import partial
 
-credential = DefaultAzureCredential()
-project_client = AIProjectClient.from_connection_string(
-    credential=credential, conn_str=os.environ["PROJECT_CONNECTION_STRING"] 
+from azure.ai.projects.models import (
+    FilePurpose,
+    FileSearchTool,
+    FileSearchToolResource,
+    MessageRole,
+    ToolResources,
+    VectorStoreExpirationPolicy,
+    VectorStoreExpirationPolicyAnchor,
 )
+from azure.core.exceptions import ResourceNotFoundError
+import dotenv
 
-# We will upload the local file and will use it for vector store creation.
+from lib.agentregistry import DEFAULT_REGISTRY_PATH, AgentRegistry, resource_key
+from lib.hashing import file_hash
+from lib import clients
+from lib.stats import format_latency_summary, latency_summary
+from lib import tracing
 
-#upload a file
-file_path = 'ENTER PATH TO FILE'
-file = project_client.agents.upload_file_and_poll(file_path=file_path, purpose=FilePurpose.AGENTS)
-print(f"Uploaded file, file ID: {file.id}")
+dotenv.load_dotenv()
 
-# create a vector store with the file you uploaded
-vector_store = project_client.agents.create_vector_store_and_poll(file_ids=[file.id], name="my_vectorstore")
-print(f"Created vector store, vector store ID: {vector_store.id}")
+logger = logging.getLogger(__name__)
 
-# create a file search tool
-file_search_tool = FileSearchTool(vector_store_ids=[vector_store.id])
+model = os.environ.get("MODEL_DEPLOYMENT_NAME", "gpt-4o")
 
 agent_instruction='''
 Summarize the Request For Proposal (RFP) in the knowledge store based on this template:
@@ -64,36 +79,278 @@ Please extract the relevant information from the RFP and fill in the template. D
 Do not use non-ascii characters.
 '''
 
-# notices that FileSearchTool as tool and tool_resources must be added or the agent will be unable to search the file
-agent = project_client.agents.create_agent(
-    model="gpt-4o",
-    name="my-summarizer-agent",
-    instructions=agent_instruction,
-    tools=file_search_tool.definitions,
-    tool_resources=file_search_tool.resources,
-)
-print(f"Created agent, agent ID: {agent.id}")
 
-# Create a thread
-thread = project_client.agents.create_thread()
-print(f"Created thread, thread ID: {thread.id}")
+def find_rfps(source):
+    # Returns (name, [file paths]) for every RFP in source
+    if os.path.isfile(source):
+        return [(os.path.basename(source), [source])]
+    rfps = []
+    for entry in sorted(os.listdir(source)):
+        path = os.path.join(source, entry)
+        if os.path.isfile(path):
+            rfps.append((entry, [path]))
+        elif os.path.isdir(path):
+            files = [os.path.join(path, name) for name in sorted(os.listdir(path))
+                     if os.path.isfile(os.path.join(path, name))]
+            if files:
+                rfps.append((entry, files))
+    return rfps
 
 
-message = project_client.agents.create_message(
-    thread_id=thread.id, role="user", content="Generate summary"
-)
-print(f"Created message, message ID: {message.id}")
+def resource_is_live(project_client, kind, resource_id):
+    # Used by the registry before reusing an ID; vector stores must also still be usable
+    try:
+        if kind == "file":
+            project_client.agents.get_file(resource_id)
+        elif kind == "vector_store":
+            return project_client.agents.get_vector_store(resource_id).status == "completed"
+        else:
+            project_client.agents.get_agent(resource_id)
+    except ResourceNotFoundError:
+        return False
+    return True
+
+
+def delete_resource(project_client, kind, resource_id):
+    try:
+        if kind == "file":
+            project_client.agents.delete_file(resource_id)
+        elif kind == "vector_store":
+            project_client.agents.delete_vector_store(resource_id)
+        else:
+            project_client.agents.delete_agent(resource_id)
+    except ResourceNotFoundError:
+        pass
+
+
+def create_summary_agent(project_client, registry=None):
+    # One agent for every RFP: the file search tool is declared here and each thread brings its own vector store.
+    # Returns the agent ID and whether it came from the registry.
+    key = resource_key(model, agent_instruction, "file_search")
+    if registry is not None:
+        agent_id = registry.get("agent", key, partial(resource_is_live, project_client))
+        if agent_id:
+            logger.info("Reusing agent, agent ID: %s", agent_id)
+            return agent_id, True
+    file_search_tool = FileSearchTool()
+    agent = project_client.agents.create_agent(
+        model=model,
+        name="my-summarizer-agent",
+        instructions=agent_instruction,
+        tools=file_search_tool.definitions,
+    )
+    logger.info("Created agent, agent ID: %s", agent.id)
+    if registry is not None:
+        registry.put("agent", key, agent.id, agent.name)
+    return agent.id, False
+
+
+def upload_rfp_file(project_client, registry, path, digest):
+    # Returns the file ID and whether a registered upload of the same content was reused
+    if registry is not None:
+        file_id = registry.get("file", digest, partial(resource_is_live, project_client))
+        if file_id:
+            return file_id, True
+    with tracing.span("agent.upload", file=os.path.basename(path)) as upload_span:
+        upload_span.add(bytes=os.path.getsize(path))
+        file = project_client.agents.upload_file_and_poll(file_path=path, purpose=FilePurpose.AGENTS)
+    if registry is not None:
+        registry.put("file", digest, file.id, os.path.basename(path))
+    return file.id, False
+
+
+def create_rfp_vector_store(project_client, registry, name, file_ids, key):
+    # create a vector store with all the files of the RFP in one call; registered stores also expire on the
+    # service once unused for as long as the registry keeps them, in case gc never runs
+    expires_after = None
+    if registry is not None:
+        days = max(1, int(registry.max_age_seconds // (24 * 60 * 60)))
+        expires_after = VectorStoreExpirationPolicy(anchor=VectorStoreExpirationPolicyAnchor.LAST_ACTIVE_AT, days=days)
+    with tracing.span("agent.vector_store", files=len(file_ids)):
+        vector_store = project_client.agents.create_vector_store_and_poll(
+            file_ids=file_ids, name=f"rfp-{name}", expires_after=expires_after
+        )
+    if registry is not None:
+        registry.put("vector_store", key, vector_store.id, vector_store.name)
+    return vector_store.id
+
+
+def parse_summary(text):
+    # The agent is asked for JSON; keep the raw text when it is not valid JSON
+    try:
+        return json.loads(text)
+    except (TypeError, ValueError):
+        return text
+
+
+def summarize_rfp(project_client, agent_id, upload_executor, name, file_paths, registry=None):
+    # One trace per RFP
+    with tracing.span("rfp", rfp=name, files=len(file_paths)) as rfp_span:
+        record = _summarize_rfp(project_client, agent_id, upload_executor, name, file_paths, registry)
+        if "error" in record:
+            rfp_span.fail(record["error"])
+        return record
+
+
+def _summarize_rfp(project_client, agent_id, upload_executor, name, file_paths, registry):
+    record = {"rfp": name, "files": file_paths}
+    file_ids = []
+    vector_store_id = None
+    thread = None
+    reused = []
+    start = time.perf_counter()
+    try:
+        # A vector store built from the same file contents is reused without uploading the files again
+        digests = list(upload_executor.map(file_hash, file_paths))
+        key = resource_key(sorted(digests))
+        if registry is not None:
+            vector_store_id = registry.get("vector_store", key, partial(resource_is_live, project_client))
+        if vector_store_id is not None:
+            reused.append("vector_store")
+            # The store needs its files on the service, so they stay registered as long as it is reused
+            registry.touch("file", digests)
+        else:
+            # Upload the RFP's files on the shared upload pool
+            futures = [upload_executor.submit(tracing.bind(upload_rfp_file), project_client, registry, path, digest)
+                       for path, digest in zip(file_paths, digests)]
+            # Wait for every upload before raising, so the files that did upload are cleaned up as well
+            upload_error = None
+            for future in futures:
+                try:
+                    file_id, file_reused = future.result()
+                except Exception as e:
+                    upload_error = upload_error or e
+                    continue
+                file_ids.append(file_id)
+                if file_reused:
+                    reused.append("file")
+            if upload_error is not None:
+                raise upload_error
+        uploaded = time.perf_counter()
+        record["upload_seconds"] = round(uploaded - start, 2)
+
+        if vector_store_id is None:
+            vector_store_id = create_rfp_vector_store(project_client, registry, name, file_ids, key)
+        indexed = time.perf_counter()
+        record["vector_store_seconds"] = round(indexed - uploaded, 2)
+
+        # the thread's tool resources limit file search to this RFP's vector store
+        thread = project_client.agents.create_thread(
+            tool_resources=ToolResources(file_search=FileSearchToolResource(vector_store_ids=[vector_store_id]))
+        )
+        project_client.agents.create_message(thread_id=thread.id, role="user", content="Generate summary")
+        with tracing.span("agent.run") as run_span:
+            run = project_client.agents.create_and_process_run(thread_id=thread.id, agent_id=agent_id)
+            run_span.set(status=run.status)
+            run_span.usage(run.usage)
+        record["run_seconds"] = round(time.perf_counter() - indexed, 2)
+        record["status"] = run.status
+        if run.usage:
+            record["usage"] = {
+                "prompt_tokens": run.usage.prompt_tokens,
+                "completion_tokens": run.usage.completion_tokens,
+                "total_tokens": run.usage.total_tokens,
+            }
+        # expired, cancelled, incomplete and requires_action runs have no usable summary either
+        if run.status != "completed":
+            record["error"] = f"run {run.status}: {run.last_error}"
+        else:
+            messages = project_client.agents.list_messages(thread_id=thread.id)
+            message = messages.get_last_text_message_by_role(MessageRole.AGENT)
+            record["summary"] = parse_summary(message.text.value) if message else None
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = str(e)
+    finally:
+        # Clean up what was created for this RFP; registered files and vector stores are kept for the next run
+        # and the agent is handled once at the end
+        cleanup = []
+        if thread is not None:
+            cleanup.append(("thread", thread.id, project_client.agents.delete_thread))
+        if registry is None:
+            if vector_store_id is not None:
+                cleanup.append(("vector store", vector_store_id, project_client.agents.delete_vector_store))
+            cleanup.extend(("file", file_id, project_client.agents.delete_file) for file_id in file_ids)
+        # One failed delete does not keep the rest from being deleted
+        for kind, resource_id, delete in cleanup:
+            try:
+                delete(resource_id)
+            except Exception as e:
+                logger.warning("Cleanup failed for %s: could not delete %s %s: %s", name, kind, resource_id, e)
+    record["reused"] = reused
+    record["duration_seconds"] = round(time.perf_counter() - start, 2)
+    return record
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize RFPs with an Azure AI Foundry file search agent.")
+    parser.add_argument("source", nargs="?", help="an RFP file, or a folder of RFP files and folders")
+    parser.add_argument("--output", default="rfp_summaries.jsonl", help="JSONL file the summaries are written to")
+    parser.add_argument("--workers", type=int, default=4, help="RFPs processed at the same time")
+    parser.add_argument("--upload-workers", type=int, default=8, help="files uploaded at the same time")
+    parser.add_argument("--registry", default=DEFAULT_REGISTRY_PATH, help="SQLite registry of reusable files, vector stores and agents")
+    parser.add_argument("--no-registry", action="store_true", help="create every resource for this run and delete it afterwards")
+    parser.add_argument("--max-age-days", type=float, default=7, help="days an unused registered resource is kept")
+    parser.add_argument("--gc", action="store_true", help="only delete the expired registered resources and exit")
+    tracing.add_arguments(parser)
+    args = parser.parse_args()
+    tracing.setup(args, "filesearchagent")
+    if args.source is None and not args.gc:
+        parser.error("the source is required unless --gc is given")
+
+    # The client is created from PROJECT_CONNECTION_STRING and the Azure CLI login (DefaultAzureCredential);
+    # its connection pool is sized for the run and upload workers, which all share it
+    project_client = clients.project_client(pool_size=args.workers + args.upload_workers)
+    registry = None
+    if not args.no_registry:
+        registry = AgentRegistry(args.registry, max_age_days=args.max_age_days)
+        deleted, gc_failed = registry.gc(partial(delete_resource, project_client))
+        if deleted or gc_failed:
+            logger.info("Deleted %d expired resources, %d failed", deleted, gc_failed)
+    if args.gc:
+        return 0
 
-run = project_client.agents.create_and_process_run(thread_id=thread.id, agent_id=agent.id)
-print(f"Created run, run ID: {run.id}")
+    rfps = find_rfps(args.source)
+    logger.info("Found %d RFPs in %s", len(rfps), args.source)
+    agent_id, _ = create_summary_agent(project_client, registry)
 
-project_client.agents.delete_vector_store(vector_store.id)
-print("Deleted vector store")
+    durations = []
+    total_tokens = 0
+    failed = 0
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.upload_workers) as upload_executor, \
+                ThreadPoolExecutor(max_workers=args.workers) as executor, \
+                open(args.output, "w", encoding="utf-8") as out:
+            futures = [executor.submit(summarize_rfp, project_client, agent_id, upload_executor, name, file_paths, registry)
+                       for name, file_paths in rfps]
+            for future in as_completed(futures):
+                record = future.result()
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+                durations.append(record["duration_seconds"])
+                total_tokens += record.get("usage", {}).get("total_tokens", 0)
+                if "error" in record:
+                    failed += 1
+                    logger.error("%s: failed after %ss: %s", record["rfp"], record["duration_seconds"], record["error"])
+                else:
+                    logger.info("%s: summarized in %ss, %s tokens", record["rfp"], record["duration_seconds"],
+                                record.get("usage", {}).get("total_tokens", "n/a"))
+    finally:
+        if registry is None:
+            project_client.agents.delete_agent(agent_id)
+            logger.info("Deleted agent")
+        else:
+            logger.info(registry.report())
+            registry.close()
+    elapsed = time.perf_counter() - start
 
-project_client.agents.delete_agent(agent.id)
-print("Deleted agent")
+    logger.info("Summarized %d of %d RFPs in %.1fs, %d failed, %d tokens; summaries written to %s",
+                len(durations) - failed, len(durations), elapsed, failed, total_tokens, args.output)
+    if durations:
+        logger.info(format_latency_summary(latency_summary(durations, elapsed), unit="RFPs"))
+    return 0 if failed == 0 else 1
 
-messages = project_client.agents.list_messages(thread_id=thread.id)
 
-for text_message in messages.text_messages:
-    print(text_message.as_dict())
+if __name__ == "__main__":
+    sys.exit(clients.run_main(main))
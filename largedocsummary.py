@@ -1,144 +1,128 @@
 # Description: This script reads a PDF file and extracts the text from it. 
+# Pages are extracted in parallel worker processes and streamed in page order, holding only a bounded window of pages in memory.
 # The text is then split into chunks 
 # sent to the Azure Text Analytics service for abstractive summarization. 
+# Chunks are packed several to a request and a bounded number of requests run concurrently.
 # The script combines the summaries from all chunks into a single summary and saves it to a file.
+# The chunk summaries are reduced in a tree: groups of summaries are summarized in parallel, level by level, until one is left.
+# Summaries are cached on disk by content hash, so re-running after a crash or on a revised PDF only summarizes the chunks that changed.
+# Throttled requests are retried by the shared adaptive rate limiter in lib/ratelimit.py, which also backs off the requests in flight.
+# Progress is logged on stderr (--log-level); the summaries are printed on stdout. With --trace every page, chunk, summarization
+# job, reduce level and HTTP request is timed (lib/tracing.py) and the time spent in each stage is logged at the end.
 # You will need an Azure Language Service created with the key
 # and endpoint in the environment variables AZURE_LANGUAGE_KEY and AZURE_LANGUAGE_ENDPOINT.
 
 
 
-import os
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.textanalytics import TextAnalyticsClient
-from pypdf import PdfReader
+import argparse
+import logging
+
 import dotenv
 
+from lib.chunking import stream_chunks
+from lib.clients import async_text_analytics_client, run_main
+from lib.pdfextract import PdfPages
+from lib.summarycache import DEFAULT_CACHE_PATH, SummaryCache
+from lib.summarization import MAX_DOCUMENTS_PER_REQUEST, SummarizationEngine, reduce_summaries
+from lib import tracing
+
 dotenv.load_dotenv()
 
-def create_chunks(text, chunk_size=10000, overlap=2000):  # 800KB chunks with 200 char overlap
-    print("Creating chunks...")
-    chunks = []
-    start = 0
-    text_length = len(text)
-    print(f"Text length: {text_length}")
-    
-    while start < text_length:
-        print(f"Starting new chunk at position {start}")
-        end = start + chunk_size
-        print(f"Initial end position: {end}")
-        
-        # If this is not the last chunk, adjust end to not break words
-        if end < text_length:
-            # Adjust end to the last space within the chunk
-            original_end = end
-            while end > start and not text[end-1].isspace():
-                end -= 1
-            print(f"Adjusted end from {original_end} to {end} to avoid breaking words")
-        else:
-            end = text_length
-            print(f"Last chunk, using text_length as end: {end}")
-            
-        # Create chunk and add to list
-        chunk = text[start:end].strip()
-        if chunk:  # Only add non-empty chunks
-            # Store chunk as plain string, not in a list
-            chunks.append(chunk)
-            print(f"Added chunk of length: {len(chunk)}")
-            
-        # Move start position for next chunk, including overlap
-        old_start = start
-        start = end - overlap
-        print(f"Moving start position from {old_start} to {start} (overlap: {overlap})")
-        
-        if start <= old_start:
-            print("Warning: Start position not advancing!")
-            # Force advancement to avoid infinite loop
-            start = end
-            print(f"Forced start position to {start}")
-    
-    print(f"Final number of chunks: {len(chunks)}")
-    return chunks
-
-
-endpoint = os.environ["AZURE_LANGUAGE_ENDPOINT"] 
-key = os.environ["AZURE_LANGUAGE_KEY"] 
-
-text_analytics_client = TextAnalyticsClient(endpoint, AzureKeyCredential(key))
-
-# First, combine all pages into a single string
-reader = PdfReader("ENTER PATH TO PDF FILE")
-# read the full pdf file
-number_of_pages = len(reader.pages)
-print(f"Found {number_of_pages} pages in PDF")
-
-full_text = ""
-pagenumber = 1
-for page in reader.pages:
-
-    # print(f"Processing page {pagenumber}")
-    page_text = page.extract_text()
-    if page_text:
-        full_text += page_text + " "
-    pagenumber += 1
-
-print("about to chunk")
-# Then create chunks from the combined text
-chunks = create_chunks(full_text)
-print(f"Created {len(chunks)} chunks")
-for chunk in chunks:
-    print(f"Chunk length: {len(chunk)}")
-    # print(chunk)
-
-
-all_summaries = []
-
-for chunk in chunks:
-    # Properly format the documents for the API
-    documents = [chunk]
-    # print(chunk)
-    try:
-        poller = text_analytics_client.begin_abstract_summary(documents)
-
-
-        actions_results = poller.result()
-        for action_result in actions_results:
-            if action_result.kind == "AbstractiveSummarization":
-                for summary in action_result.summaries:
-                    all_summaries.append(summary.text)
-                #print("Summaries extracted:")
-                #[print(f"{summary.text}\n") for summary in action_result.summaries]
-            elif action_result.is_error is True:
-                print("...Is an error with code '{}' and message '{}'".format(
-                    action_result.error.code, action_result.error.message
-                ))
-    except Exception as e:
-        print(f"Error processing chunk: {str(e)}")
-
-combined_summary = "".join(all_summaries)
-print("\nCOMBINED SUMMARY OF ALL CHUNKS:")
-print("================================")
-print(combined_summary)
-
-documents=[combined_summary]
-poller = text_analytics_client.begin_abstract_summary(documents, sentence_count=10)
-abstract_summary_results = poller.result()
-for result in abstract_summary_results:
-    if result.kind == "AbstractiveSummarization":
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Summarize a large PDF with Azure AI Language abstractive summarization.")
+    parser.add_argument("pdf_path", nargs="?", default="ENTER PATH TO PDF FILE", help="path to the PDF file to summarize")
+    parser.add_argument("--max-tokens", type=int, default=2500, help="maximum tokens per chunk")
+    parser.add_argument("--overlap-tokens", type=int, default=500, help="tokens of overlap between consecutive chunks")
+    parser.add_argument("--workers", type=int, default=None, help="processes extracting PDF pages (default: number of CPUs)")
+    parser.add_argument("--page-window", type=int, default=None, help="maximum pages being extracted or buffered at once (default: 2 x workers)")
+    parser.add_argument("--batch-size", type=int, default=MAX_DOCUMENTS_PER_REQUEST, help="chunks packed into each summarization request")
+    parser.add_argument("--fan-in", type=int, default=10, help="maximum summaries combined into one summary at each reduce level")
+    parser.add_argument("--max-group-tokens", type=int, default=6000, help="maximum tokens of summaries combined into one request")
+    parser.add_argument("--max-depth", type=int, default=5, help="maximum number of reduce levels")
+    parser.add_argument("--max-in-flight", type=int, default=4, help="summarization requests running at the same time")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="SQLite file caching summaries between runs")
+    parser.add_argument("--no-cache", action="store_true", help="summarize every chunk again and do not store the results")
+    parser.add_argument("--cache-max-mb", type=float, default=256, help="evict least recently used summaries above this size")
+    parser.add_argument("--cache-max-age-days", type=float, default=30, help="evict summaries older than this")
+    tracing.add_arguments(parser)
+    return parser.parse_args()
+
+
+async def main(args):
+    # Pages are extracted in a process pool and streamed in order into the chunker, so the first
+    # summarization requests go out while later pages are still being parsed
+    pdf_pages = PdfPages(args.pdf_path, workers=args.workers, window=args.page_window)
+    logger.info("Found %d pages in PDF", pdf_pages.page_count)
+    pages = tracing.traced_iter(pdf_pages, "pdf.page")
+    chunks = stream_chunks((page_text + " " for page_text in pages), max_tokens=args.max_tokens, overlap_tokens=args.overlap_tokens)
+    chunks = tracing.traced_iter(chunks, "chunk")
+
+    # Chunks summarized by an earlier run (e.g. before a crash, or unchanged pages of a revised
+    # document) are read from the cache instead of being sent again
+    cache = None
+    if not args.no_cache:
+        cache = SummaryCache(args.cache, max_mb=args.cache_max_mb, max_age_days=args.cache_max_age_days)
+
+    # The client reads AZURE_LANGUAGE_ENDPOINT and AZURE_LANGUAGE_KEY; throttled and transient failures are
+    # retried by the shared rate limiter instead of failing the chunk
+    async with async_text_analytics_client() as text_analytics_client:
+        # Several chunks go into each request and several requests run at once
+        engine = SummarizationEngine(
+            text_analytics_client,
+            batch_size=args.batch_size,
+            max_in_flight=args.max_in_flight,
+            cache=cache,
+        )
+        chunk_summaries = await engine.summarize(chunks)
+        logger.info("Summarized %d chunks in %d requests", len(chunk_summaries), engine.requests)
+        if engine.split_batches:
+            logger.warning("%d failed requests were split and retried in smaller batches", engine.split_batches)
+
+        all_summaries = []
+        for chunk_summary in chunk_summaries:
+            if chunk_summary.ok:
+                all_summaries.append(chunk_summary.text)
+            else:
+                logger.error("Error processing chunk %d: %s", chunk_summary.index, chunk_summary.error)
+
+        combined_summary = "\n\n".join(all_summaries)
+        print("\nCOMBINED SUMMARY OF ALL CHUNKS:")
+        print("================================")
+        print(combined_summary)
+
+        # Reduce the chunk summaries level by level so no request exceeds the document size limit
+        final_summary, levels = await reduce_summaries(
+            engine,
+            all_summaries,
+            max_group_tokens=args.max_group_tokens,
+            fan_in=args.fan_in,
+            max_depth=args.max_depth,
+            sentence_count=10,
+        )
+        for level in levels:
+            logger.info("Reduce level %d: %d summaries -> %d groups (%d failed) in %.1fs",
+                        level.level, level.inputs, level.groups, level.failed_groups, level.seconds)
+
         print("final summary of summary:")
+        print(final_summary)
         # save the summary to a file
-        
         with open("final_summary.txt", "w", encoding="utf-8") as f:
-            for summary in result.summaries:
-                f.write(f"{summary.text}\n")
-        [print(f"{summary.text}\n") for summary in result.summaries]
-    elif result.is_error is True:
-        print("...Is an error with code '{}' and message '{}'".format(
-            result.error.code, result.error.message
-        ))
+            f.write(f"{final_summary}\n")
 
+    with open("combined_summary.txt", "w", encoding="utf-8") as f:
+        f.write(combined_summary)
+    logger.info("Summary has been saved to 'combined_summary.txt'")
 
+    if cache is not None:
+        logger.info(cache.report())
+        cache.close()
 
 
-with open("combined_summary.txt", "w", encoding="utf-8") as f:
-    f.write(combined_summary)
-print("\nSummary has been saved to 'combined_summary.txt'")
+# Run the main function
+if __name__ == "__main__":
+    args = parse_args()
+    tracing.setup(args, "largedocsummary")
+    run_main(main, args)
@@ -0,0 +1,119 @@
+# Description: Registry of Azure AI Foundry agent resources, stored in SQLite, so repeat runs of
+# filesearchagent.py reuse the files, vector stores and agents they already created.
+# Resources are keyed by content: a file by the SHA-256 of its bytes, a vector store by the hashes
+# of its files, an agent by its model, instructions and tools. A changed file or instruction gets a
+# new key and therefore a new resource, and an unchanged one is found again wherever it lives on disk.
+# Before an ID is reused it can be checked with an is_live callback; resources that were deleted or
+# expired on the service side are forgotten. Entries unused for max_age_days are expired, and gc()
+# deletes the expired resources on the service and removes them from the registry. Reusing a vector store also
+# refreshes the entries of its files (touch), so gc never deletes files that a store still in use depends on.
+# The registry can be shared by the worker threads of one run.
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+DEFAULT_REGISTRY_PATH = ".agent_registry.sqlite"
+
+logger = logging.getLogger(__name__)
+
+# Resource kinds, in the order gc deletes them: agents and vector stores refer to files
+KINDS = ("agent", "vector_store", "file")
+
+
+def resource_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class AgentRegistry:
+    def __init__(self, path=DEFAULT_REGISTRY_PATH, max_age_days=7):
+        self.path = path
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+        self.hits = dict.fromkeys(KINDS, 0)
+        self.misses = dict.fromkeys(KINDS, 0)
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS resources ("
+            "kind TEXT NOT NULL, key TEXT NOT NULL, resource_id TEXT NOT NULL, name TEXT, "
+            "created_at REAL NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (kind, key))"
+        )
+        self.connection.commit()
+
+    def get(self, kind, key, is_live=None):
+        # Returns the ID of a live, unexpired resource for key, or None
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT resource_id FROM resources WHERE kind = ? AND key = ? AND last_used >= ?",
+                (kind, key, time.time() - self.max_age_seconds),
+            ).fetchone()
+        if row is not None and is_live is not None and not is_live(kind, row[0]):
+            self.forget(kind, key)
+            row = None
+        with self._lock:
+            if row is None:
+                self.misses[kind] += 1
+                return None
+            self.hits[kind] += 1
+            self.connection.execute(
+                "UPDATE resources SET last_used = ? WHERE kind = ? AND key = ?", (time.time(), kind, key)
+            )
+            self.connection.commit()
+        return row[0]
+
+    def put(self, kind, key, resource_id, name=None):
+        now = time.time()
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO resources (kind, key, resource_id, name, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, key, resource_id, name, now, now),
+            )
+            self.connection.commit()
+
+    def touch(self, kind, keys):
+        # Marks entries as used without looking them up, e.g. the files a reused vector store was built from
+        now = time.time()
+        with self._lock:
+            self.connection.executemany(
+                "UPDATE resources SET last_used = ? WHERE kind = ? AND key = ?", [(now, kind, key) for key in keys]
+            )
+            self.connection.commit()
+
+    def forget(self, kind, key):
+        with self._lock:
+            self.connection.execute("DELETE FROM resources WHERE kind = ? AND key = ?", (kind, key))
+            self.connection.commit()
+
+    def expired(self, max_age_seconds=None):
+        # (kind, key, resource_id, name) of the entries unused for longer than max_age_seconds
+        cutoff = time.time() - (self.max_age_seconds if max_age_seconds is None else max_age_seconds)
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT kind, key, resource_id, name FROM resources WHERE last_used < ?", (cutoff,)
+            ).fetchall()
+        return sorted(rows, key=lambda row: KINDS.index(row[0]))
+
+    def gc(self, delete, max_age_seconds=None):
+        # delete(kind, resource_id) removes the resource on the service; returns (deleted, failed)
+        deleted = failed = 0
+        for kind, key, resource_id, name in self.expired(max_age_seconds):
+            try:
+                delete(kind, resource_id)
+            except Exception as e:
+                failed += 1
+                logger.warning("Failed to delete %s %s (%s): %s", kind, resource_id, name, e)
+                continue
+            self.forget(kind, key)
+            deleted += 1
+        return deleted, failed
+
+    def report(self):
+        parts = [f"{kind.replace('_', ' ')}s {self.hits[kind]} reused/{self.hits[kind] + self.misses[kind]}" for kind in KINDS]
+        return "Registry: " + ", ".join(parts)
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,168 @@
+# Description: Answer cache for grounded Q&A in front of chat.completions.create.
+# A question is first looked up by its normalized text (case, punctuation and whitespace removed),
+# then by nearest neighbour over the embeddings of the cached questions, and counts as a hit when
+# the cosine similarity reaches similarity_threshold.
+# Entries expire after ttl_seconds and the least recently used entry is evicted when the cache is
+# full. The cache belongs to a namespace (e.g. a hash of the index name and system prompt): when the
+# namespace changes every entry is dropped, because the cached answers were grounded differently.
+# Hits, misses and the latency and tokens the hits saved are counted so the savings can be reported.
+# The cache can be saved to and loaded from a JSON file so it survives between runs.
+
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+_NOT_WORD = re.compile(r"[^\w\s]+")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_question(question):
+    return _SPACES.sub(" ", _NOT_WORD.sub(" ", question.lower())).strip()
+
+
+def cache_namespace(*parts):
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    def __init__(self, similarity_threshold=0.92, max_entries=1000, ttl_seconds=3600, namespace=None):
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.namespace = namespace
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+        self.tokens_saved = 0
+        self._clear()
+
+    def _clear(self):
+        # key -> (value, created_at, slot); slot is the row of the key's embedding, or None
+        self._entries = OrderedDict()
+        self._vectors = None
+        self._valid = np.zeros(self.max_entries, dtype=bool)
+        self._slot_keys = []
+        self._free_slots = []
+
+    def set_namespace(self, namespace):
+        if namespace != self.namespace:
+            self.namespace = namespace
+            self._clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        _, _, slot = self._entries.pop(key)
+        if slot is not None:
+            self._slot_keys[slot] = None
+            self._valid[slot] = False
+            self._free_slots.append(slot)
+
+    def _expired(self, created_at):
+        return self.ttl_seconds is not None and time.time() - created_at > self.ttl_seconds
+
+    def _hit(self, key, value):
+        self._entries.move_to_end(key)
+        self.seconds_saved += value.get("latency", 0.0)
+        self.tokens_saved += value.get("tokens", 0)
+        return value
+
+    def get_exact(self, question):
+        key = normalize_question(question)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self._expired(entry[1]):
+            self._remove(key)
+            return None
+        self.exact_hits += 1
+        return self._hit(key, entry[0])
+
+    def get_similar(self, embedding):
+        # Nearest cached question by cosine similarity, one matrix-vector product over all entries
+        if self._vectors is None or not self._entries:
+            return None
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        used = len(self._slot_keys)
+        scores = np.where(self._valid[:used], self._vectors[:used] @ query, -np.inf)
+        slot = int(np.argmax(scores))
+        if scores[slot] < self.similarity_threshold:
+            return None
+        key = self._slot_keys[slot]
+        value, created_at, _ = self._entries[key]
+        if self._expired(created_at):
+            self._remove(key)
+            return None
+        self.semantic_hits += 1
+        return self._hit(key, value)
+
+    def record_miss(self):
+        self.misses += 1
+
+    def put(self, question, value, embedding=None):
+        # value is a JSON-serializable dict; "latency" and "tokens" in it are counted as saved on hits
+        key = normalize_question(question)
+        if key in self._entries:
+            self._remove(key)
+        while len(self._entries) >= self.max_entries:
+            self._remove(next(iter(self._entries)))
+        slot = None
+        if embedding is not None:
+            vector = np.asarray(embedding, dtype=np.float32)
+            vector = vector / (np.linalg.norm(vector) or 1.0)
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+            if self._free_slots:
+                slot = self._free_slots.pop()
+                self._slot_keys[slot] = key
+            else:
+                slot = len(self._slot_keys)
+                self._slot_keys.append(key)
+            self._vectors[slot] = vector
+            self._valid[slot] = True
+        self._entries[key] = (value, time.time(), slot)
+
+    @property
+    def hits(self):
+        return self.exact_hits + self.semantic_hits
+
+    def report(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0.0
+        return (f"Answer cache: {self.exact_hits} exact hits, {self.semantic_hits} similar hits, {self.misses} misses "
+                f"({rate:.0%} hit rate); saved {self.seconds_saved:.1f}s of request latency and {self.tokens_saved} tokens")
+
+    def save(self, path):
+        entries = []
+        for key, (value, created_at, slot) in self._entries.items():
+            vector = self._vectors[slot].tolist() if slot is not None else None
+            entries.append({"key": key, "value": value, "created_at": created_at, "vector": vector})
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"namespace": self.namespace, "entries": entries}, f)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        # Entries saved under a different namespace or already expired are not loaded
+        if not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("namespace") != self.namespace:
+            return
+        for entry in data["entries"][-self.max_entries:]:
+            if self._expired(entry["created_at"]):
+                continue
+            self.put(entry["key"], entry["value"], entry["vector"])
+            value, _, slot = self._entries[entry["key"]]
+            self._entries[entry["key"]] = (value, entry["created_at"], slot)
@@ -0,0 +1,156 @@
+# Description: Token-budgeted chat history for the Semantic Kernel chat loop in semantickernelwithaisearch.py.
+# Every message is counted with tiktoken once, when it is added, so the size of the prompt is known
+# without re-encoding the conversation on every turn.
+# The prompt is kept under max_prompt_tokens by sending the most recent turns verbatim and folding
+# older turns into a rolling summary. The summary is produced by a background task started at the end
+# of a turn, so it normally runs while the user is typing the next message; a turn only waits for it
+# when the prompt would not fit without it. Turns are folded whole, so function calls stay next to
+# their results.
+
+import asyncio
+import logging
+
+from semantic_kernel.contents.chat_history import ChatHistory
+from semantic_kernel.contents.utils.author_role import AuthorRole
+
+from lib.chunking import count_tokens
+from lib.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Tokens the chat format adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an assistant. "
+    "Merge the new messages into the summary so far. Keep facts, names, numbers, decisions and open "
+    "questions, drop small talk, and reply with the updated summary only."
+)
+
+
+def message_text(message):
+    # Function calls and results have no text content, only items
+    return message.content or " ".join(str(item) for item in message.items)
+
+
+def chat_summarizer(chat_completion, settings):
+    # Builds the summarize callable for TokenBudgetHistory from a chat completion service
+    async def summarize(previous_summary, transcript):
+        request = ChatHistory()
+        request.add_system_message(SUMMARY_PROMPT)
+        request.add_user_message(f"Summary so far:\n{previous_summary or '(none)'}\n\nNew messages:\n{transcript}")
+        with span("complete", purpose="history summary") as summary_span:
+            result = await chat_completion.get_chat_message_content(chat_history=request, settings=settings)
+            summary_span.usage(result.metadata.get("usage"))
+        return str(result)
+
+    return summarize
+
+
+class TokenBudgetHistory:
+    def __init__(self, summarize, max_prompt_tokens=3000, max_summary_tokens=500, min_recent_turns=2,
+                 compact_to=0.5, system_message=None, encoding=None):
+        # summarize is an async callable (previous summary, transcript) -> new summary.
+        # When the prompt goes over max_prompt_tokens, the oldest turns are folded into the summary
+        # until the recent turns take at most compact_to of the budget left after the summary.
+        self.summarize = summarize
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_summary_tokens = max_summary_tokens
+        self.min_recent_turns = min_recent_turns
+        self.compact_to = compact_to
+        self.system_message = system_message
+        self.encoding = encoding
+        self.summary = ""
+        self.summary_tokens = 0
+        self.system_tokens = self._count(system_message) if system_message else 0
+        # Each turn is [messages, tokens] and starts with a user message
+        self._turns = []
+        self._folding = []
+        self._task = None
+        self._prompt_length = 0
+        self.compactions = 0
+        self.dropped_turns = 0
+        self.prompt_tokens = []
+
+    def _count(self, text):
+        return count_tokens(text, self.encoding) + MESSAGE_OVERHEAD_TOKENS
+
+    @staticmethod
+    def _turn_tokens(turns):
+        return sum(tokens for _, tokens in turns)
+
+    @property
+    def tokens(self):
+        # Tokens of the prompt as it would be sent now
+        tokens = self.system_tokens + self._turn_tokens(self._turns) + self._turn_tokens(self._folding)
+        if self.summary:
+            tokens += self.summary_tokens
+        return tokens
+
+    def add_message(self, message):
+        if message.role == AuthorRole.USER or not self._turns:
+            self._turns.append([[], 0])
+        turn = self._turns[-1]
+        turn[0].append(message)
+        turn[1] += self._count(message_text(message))
+
+    def add_prompt_messages(self, history):
+        # Function calls and results added to the prompt history by auto function invocation
+        for message in history.messages[self._prompt_length:]:
+            self.add_message(message)
+
+    async def prompt(self):
+        # The ChatHistory to send for the current turn
+        if self._task is not None and (self._task.done() or self.tokens > self.max_prompt_tokens):
+            await self._finish_compaction()
+        history = ChatHistory()
+        system = "\n\n".join(part for part in (
+            self.system_message,
+            f"Summary of the earlier conversation:\n{self.summary}" if self.summary else None,
+        ) if part)
+        if system:
+            history.add_system_message(system)
+        for messages, _ in self._folding + self._turns:
+            for message in messages:
+                history.add_message(message)
+        self._prompt_length = len(history.messages)
+        self.prompt_tokens.append(self.tokens)
+        return history
+
+    def compact(self):
+        # Call at the end of a turn: starts folding the oldest turns into the summary in the background
+        if self._task is not None or self.tokens <= self.max_prompt_tokens:
+            return
+        target = (self.max_prompt_tokens - self.system_tokens - self.max_summary_tokens) * self.compact_to
+        while len(self._turns) > self.min_recent_turns and self._turn_tokens(self._turns) > target:
+            self._folding.append(self._turns.pop(0))
+        if not self._folding:
+            return
+        transcript = "\n".join(
+            f"{message.role.value}: {message_text(message)}" for messages, _ in self._folding for message in messages
+        )
+        self._task = asyncio.create_task(self.summarize(self.summary, transcript))
+
+    async def _finish_compaction(self):
+        task, self._task = self._task, None
+        folding, self._folding = self._folding, []
+        try:
+            summary = await task
+        except Exception as e:
+            # Without a summary the folded turns are dropped so the prompt still fits the budget
+            logger.warning("Summarizing the chat history failed, dropping %d turns: %s", len(folding), e)
+            self.dropped_turns += len(folding)
+            return
+        self.summary = summary.strip()
+        self.summary_tokens = self._count(self.summary)
+        self.compactions += 1
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def report(self):
+        return (f"prompt {self.prompt_tokens[-1] if self.prompt_tokens else 0} tokens "
+                f"({len(self._folding) + len(self._turns)} turns verbatim, summary {self.summary_tokens} tokens)")
@@ -0,0 +1,170 @@
+# Description: Token-aware streaming chunker used by the summarization and indexing scripts.
+# Text is consumed as an iterable of pieces (for example one string per PDF page) and split into
+# sentence units in a single forward pass. Units are packed into chunks sized in tiktoken tokens,
+# preferring to close a chunk on a paragraph break, then on a sentence end, and only falling back to
+# word (or raw token) boundaries for units that are larger than a chunk on their own.
+# Chunks are yielded lazily, so callers can start working on the first chunk before the rest of the
+# document has been read, and only the current chunk is held in memory.
+
+import re
+from collections import deque
+from functools import lru_cache
+
+import tiktoken
+
+DEFAULT_ENCODING = "cl100k_base"
+
+# A sentence ends at terminal punctuation (optionally followed by closing quotes/brackets) and
+# whitespace, or at a blank line. Anything else is carried over to the next piece of text.
+_UNIT_END = re.compile(r"(?<=[.!?])[\"')\]]*\s+|\n[ \t\r\f\v]*\n\s*")
+_WORD = re.compile(r"\S+\s*|\s+")
+
+# A run of text with no sentence boundary is flushed once it grows past this many characters per
+# chunk token, so a page without punctuation cannot grow the carry-over buffer without limit.
+_MAX_CHARS_PER_TOKEN = 8
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name=DEFAULT_ENCODING):
+    return tiktoken.get_encoding(encoding_name)
+
+
+def count_tokens(text, encoding=None):
+    encoding = encoding or get_encoding()
+    return len(encoding.encode_ordinary(text))
+
+
+def _iter_units(pieces, flush_chars):
+    # Yields (unit_text, ends_paragraph) for each sentence unit in the stream of pieces.
+    remainder = ""
+    for piece in pieces:
+        if not piece:
+            continue
+        buffer = remainder + piece if remainder else piece
+        start = 0
+        for match in _UNIT_END.finditer(buffer):
+            end = match.end()
+            if end == len(buffer):
+                # Trailing whitespace may continue into the next piece (e.g. a blank line).
+                break
+            yield buffer[start:end], match.group().count("\n") >= 2
+            start = end
+        remainder = buffer[start:]
+        if len(remainder) > flush_chars:
+            yield remainder, False
+            remainder = ""
+    if remainder:
+        yield remainder, True
+
+
+def _split_oversized(unit, max_tokens, encoding):
+    # Splits a single unit that does not fit in a chunk on word boundaries, and splits any single
+    # word that is still too large on raw token boundaries.
+    parts = []
+    current = []
+    current_tokens = 0
+    for match in _WORD.finditer(unit):
+        word = match.group()
+        tokens = encoding.encode_ordinary(word)
+        if len(tokens) > max_tokens:
+            if current:
+                parts.append(("".join(current), current_tokens))
+                current, current_tokens = [], 0
+            for i in range(0, len(tokens), max_tokens):
+                piece = tokens[i:i + max_tokens]
+                parts.append((encoding.decode(piece), len(piece)))
+            continue
+        if current_tokens + len(tokens) > max_tokens and current:
+            parts.append(("".join(current), current_tokens))
+            current, current_tokens = [], 0
+        current.append(word)
+        current_tokens += len(tokens)
+    if current:
+        parts.append(("".join(current), current_tokens))
+    return parts
+
+
+def stream_chunks(pieces, max_tokens=2500, overlap_tokens=500, encoding=None):
+    """Yield chunks of at most max_tokens tokens from an iterable of text pieces.
+
+    Consecutive chunks share up to overlap_tokens tokens of whole sentences. Token counts are
+    the sum of per-unit counts, which is an upper bound on the count of the joined chunk.
+    """
+    if max_tokens <= 0:
+        raise ValueError("max_tokens must be positive")
+    if not 0 <= overlap_tokens < max_tokens:
+        raise ValueError("overlap_tokens must be at least 0 and less than max_tokens")
+    if isinstance(pieces, str):
+        pieces = [pieces]
+    encoding = encoding or get_encoding()
+
+    # Each entry is (text, tokens, ends_paragraph). The first len(window) - fresh entries are the
+    # overlap carried over from the previous chunk and have already been emitted once.
+    window = deque()
+    window_tokens = 0
+    fresh = 0
+
+    def emit(count):
+        # Emits the first `count` units of the window and keeps the overlap for the next chunk.
+        nonlocal window_tokens, fresh
+        units = [window[i] for i in range(count)]
+        text = "".join(unit[0] for unit in units).strip()
+        # Keep whole trailing sentences within the overlap budget, but always drop at least one
+        # unit so the next chunk makes progress.
+        keep = 0
+        kept_tokens = 0
+        for unit in reversed(units[1:]):
+            if kept_tokens + unit[1] > overlap_tokens:
+                break
+            keep += 1
+            kept_tokens += unit[1]
+        fresh = len(window) - count
+        for _ in range(count - keep):
+            window_tokens -= window.popleft()[1]
+        return text
+
+    def add(text, tokens, ends_paragraph):
+        nonlocal window_tokens, fresh
+        chunks = []
+        while window and window_tokens + tokens > max_tokens:
+            carried = len(window) - fresh
+            if not fresh:
+                # Only overlap is left and it does not fit alongside the new unit; drop it.
+                window_tokens -= window.popleft()[1]
+                continue
+            # Close on the last paragraph break if it leaves the chunk at least half full,
+            # otherwise on the last complete sentence in the window.
+            count = len(window)
+            filled = 0
+            for i, unit in enumerate(window):
+                filled += unit[1]
+                if i >= carried and unit[2] and filled * 2 >= max_tokens:
+                    count = i + 1
+            chunk = emit(count)
+            if chunk:
+                chunks.append(chunk)
+        window.append((text, tokens, ends_paragraph))
+        window_tokens += tokens
+        fresh += 1
+        return chunks
+
+    flush_chars = max_tokens * _MAX_CHARS_PER_TOKEN
+    for unit, ends_paragraph in _iter_units(pieces, flush_chars):
+        tokens = len(encoding.encode_ordinary(unit))
+        if tokens > max_tokens:
+            parts = _split_oversized(unit, max_tokens, encoding)
+        else:
+            parts = [(unit, tokens)]
+        for i, (text, part_tokens) in enumerate(parts):
+            last = i == len(parts) - 1
+            yield from add(text, part_tokens, ends_paragraph and last)
+
+    # Flush the units that have not been emitted yet, together with their leading overlap.
+    if fresh:
+        text = "".join(unit[0] for unit in window).strip()
+        if text:
+            yield text
+
+
+def chunk_text(text, max_tokens=2500, overlap_tokens=500, encoding=None):
+    return stream_chunks([text], max_tokens=max_tokens, overlap_tokens=overlap_tokens, encoding=encoding)
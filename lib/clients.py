@@ -0,0 +1,257 @@
+# Description: Shared Azure and Azure OpenAI clients for the scripts, created on first use and cached.
+# Every factory reads its endpoint and key from the same environment variables the scripts use, and the
+# SDK is only imported when its first client is created, so a script only pays for the SDKs the
+# selected code path actually calls.
+# All clients share what can be shared: one DefaultAzureCredential (sync and async), so a token is
+# fetched once and then served from the credential's token cache; one requests session for the sync
+# Azure SDK clients; and one httpx client per sync or async OpenAI client. Every client also goes
+# through the adaptive rate limiter of its service (lib/ratelimit.py).
+# Sync clients are closed with close_clients() and async clients with aclose_clients(), which must be
+# awaited on the event loop that used them. The scripts run their main() through run_main(), which does
+# both, logs the limiter reports and ends tracing however main() ends, including on errors and Ctrl-C.
+
+import asyncio
+import inspect
+import logging
+import os
+import threading
+
+from lib import tracing
+from lib.ratelimit import (
+    async_azure_client_kwargs,
+    async_openai_http_client,
+    azure_client_kwargs,
+    limiter_reports,
+    openai_http_client,
+    storage_client_kwargs,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 16
+OPENAI_API_VERSION = "2024-02-01"
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+_lock = threading.RLock()
+_clients = {}
+_async_clients = {}
+_pool_size = 0
+
+
+def env(name, default=None):
+    # Unset and empty variables are treated the same, as the .env templates leave optional values empty
+    return os.environ.get(name) or default
+
+
+def _cached(cache, key, factory):
+    with _lock:
+        client = cache.get(key)
+        if client is None:
+            client = cache[key] = factory()
+        return client
+
+
+def credential():
+    def create():
+        from azure.identity import DefaultAzureCredential
+        return DefaultAzureCredential()
+    return _cached(_clients, "credential", create)
+
+
+def async_credential():
+    def create():
+        from azure.identity.aio import DefaultAzureCredential
+        return DefaultAzureCredential()
+    return _cached(_async_clients, "credential", create)
+
+
+def key_or_credential(key_name):
+    key = env(key_name)
+    if key:
+        from azure.core.credentials import AzureKeyCredential
+        return AzureKeyCredential(key)
+    return credential()
+
+
+def async_key_or_credential(key_name):
+    key = env(key_name)
+    if key:
+        from azure.core.credentials import AzureKeyCredential
+        return AzureKeyCredential(key)
+    return async_credential()
+
+
+def requests_transport(pool_size=DEFAULT_POOL_SIZE):
+    # One session for all sync Azure SDK clients; asking for a bigger pool remounts a bigger adapter
+    global _pool_size
+    with _lock:
+        transport = _clients.get("transport")
+        if transport is None:
+            from azure.core.pipeline.transport import RequestsTransport
+            from requests import Session
+            transport = _clients["transport"] = RequestsTransport(session=Session(), session_owner=False)
+        if pool_size > _pool_size:
+            from requests.adapters import HTTPAdapter
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            transport.session.mount("https://", adapter)
+            transport.session.mount("http://", adapter)
+            _pool_size = pool_size
+        return transport
+
+
+def azure_kwargs(name, pool_size=DEFAULT_POOL_SIZE, **limiter_kwargs):
+    kwargs = azure_client_kwargs(name, **limiter_kwargs)
+    kwargs["transport"] = requests_transport(pool_size)
+    return kwargs
+
+
+def search_client(index_name=None):
+    index_name = index_name or env("AZURE_SEARCH_INDEX")
+
+    def create():
+        from azure.search.documents import SearchClient
+        return SearchClient(endpoint=env("AZURE_SEARCH_SERVICE_ENDPOINT"), index_name=index_name,
+                            credential=key_or_credential("AZURE_SEARCH_ADMIN_KEY"), **azure_kwargs("search"))
+    return _cached(_clients, ("search", index_name), create)
+
+
+def search_index_client():
+    def create():
+        from azure.search.documents.indexes import SearchIndexClient
+        return SearchIndexClient(endpoint=env("AZURE_SEARCH_SERVICE_ENDPOINT"),
+                                 credential=key_or_credential("AZURE_SEARCH_ADMIN_KEY"), **azure_kwargs("search"))
+    return _cached(_clients, "search_index", create)
+
+
+def search_indexer_client():
+    def create():
+        from azure.search.documents.indexes import SearchIndexerClient
+        return SearchIndexerClient(endpoint=env("AZURE_SEARCH_SERVICE_ENDPOINT"),
+                                   credential=key_or_credential("AZURE_SEARCH_ADMIN_KEY"), **azure_kwargs("search"))
+    return _cached(_clients, "search_indexer", create)
+
+
+def async_search_client(index_name=None):
+    index_name = index_name or env("AZURE_SEARCH_INDEX")
+
+    def create():
+        from azure.search.documents.aio import SearchClient
+        return SearchClient(endpoint=env("AZURE_SEARCH_SERVICE_ENDPOINT"), index_name=index_name,
+                            credential=async_key_or_credential("AZURE_SEARCH_ADMIN_KEY"), **async_azure_client_kwargs("search"))
+    return _cached(_async_clients, ("search", index_name), create)
+
+
+def blob_service_client(pool_size=None):
+    # pool_size raises the number of pooled connections for concurrent uploads
+    def create():
+        from azure.storage.blob import BlobServiceClient
+        size = pool_size or DEFAULT_POOL_SIZE
+        kwargs = storage_client_kwargs("blob", initial=size, maximum=max(64, size))
+        kwargs["transport"] = requests_transport(size)
+        connection_string = env("AZURE_BLOB_CONNECTION_STRING", "")
+        if not connection_string.startswith("ResourceId"):
+            return BlobServiceClient.from_connection_string(
+                connection_string, max_block_size=1024*1024*8, max_single_put_size=1024*1024*8, **kwargs
+            )
+        return BlobServiceClient(
+            account_url=env("AZURE_BLOB_ACCOUNT_URL"),
+            credential=connection_string,
+            max_block_size=1024*1024*8,
+            max_single_put_size=1024*1024*8,
+            **kwargs
+        )
+    return _cached(_clients, ("blob", pool_size), create)
+
+
+def _openai_auth():
+    # The key when one is set, otherwise Entra ID tokens from the shared credential
+    key = env("AZURE_OPENAI_KEY")
+    if key:
+        return {"api_key": key}
+    from azure.identity import get_bearer_token_provider
+    return {"azure_ad_token_provider": get_bearer_token_provider(credential(), COGNITIVE_SERVICES_SCOPE)}
+
+
+def openai_client(api_version=None):
+    api_version = api_version or env("AZURE_OPENAI_API_VERSION", OPENAI_API_VERSION)
+
+    def create():
+        import openai
+        return openai.AzureOpenAI(azure_endpoint=env("AZURE_OPENAI_ENDPOINT"), api_version=api_version,
+                                  http_client=openai_http_client(), max_retries=0, **_openai_auth())
+    return _cached(_clients, ("openai", api_version), create)
+
+
+def async_openai_client(api_version=None, base_url=None, **http_kwargs):
+    # http_kwargs (limits, timeout, initial, ...) size the pooled HTTP client of the first call; base_url
+    # addresses one deployment, as Semantic Kernel expects, instead of the resource endpoint
+    api_version = api_version or env("AZURE_OPENAI_API_VERSION", OPENAI_API_VERSION)
+
+    def create():
+        import openai
+        target = {"base_url": base_url} if base_url else {"azure_endpoint": env("AZURE_OPENAI_ENDPOINT")}
+        return openai.AsyncAzureOpenAI(api_version=api_version, http_client=async_openai_http_client(**http_kwargs),
+                                       max_retries=0, **target, **_openai_auth())
+    return _cached(_async_clients, ("openai", api_version, base_url), create)
+
+
+def async_text_analytics_client():
+    def create():
+        from azure.ai.textanalytics.aio import TextAnalyticsClient
+        return TextAnalyticsClient(env("AZURE_LANGUAGE_ENDPOINT"), async_key_or_credential("AZURE_LANGUAGE_KEY"),
+                                   **async_azure_client_kwargs("language"))
+    return _cached(_async_clients, "language", create)
+
+
+def project_client(pool_size=DEFAULT_POOL_SIZE):
+    # PROJECT_CONNECTION_STRING is copied from the Azure AI Foundry project:
+    # "<HostName>;<AzureSubscriptionId>;<ResourceGroup>;<ProjectName>"
+    def create():
+        from azure.ai.projects import AIProjectClient
+        return AIProjectClient.from_connection_string(
+            credential=credential(), conn_str=env("PROJECT_CONNECTION_STRING"), **azure_kwargs("agents", pool_size=pool_size)
+        )
+    return _cached(_clients, "project", create)
+
+
+def close_clients():
+    global _pool_size
+    with _lock:
+        clients = list(_clients.items())
+        _clients.clear()
+        _pool_size = 0
+    # The shared session is closed last, after the clients using it
+    for key, client in clients:
+        if key != "transport":
+            client.close()
+    for key, client in clients:
+        if key == "transport":
+            client.session.close()
+
+
+async def aclose_clients():
+    with _lock:
+        clients = list(_async_clients.values())
+        _async_clients.clear()
+    for client in clients:
+        await client.close()
+
+
+async def _run_async(main, args):
+    try:
+        return await main(*args)
+    finally:
+        await aclose_clients()
+
+
+def run_main(main, *args):
+    # Runs main(*args), a function or a coroutine function, and returns its result
+    try:
+        if inspect.iscoroutinefunction(main):
+            return asyncio.run(_run_async(main, args))
+        return main(*args)
+    finally:
+        close_clients()
+        for report in limiter_reports():
+            logger.info(report)
+        tracing.shutdown()
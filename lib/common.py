@@ -0,0 +1,227 @@
+# Description: Shared Azure AI Search helpers used by aisearchindexer.py.
+# The create_* functions build the index, blob datasource, skillset and indexer definitions for the
+# server-side (pull) ingestion path: the skillset splits each document into pages, embeds them with
+# Azure OpenAI and projects one search document per chunk into the index.
+# The index schema (chunk_id key, parent_id, title, chunk and a 1536-dimension vector field with an
+# Azure OpenAI vectorizer) is also used by the client-side push pipeline in lib/pushindexing.py.
+# get_chunks, get_token_length and plot_chunk_histogram are used to measure chunk sizes, either of
+# an existing index or of local chunking, so chunk sizes can be tuned before paying for indexing.
+# Token lengths are computed for the whole corpus in one batched, multi-threaded tiktoken call and
+# returned as a NumPy array, and matplotlib is only imported when a histogram is drawn.
+
+import numpy as np
+from azure.search.documents.indexes.models import (
+    AzureOpenAIEmbeddingSkill,
+    AzureOpenAIVectorizer,
+    AzureOpenAIVectorizerParameters,
+    HnswAlgorithmConfiguration,
+    IndexingParameters,
+    IndexingParametersConfiguration,
+    IndexProjectionMode,
+    InputFieldMappingEntry,
+    OutputFieldMappingEntry,
+    SearchField,
+    SearchFieldDataType,
+    SearchIndex,
+    SearchIndexer,
+    SearchIndexerDataContainer,
+    SearchIndexerDataSourceConnection,
+    SearchIndexerIndexProjection,
+    SearchIndexerIndexProjectionSelector,
+    SearchIndexerIndexProjectionsParameters,
+    SearchIndexerSkillset,
+    SplitSkill,
+    VectorSearch,
+    VectorSearchProfile,
+)
+
+from lib.chunking import get_encoding
+
+EMBEDDING_DIMENSIONS = 1536
+# The service requires the model behind the embedding deployment; 1536 dimensions is text-embedding-ada-002
+EMBEDDING_MODEL = "text-embedding-ada-002"
+VECTOR_PROFILE = "myHnswProfile"
+VECTOR_ALGORITHM = "myHnsw"
+VECTORIZER = "myOpenAI"
+
+
+def create_search_index(index_name, azure_openai_endpoint, azure_openai_embedding_deployment_id, azure_openai_key=None):
+    # One search document per chunk, keyed by chunk_id and grouped by parent_id
+    fields = [
+        SearchField(name="parent_id", type=SearchFieldDataType.String, sortable=True, filterable=True, facetable=True),
+        SearchField(name="title", type=SearchFieldDataType.String),
+        SearchField(name="chunk_id", type=SearchFieldDataType.String, key=True, sortable=True, filterable=True, facetable=True, analyzer_name="keyword"),
+        SearchField(name="chunk", type=SearchFieldDataType.String, searchable=True, sortable=False, filterable=False, facetable=False),
+        SearchField(
+            name="vector",
+            type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
+            vector_search_dimensions=EMBEDDING_DIMENSIONS,
+            vector_search_profile_name=VECTOR_PROFILE,
+        ),
+    ]
+
+    # The vectorizer lets queries be sent as text and embedded by the service
+    vector_search = VectorSearch(
+        algorithms=[HnswAlgorithmConfiguration(name=VECTOR_ALGORITHM)],
+        profiles=[VectorSearchProfile(name=VECTOR_PROFILE, algorithm_configuration_name=VECTOR_ALGORITHM,
+                                      vectorizer_name=VECTORIZER)],
+        vectorizers=[
+            AzureOpenAIVectorizer(
+                vectorizer_name=VECTORIZER,
+                parameters=AzureOpenAIVectorizerParameters(
+                    resource_url=azure_openai_endpoint,
+                    deployment_name=azure_openai_embedding_deployment_id,
+                    api_key=azure_openai_key,
+                    model_name=EMBEDDING_MODEL,
+                ),
+            )
+        ],
+    )
+
+    return SearchIndex(name=index_name, fields=fields, vector_search=vector_search)
+
+
+def create_search_datasource(datasource_name, blob_connection_string, blob_container):
+    container = SearchIndexerDataContainer(name=blob_container)
+    return SearchIndexerDataSourceConnection(
+        name=datasource_name,
+        type="azureblob",
+        connection_string=blob_connection_string,
+        container=container,
+    )
+
+
+def create_search_skillset(
+    skillset_name,
+    index_name,
+    azure_openai_endpoint,
+    azure_openai_embedding_deployment_id,
+    azure_openai_key=None,
+    text_split_mode="pages",
+    maximum_page_length=2000,
+    page_overlap_length=500,
+):
+    split_skill = SplitSkill(
+        description="Split skill to chunk documents",
+        text_split_mode=text_split_mode,
+        context="/document",
+        maximum_page_length=maximum_page_length,
+        page_overlap_length=page_overlap_length,
+        inputs=[InputFieldMappingEntry(name="text", source="/document/content")],
+        outputs=[OutputFieldMappingEntry(name="textItems", target_name="pages")],
+    )
+
+    embedding_skill = AzureOpenAIEmbeddingSkill(
+        description="Skill to generate embeddings via Azure OpenAI",
+        context="/document/pages/*",
+        resource_url=azure_openai_endpoint,
+        deployment_name=azure_openai_embedding_deployment_id,
+        api_key=azure_openai_key,
+        model_name=EMBEDDING_MODEL,
+        dimensions=EMBEDDING_DIMENSIONS,
+        inputs=[InputFieldMappingEntry(name="text", source="/document/pages/*")],
+        outputs=[OutputFieldMappingEntry(name="embedding", target_name="vector")],
+    )
+
+    # Project every page into its own search document instead of indexing the whole file
+    index_projection = SearchIndexerIndexProjection(
+        selectors=[
+            SearchIndexerIndexProjectionSelector(
+                target_index_name=index_name,
+                parent_key_field_name="parent_id",
+                source_context="/document/pages/*",
+                mappings=[
+                    InputFieldMappingEntry(name="chunk", source="/document/pages/*"),
+                    InputFieldMappingEntry(name="vector", source="/document/pages/*/vector"),
+                    InputFieldMappingEntry(name="title", source="/document/metadata_storage_name"),
+                ],
+            )
+        ],
+        parameters=SearchIndexerIndexProjectionsParameters(
+            projection_mode=IndexProjectionMode.SKIP_INDEXING_PARENT_DOCUMENTS
+        ),
+    )
+
+    return SearchIndexerSkillset(
+        name=skillset_name,
+        description="Skillset to chunk documents and generate embeddings",
+        skills=[split_skill, embedding_skill],
+        index_projection=index_projection,
+    )
+
+
+def create_search_indexer(indexer_name, index_name, datasource_name, skillset_name):
+    return SearchIndexer(
+        name=indexer_name,
+        description="Indexer to index documents and generate embeddings",
+        skillset_name=skillset_name,
+        target_index_name=index_name,
+        data_source_name=datasource_name,
+        # query_timeout only applies to SQL datasources and must be cleared for blob storage
+        parameters=IndexingParameters(
+            configuration=IndexingParametersConfiguration(
+                data_to_extract="contentAndMetadata",
+                parsing_mode="default",
+                query_timeout=None,
+            )
+        ),
+    )
+
+
+def get_chunks(search_client, select=("chunk_id", "parent_id", "title", "chunk")):
+    # Read every chunk in the index, e.g. to measure the chunks the skillset produced
+    results = search_client.search(search_text="*", select=list(select), top=100000)
+    return [dict(result) for result in results]
+
+
+def get_token_length(texts, encoding_name="cl100k_base", num_threads=8):
+    # Returns an int for a single string, or a NumPy array of lengths for a list of strings
+    encoding = get_encoding(encoding_name)
+    if isinstance(texts, str):
+        return len(encoding.encode_ordinary(texts))
+    tokens = encoding.encode_ordinary_batch(list(texts), num_threads=num_threads)
+    return np.fromiter((len(t) for t in tokens), dtype=np.int64, count=len(tokens))
+
+
+def describe_lengths(lengths):
+    lengths = np.asarray(lengths)
+    if lengths.size == 0:
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(lengths, [50, 95, 99])
+    return {
+        "count": int(lengths.size),
+        "total": int(lengths.sum()),
+        "mean": float(lengths.mean()),
+        "min": int(lengths.min()),
+        "p50": float(p50),
+        "p95": float(p95),
+        "p99": float(p99),
+        "max": int(lengths.max()),
+    }
+
+
+def plot_chunk_histogram(chunks, length_fn=get_token_length, title="Chunk length distribution",
+                         xlabel="Chunk length (tokens)", ylabel="Chunk count", bins=50, output_path=None):
+    # chunks can be strings or the dicts returned by get_chunks; length_fn is applied to the whole
+    # list at once so it can be vectorized
+    texts = [chunk["chunk"] if isinstance(chunk, dict) else chunk for chunk in chunks]
+    lengths = np.asarray(length_fn(texts))
+    counts, edges = np.histogram(lengths, bins=bins)
+
+    import matplotlib
+    if output_path:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    plt.figure(figsize=(10, 6))
+    plt.bar(edges[:-1], counts, width=np.diff(edges), align="edge", edgecolor="black")
+    plt.title(title)
+    plt.xlabel(xlabel)
+    plt.ylabel(ylabel)
+    plt.grid(axis="y", alpha=0.75)
+    if output_path:
+        plt.savefig(output_path)
+        plt.close()
+    else:
+        plt.show()
+    return lengths
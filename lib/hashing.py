@@ -0,0 +1,17 @@
+# Description: Content hashes shared by the caches, registries and manifests in lib/, so a file or text is
+# recognized by what it contains rather than by where it lives.
+
+import hashlib
+
+
+def file_hash(path, block_size=1024 * 1024):
+    # SHA-256 of a file, read in blocks so large files are not loaded at once
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
@@ -0,0 +1,118 @@
+# Description: Manifest of the chunks the push pipeline (lib/pushindexing.py) put in each search index, stored in SQLite,
+# so aisearchindexer.py --push --incremental only embeds and uploads what changed since the previous run.
+# For every document the manifest keeps the SHA-256 of the file, the parameters its chunks were made with and, per page,
+# the hash of the page text together with the keys and token count of the chunks cut from that page. Chunk keys are
+# derived from the chunk text, so an unchanged chunk keeps its key wherever its page moved in the document.
+# Entries are scoped by index name, so one manifest file can track several indexes.
+# The manifest can be shared by the worker threads of one run.
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+
+DEFAULT_MANIFEST_PATH = ".index_manifest.sqlite"
+
+
+def params_key(**params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+@dataclass
+class PageEntry:
+    page_hash: str
+    chunk_keys: list
+    tokens: int = 0
+
+
+@dataclass
+class DocumentEntry:
+    name: str
+    parent_id: str
+    file_hash: str
+    params: str
+    pages: list = field(default_factory=list)
+
+    @property
+    def chunk_keys(self):
+        return {key for page in self.pages for key in page.chunk_keys}
+
+    @property
+    def tokens(self):
+        return sum(page.tokens for page in self.pages)
+
+    def page_index(self):
+        # Page hash -> PageEntry, to find an unchanged page wherever it moved
+        return {page.page_hash: page for page in self.pages}
+
+
+class IndexManifest:
+    def __init__(self, path=DEFAULT_MANIFEST_PATH, index_name=""):
+        self.path = path
+        self.index_name = index_name
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "index_name TEXT NOT NULL, name TEXT NOT NULL, parent_id TEXT NOT NULL, file_hash TEXT NOT NULL, "
+            "params TEXT NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (index_name, name))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "index_name TEXT NOT NULL, name TEXT NOT NULL, number INTEGER NOT NULL, page_hash TEXT NOT NULL, "
+            "chunk_keys TEXT NOT NULL, tokens INTEGER NOT NULL, PRIMARY KEY (index_name, name, number))"
+        )
+        self.connection.commit()
+
+    def get(self, name):
+        # Returns the DocumentEntry recorded for name, or None
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT parent_id, file_hash, params FROM documents WHERE index_name = ? AND name = ?",
+                (self.index_name, name),
+            ).fetchone()
+            if row is None:
+                return None
+            pages = self.connection.execute(
+                "SELECT page_hash, chunk_keys, tokens FROM pages WHERE index_name = ? AND name = ? ORDER BY number",
+                (self.index_name, name),
+            ).fetchall()
+        return DocumentEntry(name, row[0], row[1], row[2],
+                             [PageEntry(page_hash, json.loads(keys), tokens) for page_hash, keys, tokens in pages])
+
+    def put(self, entry):
+        with self._lock:
+            self.connection.execute("DELETE FROM pages WHERE index_name = ? AND name = ?", (self.index_name, entry.name))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO documents (index_name, name, parent_id, file_hash, params, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (self.index_name, entry.name, entry.parent_id, entry.file_hash, entry.params, time.time()),
+            )
+            self.connection.executemany(
+                "INSERT INTO pages (index_name, name, number, page_hash, chunk_keys, tokens) VALUES (?, ?, ?, ?, ?, ?)",
+                [(self.index_name, entry.name, number, page.page_hash, json.dumps(page.chunk_keys), page.tokens)
+                 for number, page in enumerate(entry.pages)],
+            )
+            self.connection.commit()
+
+    def forget(self, name):
+        with self._lock:
+            self.connection.execute("DELETE FROM pages WHERE index_name = ? AND name = ?", (self.index_name, name))
+            self.connection.execute("DELETE FROM documents WHERE index_name = ? AND name = ?", (self.index_name, name))
+            self.connection.commit()
+
+    def names(self):
+        with self._lock:
+            rows = self.connection.execute("SELECT name FROM documents WHERE index_name = ?", (self.index_name,)).fetchall()
+        return [row[0] for row in rows]
+
+    def clear(self):
+        with self._lock:
+            self.connection.execute("DELETE FROM pages WHERE index_name = ?", (self.index_name,))
+            self.connection.execute("DELETE FROM documents WHERE index_name = ?", (self.index_name,))
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,231 @@
+# Description: Local vector retrieval over the chunks of the search index, for development, CI and
+# latency-sensitive tools that should not round-trip to Azure AI Search for every question.
+# A store is a directory: the normalized chunk embeddings are one float32 matrix in vectors.f32 that
+# is memory-mapped when the store is opened, the chunk texts are one UTF-8 blob with an offsets
+# array, and chunk_id, parent_id and title are kept in a small JSON side table with the parents
+# deduplicated. Opening a store reads only the side table; the vectors and texts are paged in by the
+# OS as queries touch them.
+# Queries are answered with vectorized dot products over blocks of the matrix (cosine similarity,
+# as the vectors are normalized). With nlist set when the store is written, the vectors are also
+# grouped into a coarse IVF partition by k-means, and a query only scans the nprobe closest lists.
+# Stores are written from the same chunk documents the indexing pipelines produce (chunk_id,
+# parent_id, title, chunk and vector).
+
+import json
+import os
+
+import numpy as np
+
+MANIFEST = "manifest.json"
+VECTORS = "vectors.f32"
+TEXT = "text.bin"
+OFFSETS = "offsets.npy"
+METADATA = "metadata.json"
+CENTROIDS = "centroids.npy"
+LISTS = "lists.npy"
+ROWS = "rows.npy"
+
+# Rows scored per matrix-vector product; bounds the temporary memory of a query
+BLOCK_ROWS = 65536
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def kmeans(vectors, k, iterations=10, sample_size=None, seed=0):
+    # Spherical k-means on a sample of the (normalized) vectors; returns normalized centroids
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), sample_size or k * 256)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), size=sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(sample_size, size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        empty = np.bincount(assignment, minlength=k) == 0
+        # Restart empty lists from random sample points
+        sums[empty] = sample[rng.choice(sample_size, size=int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids
+
+
+def assign_lists(vectors, centroids):
+    assignment = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), BLOCK_ROWS):
+        block = np.asarray(vectors[start:start + BLOCK_ROWS])
+        assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignment
+
+
+class LocalVectorStoreWriter:
+    def __init__(self, path, dimensions=None):
+        os.makedirs(path, exist_ok=True)
+        # The manifest is written last, so a store being rewritten cannot be opened half-written
+        if os.path.exists(os.path.join(path, MANIFEST)):
+            os.remove(os.path.join(path, MANIFEST))
+        self.path = path
+        self.dimensions = dimensions
+        self.count = 0
+        self._vectors = open(os.path.join(path, VECTORS), "wb")
+        self._text = open(os.path.join(path, TEXT), "wb")
+        self._offsets = [0]
+        self._chunk_ids = []
+        self._parent_index = []
+        self._parents = {}
+
+    def add(self, document):
+        vector = np.asarray(document["vector"], dtype=np.float32)
+        if self.dimensions is None:
+            self.dimensions = vector.shape[0]
+        elif vector.shape[0] != self.dimensions:
+            raise ValueError(f"{document['chunk_id']}: expected {self.dimensions} dimensions, got {vector.shape[0]}")
+        self._vectors.write(_normalize(vector).tobytes())
+        data = document["chunk"].encode("utf-8")
+        self._text.write(data)
+        self._offsets.append(self._offsets[-1] + len(data))
+        self._chunk_ids.append(document["chunk_id"])
+        parent = (document.get("parent_id"), document.get("title"))
+        self._parent_index.append(self._parents.setdefault(parent, len(self._parents)))
+        self.count += 1
+
+    def add_many(self, documents):
+        for document in documents:
+            self.add(document)
+
+    def close(self, nlist=None, iterations=10):
+        # nlist builds an IVF partition with that many lists; use about sqrt(count) for large stores
+        self._vectors.close()
+        self._text.close()
+        np.save(os.path.join(self.path, OFFSETS), np.asarray(self._offsets, dtype=np.int64))
+        with open(os.path.join(self.path, METADATA), "w", encoding="utf-8") as f:
+            json.dump({"chunk_id": self._chunk_ids, "parent": self._parent_index, "parents": list(self._parents)}, f)
+        manifest = {"count": self.count, "dimensions": self.dimensions, "nlist": None}
+        if nlist and self.count >= nlist:
+            self._build_lists(nlist, iterations)
+            manifest["nlist"] = nlist
+        with open(os.path.join(self.path, MANIFEST), "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+
+    def _build_lists(self, nlist, iterations):
+        # Sort the vectors by list so every list is one contiguous range of the matrix; rows.npy maps
+        # the sorted positions back to the chunk rows, so the texts and metadata stay in place.
+        vectors_path = os.path.join(self.path, VECTORS)
+        vectors = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(self.count, self.dimensions))
+        centroids = kmeans(vectors, nlist, iterations=iterations)
+        assignment = assign_lists(vectors, centroids)
+        rows = np.argsort(assignment, kind="stable")
+        lists = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=nlist), out=lists[1:])
+        sorted_path = vectors_path + ".tmp"
+        with open(sorted_path, "wb") as f:
+            for start in range(0, self.count, BLOCK_ROWS):
+                f.write(np.ascontiguousarray(vectors[rows[start:start + BLOCK_ROWS]]).tobytes())
+        del vectors
+        os.replace(sorted_path, vectors_path)
+        np.save(os.path.join(self.path, CENTROIDS), centroids)
+        np.save(os.path.join(self.path, LISTS), lists)
+        np.save(os.path.join(self.path, ROWS), rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # Without close() no manifest is written, so an interrupted store cannot be opened
+        self._vectors.close()
+        self._text.close()
+
+
+def write_store(path, documents, nlist=None):
+    with LocalVectorStoreWriter(path) as writer:
+        writer.add_many(documents)
+        writer.close(nlist=nlist)
+    return writer.count
+
+
+class LocalVectorStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST), encoding="utf-8") as f:
+            manifest = json.load(f)
+        self.count = manifest["count"]
+        self.dimensions = manifest["dimensions"]
+        self.nlist = manifest["nlist"]
+        shape = (self.count, self.dimensions)
+        self.vectors = np.memmap(os.path.join(path, VECTORS), dtype=np.float32, mode="r", shape=shape) if self.count else np.zeros((0, 0), np.float32)
+        self.text = np.memmap(os.path.join(path, TEXT), dtype=np.uint8, mode="r") if self.count else b""
+        self.offsets = np.load(os.path.join(path, OFFSETS), mmap_mode="r")
+        with open(os.path.join(path, METADATA), encoding="utf-8") as f:
+            metadata = json.load(f)
+        self.chunk_ids = metadata["chunk_id"]
+        self.parent_index = metadata["parent"]
+        self.parents = metadata["parents"]
+        self.centroids = self.lists = self.rows = None
+        if self.nlist:
+            self.centroids = np.load(os.path.join(path, CENTROIDS))
+            self.lists = np.load(os.path.join(path, LISTS))
+            self.rows = np.load(os.path.join(path, ROWS))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        # Size of the store on disk
+        return sum(entry.stat().st_size for entry in os.scandir(self.path) if entry.is_file())
+
+    def document(self, row, score=None):
+        start, end = self.offsets[row], self.offsets[row + 1]
+        parent_id, title = self.parents[self.parent_index[row]]
+        document = {
+            "chunk_id": self.chunk_ids[row],
+            "parent_id": parent_id,
+            "title": title,
+            "chunk": bytes(self.text[start:end]).decode("utf-8"),
+        }
+        if score is not None:
+            document["score"] = score
+        return document
+
+    def _ranges(self, query, nprobe, k):
+        if self.centroids is None or nprobe >= self.nlist:
+            return [(0, self.count)]
+        similarities = self.centroids @ query
+        probe = np.argpartition(-similarities, nprobe - 1)[:nprobe]
+        ranges = [(int(self.lists[c]), int(self.lists[c + 1])) for c in probe]
+        if sum(end - start for start, end in ranges) >= k:
+            return ranges
+        # The nearest lists hold fewer than k chunks (some lists can be empty): take further lists, nearest first
+        ranges = []
+        rows = 0
+        for c in np.argsort(-similarities):
+            start, end = int(self.lists[c]), int(self.lists[c + 1])
+            if end > start:
+                ranges.append((start, end))
+                rows += end - start
+                if rows >= k:
+                    break
+        return ranges
+
+    def search(self, embedding, k=5, nprobe=8):
+        # Top-k chunks by cosine similarity to embedding, best first, as documents with a score
+        if k < 1 or nprobe < 1:
+            raise ValueError("k and nprobe must be at least 1")
+        if not self.count:
+            return []
+        query = _normalize(np.asarray(embedding, dtype=np.float32))
+        top_scores = []
+        top_positions = []
+        for start, end in self._ranges(query, nprobe, k):
+            for block_start in range(start, end, BLOCK_ROWS):
+                scores = self.vectors[block_start:min(end, block_start + BLOCK_ROWS)] @ query
+                best = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+                top_scores.append(scores[best])
+                top_positions.append(best + block_start)
+        scores = np.concatenate(top_scores)
+        positions = np.concatenate(top_positions)
+        order = np.argsort(-scores)[:k]
+        rows = positions[order] if self.rows is None else self.rows[positions[order]]
+        return [self.document(int(row), float(score)) for row, score in zip(rows, scores[order])]
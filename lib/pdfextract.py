@@ -0,0 +1,100 @@
+# Description: Parallel, streaming PDF text extraction.
+# Pages are extracted in a process pool (pypdf text extraction is CPU bound and holds the GIL) and
+# yielded in page order as soon as each page is ready, so the chunker and the summarization or
+# indexing stages can start before the last page has been parsed.
+# At most `window` pages are being extracted or waiting to be consumed at any time, which bounds the
+# extracted text held in the main process by the window instead of by the size of the document.
+# Each worker process opens a PDF once and keeps its reader while it extracts pages of it. pypdf keeps every
+# page and object a reader has resolved, so the memory of a worker still grows with the pages it has
+# extracted (about 10 KB per text-only page, more with fonts and images). Re-opening the reader to drop
+# them would parse the whole page tree again each time, which made extraction several times slower.
+# PdfPages reads the page count when it is created, with the one reader the main process opens, which
+# also extracts the pages when there is a single worker.
+# A PdfPages starts its own pool, which suits one large document. To extract many documents, create one
+# pool with page_pool() and pass it to every PdfPages, so the workers are started (and pypdf imported in
+# them) once per run instead of once per document. Workers are started with forkserver (spawn where it
+# is not available) rather than forked, as the pool may first be used from a worker thread while the
+# event loop and rate limiter threads are running.
+
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from pypdf import PdfReader
+
+_reader = None
+_reader_path = None
+
+
+def _extract_page(path, page_number):
+    global _reader, _reader_path
+    if _reader_path != path:
+        # The previous document's reader is dropped before the next one is opened
+        _reader, _reader_path = None, None
+        _reader, _reader_path = PdfReader(path), path
+    return _reader.pages[page_number].extract_text() or ""
+
+
+def page_pool(workers=None):
+    # A process pool to share between PdfPages; the caller shuts it down
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        # Workers are forked from a server that has already imported pypdf
+        context.set_forkserver_preload([__name__])
+    else:
+        context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1, mp_context=context)
+
+
+class PdfPages:
+    """The text of every page of the PDF at path, in page order, with page_count known up front.
+
+    Empty pages yield an empty string so the position in the stream is the page number.
+    workers defaults to the number of CPUs and window to twice the number of workers. With more than one
+    worker and a pool (see page_pool), the pages are extracted by the pool, which is left running afterwards.
+    """
+
+    def __init__(self, path, workers=None, window=None, pool=None):
+        self.path = path
+        self.pool = pool
+        self.workers = workers or os.cpu_count() or 1
+        self.window = max(window or self.workers * 2, 1)
+        reader = PdfReader(path)
+        self.page_count = len(reader.pages)
+        # Kept only to extract the pages in this process; pool workers open their own
+        self._reader = reader if self.workers == 1 else None
+
+    def __len__(self):
+        return self.page_count
+
+    def __iter__(self):
+        if self.workers == 1:
+            # Not worth starting a pool. The reader keeps the pages it parsed until it is dropped with the
+            # generator, so they do not outlive the extraction.
+            reader, self._reader = self._reader or PdfReader(self.path), None
+            for page in reader.pages:
+                yield page.extract_text() or ""
+            return
+
+        pool = self.pool or page_pool(self.workers)
+        futures = deque()
+        try:
+            next_page = 0
+            while futures or next_page < self.page_count:
+                while next_page < self.page_count and len(futures) < self.window:
+                    futures.append(pool.submit(_extract_page, self.path, next_page))
+                    next_page += 1
+                yield futures.popleft().result()
+        finally:
+            # Also runs when the consumer stops early; pages not started yet are dropped.
+            if self.pool is None:
+                pool.shutdown(wait=True, cancel_futures=True)
+            else:
+                for future in futures:
+                    future.cancel()
+
+
+def iter_pdf_pages(path, workers=None, window=None, pool=None):
+    # Yield the text of every page of the PDF at path, in page order (see PdfPages)
+    return iter(PdfPages(path, workers=workers, window=window, pool=pool))
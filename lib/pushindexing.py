@@ -0,0 +1,386 @@
+# Description: Client-side (push mode) ingestion into the Azure AI Search index built by lib/common.py.
+# Documents are chunked locally with the streaming token-aware chunker, chunks are embedded in
+# batched Azure OpenAI embedding calls with several requests in flight, and the embedded chunks are
+# uploaded with IndexDocumentsBatch batches bounded by document count and payload size.
+# The stages are connected by bounded queues, so a slow stage (usually the index upload) holds back
+# the stages in front of it instead of letting embedded chunks pile up in memory.
+# This replaces the server-side skillset when chunking has to be controlled or measured locally.
+# Every page, chunk, embedding request and upload batch is a span when tracing is on (lib/tracing.py).
+# IncrementalPush keeps a per-document manifest (lib/indexmanifest.py) of page and chunk hashes: its chunks never cross
+# a page boundary and are keyed by the hash of their text, so a revised document only has the chunks of its changed
+# pages embedded and uploaded, and the chunks that disappeared are deleted from the index.
+
+import asyncio
+import base64
+import os
+import time
+from dataclasses import dataclass, field
+
+from azure.search.documents import IndexDocumentsBatch
+
+from lib.chunking import count_tokens, stream_chunks
+from lib.hashing import file_hash, text_hash
+from lib.indexmanifest import DocumentEntry, PageEntry, params_key
+from lib.pdfextract import iter_pdf_pages
+from lib.tracing import span, traced_iter
+
+# Per-request limits of the index documents API. See
+# https://learn.microsoft.com/azure/search/search-limits-quotas-capacity#document-size-limits-per-api-call
+MAX_UPLOAD_DOCUMENTS = 1000
+MAX_UPLOAD_BYTES = 16 * 1024 * 1024
+
+_END = object()
+
+
+@dataclass
+class PushStats:
+    documents: int = 0
+    chunks: int = 0
+    embedding_tokens: int = 0
+    embedding_requests: int = 0
+    upload_batches: int = 0
+    uploaded: int = 0
+    failed: int = 0
+    stored_locally: int = 0
+    errors: list = field(default_factory=list)
+    failed_keys: set = field(default_factory=set)
+    seconds: float = 0.0
+
+    def report(self):
+        rate = self.chunks / self.seconds if self.seconds else 0.0
+        return (f"Pushed {self.uploaded} of {self.chunks} chunks from {self.documents} documents in {self.seconds:.1f}s "
+                f"({rate:.1f} chunks/s); {self.embedding_requests} embedding requests ({self.embedding_tokens} tokens), "
+                f"{self.upload_batches} upload batches, {self.failed} failed"
+                + (f", {self.stored_locally} stored locally" if self.stored_locally else ""))
+
+
+def document_key(name):
+    # Search keys may only contain letters, digits, '_', '-' and '=', so the name is base64 encoded
+    return base64.urlsafe_b64encode(name.encode("utf-8")).decode("ascii")
+
+
+def iter_document_chunks(files, max_tokens=512, overlap_tokens=128, workers=None, page_window=None, stats=None, pool=None):
+    # files are (local path, document name) pairs, e.g. from aisearchindexer.find_pdfs.
+    # Yields one search document (without its vector) per chunk. Pass one pool (lib.pdfextract.page_pool)
+    # for all the files, or every file starts its own.
+    for file_path, name in files:
+        parent_id = document_key(name)
+        pages = traced_iter(iter_pdf_pages(file_path, workers=workers, window=page_window, pool=pool), "pdf.page", document=name)
+        chunks = stream_chunks((page_text + " " for page_text in pages), max_tokens=max_tokens, overlap_tokens=overlap_tokens)
+        chunks = traced_iter(chunks, "chunk", document=name)
+        for number, chunk in enumerate(chunks):
+            yield {
+                "chunk_id": f"{parent_id}_pages_{number}",
+                "parent_id": parent_id,
+                "title": os.path.basename(name),
+                "chunk": chunk,
+            }
+        if stats is not None:
+            stats.documents += 1
+
+
+def _estimated_size(document):
+    # Close to the JSON size of a document without serializing it: each float is at most ~20
+    # characters and the text may grow slightly when escaped.
+    return len(document["chunk"].encode("utf-8")) * 11 // 10 + len(document.get("vector", ())) * 20 + 512
+
+
+async def push_documents(documents, openai_client, search_client, embedding_deployment, stats=None,
+                         embed_batch_size=16, max_embedding_requests=4, max_upload_documents=MAX_UPLOAD_DOCUMENTS,
+                         max_upload_bytes=MAX_UPLOAD_BYTES, max_uploads_in_flight=2, on_embedded=None):
+    """Embed and upload an iterable of chunk documents; returns PushStats.
+
+    openai_client is an AsyncAzureOpenAI client and search_client an async SearchClient, or None to
+    only embed. on_embedded, if given, is called with every embedded document, e.g. to also write it
+    to a local vector store.
+    """
+    stats = stats or PushStats()
+    start = time.perf_counter()
+    iterator = iter(documents)
+    # Embedded chunks wait here for the uploader; when it is full, embedding stops.
+    upload_queue = asyncio.Queue(maxsize=max_upload_documents * max_uploads_in_flight)
+    embedding_slots = asyncio.Semaphore(max_embedding_requests)
+    upload_slots = asyncio.Semaphore(max_uploads_in_flight)
+
+    async def embed(batch):
+        try:
+            with span("embed", first=batch[0]["chunk_id"]) as embed_span:
+                texts = [document["chunk"] for document in batch]
+                embed_span.add(inputs=len(texts), chars=sum(map(len, texts)))
+                response = await openai_client.embeddings.create(model=embedding_deployment, input=texts)
+                embed_span.usage(response.usage)
+            stats.embedding_requests += 1
+            stats.embedding_tokens += response.usage.total_tokens
+            for document, item in zip(batch, sorted(response.data, key=lambda item: item.index)):
+                document["vector"] = item.embedding
+                if on_embedded is not None:
+                    on_embedded(document)
+                    stats.stored_locally += 1
+                if search_client is not None:
+                    await upload_queue.put(document)
+        except Exception as e:
+            stats.failed += len(batch)
+            stats.failed_keys.update(document["chunk_id"] for document in batch)
+            stats.errors.append(f"embedding {batch[0]['chunk_id']}..: {e}")
+        finally:
+            embedding_slots.release()
+
+    async def upload(batch, batch_bytes, keys):
+        try:
+            with span("upload", documents=len(batch.actions)) as upload_span:
+                upload_span.add(estimated_bytes=batch_bytes)
+                results = await search_client.index_documents(batch)
+            for result in results:
+                if result.succeeded:
+                    stats.uploaded += 1
+                else:
+                    stats.failed += 1
+                    stats.failed_keys.add(result.key)
+                    stats.errors.append(f"{result.key}: {result.error_message}")
+        except Exception as e:
+            stats.failed += len(batch.actions)
+            stats.failed_keys.update(keys)
+            stats.errors.append(f"upload batch: {e}")
+        finally:
+            stats.upload_batches += 1
+            upload_slots.release()
+
+    async def uploader():
+        tasks = set()
+        batch = IndexDocumentsBatch()
+        batch_bytes = 0
+        keys = []
+
+        async def flush():
+            nonlocal batch, batch_bytes, keys
+            await upload_slots.acquire()
+            task = asyncio.create_task(upload(batch, batch_bytes, keys))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            batch, batch_bytes, keys = IndexDocumentsBatch(), 0, []
+
+        while True:
+            document = await upload_queue.get()
+            if document is _END:
+                break
+            size = _estimated_size(document)
+            if batch.actions and (len(batch.actions) >= max_upload_documents or batch_bytes + size > max_upload_bytes):
+                await flush()
+            batch.add_merge_or_upload_actions([document])
+            batch_bytes += size
+            keys.append(document["chunk_id"])
+        if batch.actions:
+            await flush()
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    uploader_task = asyncio.create_task(uploader())
+    embed_tasks = set()
+    try:
+        while True:
+            await embedding_slots.acquire()
+            batch = []
+            while len(batch) < embed_batch_size:
+                document = await asyncio.to_thread(next, iterator, _END)
+                if document is _END:
+                    break
+                batch.append(document)
+            if not batch:
+                embedding_slots.release()
+                break
+            stats.chunks += len(batch)
+            task = asyncio.create_task(embed(batch))
+            embed_tasks.add(task)
+            task.add_done_callback(embed_tasks.discard)
+            if len(batch) < embed_batch_size:
+                break
+        if embed_tasks:
+            await asyncio.gather(*embed_tasks)
+        await upload_queue.put(_END)
+        await uploader_task
+    except BaseException:
+        for task in (*embed_tasks, uploader_task):
+            task.cancel()
+        raise
+    stats.seconds = time.perf_counter() - start
+    return stats
+
+
+async def delete_documents(search_client, keys, stats=None, key_field="chunk_id", batch_size=MAX_UPLOAD_DOCUMENTS):
+    # Deletes the documents with these keys from the index; returns the keys that could not be deleted
+    keys = list(keys)
+    failed = set()
+    for start in range(0, len(keys), batch_size):
+        part = keys[start:start + batch_size]
+        batch = IndexDocumentsBatch()
+        batch.add_delete_actions([{key_field: key} for key in part])
+        try:
+            with span("delete", documents=len(part)):
+                results = await search_client.index_documents(batch)
+            for result in results:
+                if not result.succeeded:
+                    failed.add(result.key)
+                    if stats is not None:
+                        stats.errors.append(f"delete {result.key}: {result.error_message}")
+        except Exception as e:
+            failed.update(part)
+            if stats is not None:
+                stats.errors.append(f"delete batch: {e}")
+    return failed
+
+
+async def indexed_chunk_keys(search_client, parent_id):
+    # Keys of the chunks of one document that are already in the index, whatever pushed them
+    results = await search_client.search(search_text="*", filter=f"parent_id eq '{parent_id}'",
+                                         select=["chunk_id", "parent_id"], top=100000)
+    return {result["chunk_id"] async for result in results if result.get("parent_id") == parent_id}
+
+
+@dataclass
+class IncrementalStats:
+    documents: int = 0
+    unchanged_documents: int = 0
+    pages: int = 0
+    changed_pages: int = 0
+    chunks: int = 0
+    changed_chunks: int = 0
+    reused_chunks: int = 0
+    reused_tokens: int = 0
+    deleted: int = 0
+    delete_failed: int = 0
+    removed_documents: int = 0
+    recorded_documents: int = 0
+
+    def report(self):
+        share = self.reused_chunks / self.chunks if self.chunks else 0.0
+        return (f"Incremental: {self.unchanged_documents} of {self.documents} documents unchanged, "
+                f"{self.changed_pages} of {self.pages} pages changed; {self.changed_chunks} of {self.chunks} chunks new or changed, "
+                f"reused {self.reused_chunks} ({share:.0%}, {self.reused_tokens:,} embedding tokens saved), "
+                f"deleted {self.deleted} stale chunks"
+                + (f", {self.removed_documents} removed documents forgotten" if self.removed_documents else "")
+                + (f", {self.delete_failed} deletes failed" if self.delete_failed else ""))
+
+
+class IncrementalPush:
+    """Incremental push of PDFs against an IndexManifest.
+
+    iter_chunks yields only the chunks whose key the manifest does not know for the document yet, to
+    be passed to push_documents; finish then deletes the chunks that are no longer produced and
+    records the documents whose new chunks were all uploaded. A document with a failed chunk keeps
+    its previous entry, so the next run sends its changes again.
+    """
+
+    def __init__(self, manifest, embedding_deployment, max_tokens=512, overlap_tokens=128, workers=None, page_window=None,
+                 pool=None):
+        self.manifest = manifest
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.workers = workers
+        self.page_window = page_window
+        self.pool = pool
+        self.params = params_key(chunking="page", max_tokens=max_tokens, overlap_tokens=overlap_tokens,
+                                 embedding_deployment=embedding_deployment)
+        self.stats = IncrementalStats()
+        self.names = set()
+        # (new DocumentEntry, previous DocumentEntry or None) of every changed document
+        self.updates = []
+
+    def iter_chunks(self, files, stats=None):
+        incremental = self.stats
+        for file_path, name in files:
+            self.names.add(name)
+            incremental.documents += 1
+            if stats is not None:
+                stats.documents += 1
+            digest = file_hash(file_path)
+            previous = self.manifest.get(name)
+            current = previous is not None and previous.params == self.params
+            if current and previous.file_hash == digest:
+                keys = previous.chunk_keys
+                incremental.unchanged_documents += 1
+                incremental.pages += len(previous.pages)
+                incremental.chunks += len(keys)
+                incremental.reused_chunks += len(keys)
+                incremental.reused_tokens += previous.tokens
+                continue
+            # With other parameters every chunk is embedded again, but the previous keys are still deleted
+            reusable = previous.page_index() if current else {}
+            known = set(previous.chunk_keys) if current else set()
+            parent_id = document_key(name)
+            entry = DocumentEntry(name, parent_id, digest, self.params)
+            pages = traced_iter(iter_pdf_pages(file_path, workers=self.workers, window=self.page_window, pool=self.pool), "pdf.page", document=name)
+            for page_text in pages:
+                page_hash = text_hash(page_text)
+                incremental.pages += 1
+                page = reusable.get(page_hash)
+                if page is not None:
+                    entry.pages.append(page)
+                    incremental.chunks += len(page.chunk_keys)
+                    incremental.reused_chunks += len(page.chunk_keys)
+                    incremental.reused_tokens += page.tokens
+                    known.update(page.chunk_keys)
+                    continue
+                incremental.changed_pages += 1
+                page = PageEntry(page_hash, [])
+                chunks = stream_chunks([page_text], max_tokens=self.max_tokens, overlap_tokens=self.overlap_tokens)
+                for chunk in traced_iter(chunks, "chunk", document=name):
+                    key = f"{parent_id}_{text_hash(chunk)[:32]}"
+                    tokens = count_tokens(chunk)
+                    page.chunk_keys.append(key)
+                    page.tokens += tokens
+                    incremental.chunks += 1
+                    if key in known:
+                        incremental.reused_chunks += 1
+                        incremental.reused_tokens += tokens
+                        continue
+                    known.add(key)
+                    incremental.changed_chunks += 1
+                    yield {
+                        "chunk_id": key,
+                        "parent_id": parent_id,
+                        "title": os.path.basename(name),
+                        "chunk": chunk,
+                    }
+                entry.pages.append(page)
+            self.updates.append((entry, previous))
+
+    async def finish(self, search_client, stats, prune=False, max_lookups=8):
+        # Deletes the stale chunks of the changed documents (and, with prune, all chunks of the documents that were
+        # not among the files) and records the changed documents in the manifest
+        incremental = self.stats
+        lookup_slots = asyncio.Semaphore(max_lookups)
+
+        async def stale_keys(entry, previous):
+            if previous is not None:
+                return previous.chunk_keys - entry.chunk_keys
+            # A document the manifest does not know yet may have been pushed without --incremental or by an
+            # earlier manifest, under other keys
+            async with lookup_slots:
+                try:
+                    return await indexed_chunk_keys(search_client, entry.parent_id) - entry.chunk_keys
+                except Exception as e:
+                    stats.errors.append(f"listing chunks of {entry.name}: {e}")
+                    return None
+
+        updates = [(entry, previous) for entry, previous in self.updates if not entry.chunk_keys & stats.failed_keys]
+        stale = await asyncio.gather(*(stale_keys(entry, previous) for entry, previous in updates))
+        removed = []
+        if prune:
+            for name in self.manifest.names():
+                if name not in self.names:
+                    removed.append((name, self.manifest.get(name).chunk_keys))
+        keys = set()
+        for entry_keys in (*stale, *(removed_keys for _, removed_keys in removed)):
+            keys.update(entry_keys or ())
+        failed = await delete_documents(search_client, keys, stats=stats) if keys else set()
+        incremental.deleted += len(keys) - len(failed)
+        incremental.delete_failed += len(failed)
+        for (entry, _), entry_stale in zip(updates, stale):
+            if entry_stale is not None and not entry_stale & failed:
+                self.manifest.put(entry)
+                incremental.recorded_documents += 1
+        for name, removed_keys in removed:
+            if not removed_keys & failed:
+                self.manifest.forget(name)
+                incremental.removed_documents += 1
+        return incremental
@@ -0,0 +1,422 @@
+# Description: Adaptive rate limiting and retries shared by the Azure clients the scripts create.
+# An AdaptiveLimiter caps the requests in flight to one service and adjusts the cap AIMD-style:
+# every successful response adds 1/limit (about +1 per round of requests), and a throttled response
+# (429, or 503 with Retry-After) halves it. Like TCP, the cap is only cut again for throttles of
+# requests sent after the previous cut, so a burst of throttles from requests that were already in
+# flight counts once. Retry-After pauses every request to the service, not only the throttled one.
+# The cap also stops growing while the x-ratelimit-remaining-* headers of Azure OpenAI say the quota
+# is nearly used.
+# Throttled and transient failures (408, 429, 5xx and connection errors) are retried with jittered
+# exponential backoff, or after Retry-After when the service sends it.
+# The limiter is applied through AdaptiveRetryPolicy / AsyncAdaptiveRetryPolicy for azure-core clients
+# (Search, Language, Agents; see azure_client_kwargs, and Blob; see storage_client_kwargs) and through RateLimitedTransport /
+# AsyncRateLimitedTransport for the httpx clients of the openai SDK (see openai_http_client). The
+# clients' own retries are turned off so requests are not retried twice.
+# The in-flight slot of a request is released however the request ends, including cancellation and
+# errors that are not retried, since a lost slot would stall the limiter for the rest of the process.
+# Limiters are shared per service name within the process and count requests, throttles, retries,
+# failures and the effective request rate.
+# With tracing on (lib/tracing.py) every request, including its retries, is an "http.<service>" span
+# with the request and response sizes, the final status and the number of retries.
+
+import asyncio
+import email.utils
+import random
+import threading
+import time
+
+from urllib.parse import urlsplit
+
+import httpx
+from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+from azure.core.pipeline.policies import AsyncHTTPPolicy, HTTPPolicy
+
+from lib.tracing import span
+
+RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def _header_float(headers, name):
+    value = headers.get(name)
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def retry_after_seconds(headers):
+    for name, scale in (("retry-after-ms", 0.001), ("x-ms-retry-after-ms", 0.001)):
+        value = _header_float(headers, name)
+        if value is not None:
+            return value * scale
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        # Retry-After may also be an HTTP date
+        parsed = email.utils.parsedate_to_datetime(value)
+        return max(0.0, parsed.timestamp() - time.time()) if parsed else None
+
+
+class AdaptiveLimiter:
+    def __init__(self, name, initial=8, minimum=1, maximum=64, increase=1.0, decrease=0.5, max_retries=6,
+                 base_delay=0.5, max_delay=60.0, min_remaining_tokens=1000):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.min_remaining_tokens = min_remaining_tokens
+        self.in_flight = 0
+        self.requests = 0
+        self.successes = 0
+        self.throttles = 0
+        self.retries = 0
+        self.errors = 0
+        self.failures = 0
+        self.peak_limit = self.limit
+        self._first_request = None
+        self._last_response = None
+        self._decreased_at = 0
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._async_waiters = []
+
+    def _slots(self):
+        return max(self.minimum, int(self.limit))
+
+    def _try_acquire(self):
+        # Called with the lock held; returns seconds to wait, or the request's sequence number when a slot was taken
+        wait = self._paused_until - time.monotonic()
+        if wait > 0:
+            return wait
+        if self.in_flight < self._slots():
+            self.in_flight += 1
+            self.requests += 1
+            if self._first_request is None:
+                self._first_request = time.monotonic()
+            return -self.requests
+        return 0.0
+
+    def acquire(self):
+        # Waits for a slot; returns a ticket to pass to on_response
+        with self._condition:
+            while True:
+                wait = self._try_acquire()
+                if wait < 0:
+                    return -wait
+                self._condition.wait(wait or None)
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                wait = self._try_acquire()
+                if wait < 0:
+                    return -wait
+                if not wait:
+                    future = loop.create_future()
+                    self._async_waiters.append((loop, future))
+            if wait:
+                await asyncio.sleep(wait)
+            else:
+                await future
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._wake()
+
+    def _wake(self):
+        # Called with the lock held; every waiter checks again whether it can go
+        self._condition.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(None))
+
+    def backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(self.max_delay, retry_after) + random.uniform(0, self.base_delay)
+        # Full jitter: a random delay up to the exponential backoff
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def on_response(self, status, headers, attempt, ticket=None):
+        # Updates the limit from a response to the request acquire() returned ticket for;
+        # returns the delay before a retry, or None not to retry
+        now = time.monotonic()
+        retry_after = retry_after_seconds(headers)
+        with self._condition:
+            self._last_response = now
+            if status == 429 or (status == 503 and retry_after is not None):
+                self.throttles += 1
+                if ticket is None or ticket > self._decreased_at:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._decreased_at = self.requests
+                if retry_after:
+                    self._paused_until = max(self._paused_until, now + retry_after)
+            elif status < 400:
+                self.successes += 1
+                remaining_requests = _header_float(headers, "x-ratelimit-remaining-requests")
+                remaining_tokens = _header_float(headers, "x-ratelimit-remaining-tokens")
+                near_quota = ((remaining_requests is not None and remaining_requests <= self.in_flight)
+                              or (remaining_tokens is not None and remaining_tokens < self.min_remaining_tokens))
+                if not near_quota:
+                    self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+                    self.peak_limit = max(self.peak_limit, self.limit)
+                    self._wake()
+            if status not in RETRY_STATUSES:
+                return None
+            if attempt >= self.max_retries:
+                self.failures += 1
+                return None
+            self.retries += 1
+        return self.backoff(attempt, retry_after)
+
+    def on_error(self, attempt):
+        # Connection errors and timeouts; returns the delay before a retry, or None to raise
+        with self._lock:
+            self.errors += 1
+            if attempt >= self.max_retries:
+                self.failures += 1
+                return None
+            self.retries += 1
+        return self.backoff(attempt)
+
+    def counters(self):
+        elapsed = (self._last_response or 0) - (self._first_request or 0)
+        return {
+            "requests": self.requests,
+            "successes": self.successes,
+            "throttles": self.throttles,
+            "retries": self.retries,
+            "errors": self.errors,
+            "failures": self.failures,
+            "limit": round(self.limit, 2),
+            "peak_limit": round(self.peak_limit, 2),
+            "per_second": self.successes / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def report(self):
+        c = self.counters()
+        return (f"{self.name}: {c['requests']} requests, {c['throttles']} throttled, {c['retries']} retries, "
+                f"{c['errors']} connection errors, {c['failures']} failed; concurrency {c['limit']:.1f} "
+                f"(peak {c['peak_limit']:.1f}), {c['per_second']:.2f} successful requests/s")
+
+
+def get_limiter(name, **kwargs):
+    # One limiter per service name; kwargs only apply when the limiter is created
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = AdaptiveLimiter(name, **kwargs)
+        return _limiters[name]
+
+
+def limiter_reports():
+    with _limiters_lock:
+        return [limiter.report() for limiter in _limiters.values() if limiter.requests]
+
+
+def _rewind(request):
+    # Request bodies that are streams, e.g. blob uploads, must be sent again from the same position
+    body = request.body
+    if hasattr(body, "seek") and hasattr(body, "tell"):
+        position = body.tell()
+        return lambda: body.seek(position)
+    return lambda: None
+
+
+def _request_span(limiter, method, url, headers):
+    request_span = span(f"http.{limiter.name}")
+    if request_span.recording:
+        request_span.set(method=method, path=urlsplit(str(url)).path)
+        request_span.add(request_bytes=int(headers.get("Content-Length") or 0))
+    return request_span
+
+
+def _end_request_span(request_span, status, headers, attempt):
+    if request_span.recording:
+        request_span.set(status=status)
+        request_span.add(response_bytes=int(headers.get("Content-Length") or 0), retries=attempt)
+
+
+class AdaptiveRetryPolicy(HTTPPolicy):
+    def __init__(self, limiter):
+        super().__init__()
+        self.limiter = limiter
+
+    def send(self, request):
+        http_request = request.http_request
+        rewind = _rewind(http_request)
+        attempt = 0
+        with _request_span(self.limiter, http_request.method, http_request.url, http_request.headers) as request_span:
+            while True:
+                ticket = self.limiter.acquire()
+                try:
+                    try:
+                        response = self.next.send(request)
+                    finally:
+                        self.limiter.release()
+                except (ServiceRequestError, ServiceResponseError):
+                    delay = self.limiter.on_error(attempt)
+                    if delay is None:
+                        raise
+                else:
+                    http_response = response.http_response
+                    delay = self.limiter.on_response(http_response.status_code, http_response.headers, attempt, ticket)
+                    if delay is None:
+                        _end_request_span(request_span, http_response.status_code, http_response.headers, attempt)
+                        return response
+                time.sleep(delay)
+                rewind()
+                attempt += 1
+
+
+class AsyncAdaptiveRetryPolicy(AsyncHTTPPolicy):
+    def __init__(self, limiter):
+        super().__init__()
+        self.limiter = limiter
+
+    async def send(self, request):
+        http_request = request.http_request
+        rewind = _rewind(http_request)
+        attempt = 0
+        with _request_span(self.limiter, http_request.method, http_request.url, http_request.headers) as request_span:
+            while True:
+                ticket = await self.limiter.acquire_async()
+                try:
+                    try:
+                        response = await self.next.send(request)
+                    finally:
+                        self.limiter.release()
+                except (ServiceRequestError, ServiceResponseError):
+                    delay = self.limiter.on_error(attempt)
+                    if delay is None:
+                        raise
+                else:
+                    http_response = response.http_response
+                    delay = self.limiter.on_response(http_response.status_code, http_response.headers, attempt, ticket)
+                    if delay is None:
+                        _end_request_span(request_span, http_response.status_code, http_response.headers, attempt)
+                        return response
+                await asyncio.sleep(delay)
+                rewind()
+                attempt += 1
+
+
+class StorageAdaptiveRetryPolicy(AdaptiveRetryPolicy):
+    # Takes the place of the storage SDK's retry policy, so it also consumes the retry options the storage
+    # pipeline leaves in the request context for it and sets the location mode its responses are read with
+    STORAGE_RETRY_OPTIONS = ("retry_total", "retry_connect", "retry_read", "retry_status", "retry_to_secondary",
+                             "hosts", "retry_hook")
+
+    def send(self, request):
+        options = request.context.options
+        for option in self.STORAGE_RETRY_OPTIONS:
+            options.pop(option, None)
+        location_mode = options.pop("location_mode", None) or "primary"
+        response = super().send(request)
+        response.http_response.location_mode = location_mode
+        return response
+
+
+def azure_client_kwargs(name, **limiter_kwargs):
+    # Keyword arguments for a sync azure-core client (SearchClient, BlobServiceClient, AIProjectClient, ...)
+    return {"per_call_policies": [AdaptiveRetryPolicy(get_limiter(name, **limiter_kwargs))], "retry_total": 0}
+
+
+def async_azure_client_kwargs(name, **limiter_kwargs):
+    return {"per_call_policies": [AsyncAdaptiveRetryPolicy(get_limiter(name, **limiter_kwargs))], "retry_total": 0}
+
+
+def storage_client_kwargs(name, **limiter_kwargs):
+    # Storage clients (BlobServiceClient) build their own pipeline without per_call_policies; the policy
+    # takes the place of their retry policy instead, in front of the request signing
+    return {"retry_policy": StorageAdaptiveRetryPolicy(get_limiter(name, **limiter_kwargs))}
+
+
+class RateLimitedTransport(httpx.BaseTransport):
+    def __init__(self, limiter, transport=None):
+        self.limiter = limiter
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request):
+        attempt = 0
+        with _request_span(self.limiter, request.method, request.url, request.headers) as request_span:
+            while True:
+                ticket = self.limiter.acquire()
+                try:
+                    try:
+                        response = self.transport.handle_request(request)
+                    finally:
+                        self.limiter.release()
+                except httpx.TransportError:
+                    delay = self.limiter.on_error(attempt)
+                    if delay is None:
+                        raise
+                else:
+                    delay = self.limiter.on_response(response.status_code, response.headers, attempt, ticket)
+                    if delay is None:
+                        _end_request_span(request_span, response.status_code, response.headers, attempt)
+                        return response
+                    response.close()
+                time.sleep(delay)
+                attempt += 1
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncRateLimitedTransport(httpx.AsyncBaseTransport):
+    def __init__(self, limiter, transport=None):
+        self.limiter = limiter
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request):
+        attempt = 0
+        with _request_span(self.limiter, request.method, request.url, request.headers) as request_span:
+            while True:
+                ticket = await self.limiter.acquire_async()
+                try:
+                    try:
+                        response = await self.transport.handle_async_request(request)
+                    finally:
+                        self.limiter.release()
+                except httpx.TransportError:
+                    delay = self.limiter.on_error(attempt)
+                    if delay is None:
+                        raise
+                else:
+                    delay = self.limiter.on_response(response.status_code, response.headers, attempt, ticket)
+                    if delay is None:
+                        _end_request_span(request_span, response.status_code, response.headers, attempt)
+                        return response
+                    await response.aclose()
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def openai_http_client(name="openai", limits=None, timeout=None, **limiter_kwargs):
+    # httpx.Client for openai.AzureOpenAI(http_client=..., max_retries=0)
+    transport = httpx.HTTPTransport(limits=limits) if limits else httpx.HTTPTransport()
+    return httpx.Client(transport=RateLimitedTransport(get_limiter(name, **limiter_kwargs), transport),
+                        timeout=timeout or httpx.Timeout(120.0, connect=10.0))
+
+
+def async_openai_http_client(name="openai", limits=None, timeout=None, **limiter_kwargs):
+    # httpx.AsyncClient for openai.AsyncAzureOpenAI(http_client=..., max_retries=0)
+    transport = httpx.AsyncHTTPTransport(limits=limits) if limits else httpx.AsyncHTTPTransport()
+    return httpx.AsyncClient(transport=AsyncRateLimitedTransport(get_limiter(name, **limiter_kwargs), transport),
+                             timeout=timeout or httpx.Timeout(120.0, connect=10.0))
@@ -0,0 +1,92 @@
+# Description: Semantic Kernel plugin that lets the model query the Azure AI Search index built by lib/common.py.
+# Each search is a hybrid query: the keyword query and a vector query that the index vectorizer embeds
+# from the same text, so no embedding call is made by the client. Only the selected fields are
+# returned, and each result's content is cut to max_content_chars to keep tool results small.
+# The function is async and uses the async SearchClient, so when the model asks for several searches
+# in one turn Semantic Kernel runs them concurrently. Results are kept in a small in-process cache for
+# ttl_seconds, and concurrent calls for the same query share one request. Every request to the index
+# is a "retrieve" span when tracing is on (lib/tracing.py).
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Annotated
+
+from azure.search.documents.models import VectorizableTextQuery
+from semantic_kernel.functions import kernel_function
+
+from lib.tracing import span
+
+
+class SearchPlugin:
+    def __init__(self, search_client, top_k=5, select=("title", "chunk"), content_field="chunk",
+                 vector_field="vector", max_content_chars=1500, ttl_seconds=300, max_cache_entries=256):
+        # search_client is an azure.search.documents.aio.SearchClient
+        self.search_client = search_client
+        self.top_k = top_k
+        self.select = list(select)
+        self.content_field = content_field
+        self.vector_field = vector_field
+        self.max_content_chars = max_content_chars
+        self.ttl_seconds = ttl_seconds
+        self.max_cache_entries = max_cache_entries
+        self._cache = OrderedDict()
+        self._in_flight = {}
+        self.searches = 0
+        self.cache_hits = 0
+        self.search_seconds = 0.0
+
+    @kernel_function(name="search", description="Search the document index and return the most relevant passages.")
+    async def search(
+        self,
+        query: Annotated[str, "What to search for, as a short natural language query"],
+        top: Annotated[int | None, "Number of passages to return"] = None,
+    ) -> Annotated[str, "Numbered passages with their titles"]:
+        # top comes from the model, so it is kept between 1 and twice the configured number
+        top = max(1, min(top or self.top_k, self.top_k * 2))
+        key = (query.strip().lower(), top)
+        entry = self._cache.get(key)
+        if entry is not None and time.monotonic() - entry[1] <= self.ttl_seconds:
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+            return entry[0]
+
+        # Concurrent calls for the same query wait for the request that is already running
+        if key in self._in_flight:
+            self.cache_hits += 1
+            return await asyncio.shield(self._in_flight[key])
+        task = asyncio.ensure_future(self._search(query, top))
+        self._in_flight[key] = task
+        try:
+            result = await task
+        finally:
+            del self._in_flight[key]
+        self._cache[key] = (result, time.monotonic())
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_cache_entries:
+            self._cache.popitem(last=False)
+        return result
+
+    async def _search(self, query, top):
+        start = time.perf_counter()
+        with span("retrieve", source="search", top=top) as retrieve_span:
+            results = await self.search_client.search(
+                search_text=query,
+                vector_queries=[VectorizableTextQuery(text=query, k_nearest_neighbors=top, fields=self.vector_field)],
+                select=self.select,
+                top=top,
+            )
+            passages = []
+            async for result in results:
+                content = (result.get(self.content_field) or "")[:self.max_content_chars]
+                fields = ", ".join(f"{name}: {result[name]}" for name in self.select
+                                   if name != self.content_field and result.get(name))
+                passages.append(f"[{len(passages) + 1}] {fields}\n{content}")
+            retrieve_span.add(passages=len(passages))
+        self.searches += 1
+        self.search_seconds += time.perf_counter() - start
+        return "\n\n".join(passages) if passages else "No results."
+
+    def report(self):
+        return (f"Search plugin: {self.searches} searches ({self.search_seconds:.1f}s), "
+                f"{self.cache_hits} answered from the cache")
@@ -0,0 +1,35 @@
+# Description: Small helpers for summarizing latency measurements in the scripts and benchmarks.
+
+import math
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+
+def latency_summary(latencies, elapsed=None):
+    # latencies in seconds; elapsed is the wall time the requests ran in, used for the request rate
+    values = sorted(latencies)
+    summary = {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else 0.0,
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": values[-1] if values else 0.0,
+    }
+    if elapsed:
+        summary["per_second"] = len(values) / elapsed
+    return summary
+
+
+def format_latency_summary(summary, unit="requests"):
+    line = (f"{summary['count']} {unit}: p50 {summary['p50'] * 1000:.0f} ms, p95 {summary['p95'] * 1000:.0f} ms, "
+            f"p99 {summary['p99'] * 1000:.0f} ms, max {summary['max'] * 1000:.0f} ms")
+    if "per_second" in summary:
+        line += f", {summary['per_second']:.2f} {unit}/s"
+    return line
@@ -0,0 +1,254 @@
+# Description: Concurrent abstractive summarization on top of the async Azure AI Language TextAnalyticsClient.
+# Chunks are packed into multi-document requests (up to the service's per-request document and
+# character limits) and a bounded number of long-running operations are kept in flight at once.
+# Chunks are pulled from the input iterable on a worker thread, so a lazy producer such as the
+# streaming chunker keeps running while earlier batches are being summarized, and the in-flight
+# bound also limits how far ahead of the service the producer can get.
+# Results are returned in chunk order, and a failure in one chunk is recorded on its result without
+# discarding the rest: when a whole request fails for a reason other than throttling or an outage
+# (which the rate limiter already retried), the batch is split in halves and each half is sent again,
+# so a chunk the service rejects only fails itself.
+# reduce_summaries builds a map-reduce summary tree over the chunk summaries: each level groups the
+# summaries by token budget and fan-in and summarizes the groups in parallel, until one is left.
+# With a SummaryCache (lib/summarycache.py) attached, chunks summarized by an earlier run are
+# answered from the cache and only the remaining chunks are sent to the service.
+# Every summarization job and reduce level is a span when tracing is on (lib/tracing.py).
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+
+from lib.chunking import count_tokens
+from lib.ratelimit import RETRY_STATUSES
+from lib.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Per-request limits for analyze-text jobs. See
+# https://learn.microsoft.com/azure/ai-services/language-service/concepts/data-limits
+MAX_DOCUMENTS_PER_REQUEST = 25
+MAX_CHARACTERS_PER_REQUEST = 125000
+
+_END = object()
+
+
+def _is_transient(error):
+    # Throttling, outages and connection failures: sending smaller requests would not help
+    return (getattr(error, "status_code", None) in RETRY_STATUSES
+            or isinstance(error, (ServiceRequestError, ServiceResponseError, asyncio.TimeoutError)))
+
+
+@dataclass
+class ChunkSummary:
+    index: int
+    text: str = ""
+    error: Optional[str] = None
+    cached: bool = False
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class SummarizationEngine:
+    def __init__(self, client, batch_size=MAX_DOCUMENTS_PER_REQUEST, max_batch_chars=MAX_CHARACTERS_PER_REQUEST,
+                 max_in_flight=4, language="en", cache=None):
+        if not 1 <= batch_size <= MAX_DOCUMENTS_PER_REQUEST:
+            raise ValueError(f"batch_size must be between 1 and {MAX_DOCUMENTS_PER_REQUEST}")
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        self.client = client
+        self.batch_size = batch_size
+        self.max_batch_chars = max_batch_chars
+        self.max_in_flight = max_in_flight
+        self.language = language
+        self.cache = cache
+        self.requests = 0
+        self.split_batches = 0
+
+    async def summarize(self, chunks, sentence_count=None):
+        """Summarize every chunk and return a ChunkSummary per chunk, in chunk order."""
+        results = {}
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        tasks = set()
+        iterator = iter(chunks)
+        try:
+            await self._dispatch(iterator, results, in_flight, tasks, sentence_count)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        if tasks:
+            await asyncio.gather(*tasks)
+        return [results[i] for i in range(len(results))]
+
+    async def _dispatch(self, iterator, results, in_flight, tasks, sentence_count):
+        index = 0
+        pending = None
+
+        async def next_chunk():
+            return await asyncio.to_thread(next, iterator, _END)
+
+        while True:
+            # Wait for a free slot before pulling more chunks, so a fast producer is held back
+            # while the service is busy.
+            await in_flight.acquire()
+            batch = []
+            batch_chars = 0
+            if pending is not None:
+                batch.append(pending)
+                batch_chars = len(pending[1])
+                pending = None
+            exhausted = False
+            while len(batch) < self.batch_size:
+                chunk = await next_chunk()
+                if chunk is _END:
+                    exhausted = True
+                    break
+                key = None
+                if self.cache is not None:
+                    key = self.cache.key(chunk, self._cache_params(sentence_count))
+                    cached = self.cache.get(key)
+                    if cached is not None:
+                        results[index] = ChunkSummary(index, text=cached, cached=True)
+                        index += 1
+                        continue
+                item = (index, chunk, key)
+                index += 1
+                if batch and batch_chars + len(chunk) > self.max_batch_chars:
+                    pending = item
+                    break
+                batch.append(item)
+                batch_chars += len(chunk)
+            if batch:
+                task = asyncio.create_task(self._run_batch(batch, sentence_count, results, in_flight))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            else:
+                in_flight.release()
+            if exhausted and pending is None:
+                break
+
+    def _cache_params(self, sentence_count):
+        return {"task": "abstractive_summary", "language": self.language, "sentence_count": sentence_count}
+
+    async def _run_batch(self, batch, sentence_count, results, in_flight):
+        try:
+            await self._summarize_batch(batch, sentence_count, results)
+        finally:
+            for i, _, _ in batch:
+                results.setdefault(i, ChunkSummary(i, error="no result returned by the service"))
+            in_flight.release()
+
+    async def _summarize_batch(self, batch, sentence_count, results):
+        try:
+            await self._request(batch, sentence_count, results)
+        except Exception as e:
+            # Retry the chunks without a result in two halves, one after the other so the batch keeps its single
+            # in-flight slot, until the chunk that fails the request is on its own
+            remaining = [item for item in batch if item[0] not in results]
+            if len(remaining) > 1 and not _is_transient(e):
+                self.split_batches += 1
+                middle = len(remaining) // 2
+                await self._summarize_batch(remaining[:middle], sentence_count, results)
+                await self._summarize_batch(remaining[middle:], sentence_count, results)
+                return
+            for i, _, _ in remaining:
+                results[i] = ChunkSummary(i, error=str(e))
+
+    async def _request(self, batch, sentence_count, results):
+        start = time.perf_counter()
+        documents = [{"id": str(i), "text": chunk, "language": self.language} for i, chunk, _ in batch]
+        keys = {i: key for i, _, key in batch}
+        self.requests += 1
+        with span("summarize", first=batch[0][0]) as summarize_span:
+            summarize_span.add(documents=len(documents), chars=sum(len(chunk) for _, chunk, _ in batch))
+            poller = await self.client.begin_abstract_summary(documents, sentence_count=sentence_count)
+            pages = await poller.result()
+            summaries = []
+            async for result in pages:
+                i = int(result.id)
+                if result.is_error:
+                    results[i] = ChunkSummary(i, error=f"{result.error.code}: {result.error.message}")
+                else:
+                    results[i] = ChunkSummary(i, text=" ".join(summary.text for summary in result.summaries))
+                    summaries.append(results[i])
+        if self.cache is not None:
+            # Store every summary of the batch right away so an interrupted run can resume.
+            seconds = (time.perf_counter() - start) / len(batch)
+            for summary in summaries:
+                self.cache.put(keys[summary.index], summary.text, seconds)
+
+
+@dataclass
+class ReduceLevel:
+    level: int
+    inputs: int
+    groups: int
+    failed_groups: int
+    seconds: float
+
+
+def group_by_budget(texts, max_group_tokens, fan_in, encoding=None):
+    # Packs consecutive texts into groups of at most fan_in texts and max_group_tokens tokens.
+    # A single text over the budget gets a group of its own.
+    groups = []
+    current = []
+    current_tokens = 0
+    for text in texts:
+        tokens = count_tokens(text, encoding)
+        if current and (len(current) == fan_in or current_tokens + tokens > max_group_tokens):
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(text)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+async def reduce_summaries(engine, summaries, max_group_tokens=6000, fan_in=10, max_depth=5,
+                           sentence_count=10, level_sentence_count=None, encoding=None):
+    """Summarize a list of summaries into one by repeatedly summarizing groups of them.
+
+    Each level packs the current summaries into groups bounded by fan_in and max_group_tokens and
+    summarizes all groups of the level in parallel. The level that is left with a single group uses
+    sentence_count, earlier levels use level_sentence_count. Groups that fail are carried to the
+    next level unchanged. Returns the final text and a ReduceLevel per level; if max_depth levels
+    are not enough the remaining summaries are joined and returned, with a warning.
+    """
+    if fan_in < 2:
+        raise ValueError("fan_in must be at least 2")
+    texts = [text for text in summaries if text]
+    levels = []
+    for level in range(1, max_depth + 1):
+        if not texts:
+            break
+        groups = group_by_budget(texts, max_group_tokens, fan_in, encoding)
+        final = len(groups) == 1
+        start = time.perf_counter()
+        with span("summarize.reduce", level=level, inputs=len(texts), groups=len(groups)):
+            results = await engine.summarize(
+                ["\n\n".join(group) for group in groups],
+                sentence_count=sentence_count if final else level_sentence_count,
+            )
+        next_texts = []
+        failed = 0
+        for group, result in zip(groups, results):
+            if result.ok:
+                next_texts.append(result.text)
+            else:
+                failed += 1
+                next_texts.extend(group)
+        levels.append(ReduceLevel(level, len(texts), len(groups), failed, time.perf_counter() - start))
+        texts = next_texts
+        if final and not failed:
+            break
+    if len(texts) > 1:
+        logger.warning("Reduce stopped after %d levels (max_depth) with %d summaries left; they are joined "
+                       "instead of summarized into one", len(levels), len(texts))
+    return "\n\n".join(texts), levels
@@ -0,0 +1,87 @@
+# Description: Content-addressed on-disk cache for summaries, stored in SQLite.
+# Entries are keyed by a SHA-256 hash of the summarization parameters and the text that was
+# summarized, so an unchanged chunk of a revised document is found again however its position in
+# the document moved, and changing a parameter such as sentence_count never returns a stale summary.
+# Every summary is committed as soon as it is stored, which makes an interrupted or throttled run
+# resumable: the next run only sends the chunks that were not summarized yet.
+# Entries older than max_age_days are dropped, and the least recently used entries are dropped once
+# the stored summaries exceed max_mb. The cache also counts hits and misses and adds up the
+# service time that the hits saved.
+
+import hashlib
+import json
+import sqlite3
+import time
+
+DEFAULT_CACHE_PATH = ".summary_cache.sqlite"
+
+
+class SummaryCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_mb=256, max_age_days=30):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS summaries ("
+            "key TEXT PRIMARY KEY, summary TEXT NOT NULL, seconds REAL NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS summaries_last_used ON summaries (last_used)")
+        self.connection.commit()
+        self.evict()
+
+    @staticmethod
+    def key(text, params):
+        digest = hashlib.sha256()
+        digest.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        row = self.connection.execute("SELECT summary, seconds FROM summaries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.seconds_saved += row[1]
+        self.connection.execute("UPDATE summaries SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.connection.commit()
+        return row[0]
+
+    def put(self, key, summary, seconds):
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO summaries (key, summary, seconds, size, created_at, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (key, summary, seconds, len(summary.encode("utf-8")), now, now),
+        )
+        self.connection.commit()
+
+    def evict(self):
+        # Drop expired entries, then the least recently used ones until the total size fits.
+        self.connection.execute("DELETE FROM summaries WHERE created_at < ?", (time.time() - self.max_age_seconds,))
+        self.connection.execute(
+            "DELETE FROM summaries WHERE key IN ("
+            "SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS running FROM summaries) "
+            "WHERE running > ?)",
+            (self.max_bytes,),
+        )
+        self.connection.commit()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def report(self):
+        return (f"Summary cache: {self.hits} hits, {self.misses} misses ({self.hit_rate:.0%} hit rate), "
+                f"{self.seconds_saved:.1f}s of summarization time saved")
+
+    def close(self):
+        self.evict()
+        self.connection.close()
@@ -0,0 +1,373 @@
+# Description: Lightweight tracing of the pipeline stages and the logging setup shared by the scripts.
+# A span times one stage (PDF page, chunk, embed, upload, summarize, retrieve, complete, agent run, and
+# every HTTP request sent through lib/ratelimit.py) and carries attributes such as request sizes and
+# the token usage of the response. The current span is kept in a contextvar, so spans opened in
+# asyncio tasks and asyncio.to_thread calls nest under the span that started them; work submitted to
+# a thread pool is attached to it with bind().
+# Tracing is off unless configure() is called (--trace FILE in the scripts, or TRACE_FILE). While it
+# is off span() returns one shared no-op span, so an instrumented call costs a function call.
+# While it is on every span is added to per-stage metrics (count, errors, total time, self time, i.e.
+# time not spent in child spans, latency percentiles and summed counters such as tokens and bytes),
+# which are logged when the run ends, and the spans of sampled traces are written to the file: one
+# JSON object per span ("jsonl"), or OTLP/JSON ExportTraceServiceRequest lines ("otlp") as read by
+# the OpenTelemetry Collector's otlpjsonfile receiver. Whether a trace is sampled is decided once, at
+# its root span, so a trace in the file is always complete.
+
+import atexit
+import contextvars
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from lib.stats import percentile
+
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+TRACE_FORMATS = ("jsonl", "otlp")
+MAX_SAMPLES = 10000
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar("lib.tracing.span", default=None)
+_tracer = None
+
+
+class _NoopSpan:
+    __slots__ = ()
+    recording = False
+    sampled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+    def add(self, **counters):
+        pass
+
+    def usage(self, usage):
+        pass
+
+    def fail(self, error):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class Span:
+    __slots__ = ("tracer", "name", "attributes", "counters", "parent", "trace_id", "span_id", "sampled",
+                 "start_ns", "error", "child_seconds", "_start", "_token")
+    recording = True
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.counters = {}
+        self.error = None
+        self.child_seconds = 0.0
+
+    def __enter__(self):
+        parent = _current.get()
+        self.parent = parent
+        self.sampled = self.tracer.sample() if parent is None else parent.sampled
+        # IDs and wall-clock times are only needed for the spans written to the file
+        if self.sampled:
+            self.trace_id = parent.trace_id if parent is not None else f"{random.getrandbits(128):032x}"
+            self.span_id = f"{random.getrandbits(64):016x}"
+            self.start_ns = time.time_ns()
+        self._start = time.perf_counter()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self._start
+        self._detach()
+        if exc is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        self.tracer.record(self, duration)
+        return False
+
+    def _detach(self):
+        try:
+            _current.reset(self._token)
+        except ValueError:
+            # Exited in another context than it was entered in
+            _current.set(self.parent)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def fail(self, error):
+        # Marks the span as failed for an exception (or error message) that is handled inside it
+        self.error = error if isinstance(error, str) else f"{type(error).__name__}: {error}"
+
+    def add(self, **counters):
+        # Counters are also summed per stage in the metrics
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def usage(self, usage):
+        # Token usage of an OpenAI response or an agent run, as an object or a dict
+        if usage is None:
+            return
+        if not isinstance(usage, dict):
+            usage = {key: getattr(usage, key, None) for key in ("prompt_tokens", "completion_tokens", "total_tokens")}
+        self.add(**{key: value for key, value in usage.items() if isinstance(value, int)})
+
+
+class StageMetrics:
+    __slots__ = ("count", "errors", "seconds", "self_seconds", "counters", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.self_seconds = 0.0
+        self.counters = {}
+        self.samples = []
+
+
+class Tracer:
+    def __init__(self, path=None, sample_rate=1.0, format="jsonl", service="agentplayground", flush_every=256):
+        if format not in TRACE_FORMATS:
+            raise ValueError(f"format must be one of {', '.join(TRACE_FORMATS)}")
+        self.path = path
+        self.sample_rate = sample_rate
+        self.format = format
+        self.service = service
+        self.flush_every = flush_every
+        self.metrics = {}
+        self.written = 0
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self._file = open(path, "a", encoding="utf-8") if path and sample_rate > 0 else None
+
+    def sample(self):
+        return self._file is not None and (self.sample_rate >= 1 or self._random.random() < self.sample_rate)
+
+    def record(self, span, duration):
+        with self._lock:
+            if span.parent is not None:
+                span.parent.child_seconds += duration
+            stage = self.metrics.get(span.name)
+            if stage is None:
+                stage = self.metrics[span.name] = StageMetrics()
+            stage.count += 1
+            stage.seconds += duration
+            stage.self_seconds += max(duration - span.child_seconds, 0.0)
+            if span.error is not None:
+                stage.errors += 1
+            for key, value in span.counters.items():
+                stage.counters[key] = stage.counters.get(key, 0) + value
+            # Reservoir sample of the durations for the percentiles, so long runs use bounded memory
+            if len(stage.samples) < MAX_SAMPLES:
+                stage.samples.append(duration)
+            else:
+                slot = self._random.randrange(stage.count)
+                if slot < MAX_SAMPLES:
+                    stage.samples[slot] = duration
+            if span.sampled:
+                self._buffer.append((span, duration))
+                if len(self._buffer) >= self.flush_every:
+                    self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        if self.format == "otlp":
+            self._file.write(json.dumps(self._otlp_request(self._buffer), default=str) + "\n")
+        else:
+            self._file.writelines(json.dumps(self._json_span(span, duration), default=str) + "\n"
+                                  for span, duration in self._buffer)
+        self._file.flush()
+        self.written += len(self._buffer)
+        self._buffer = []
+
+    def _json_span(self, span, duration):
+        record = {
+            "trace_id": span.trace_id,
+            "span_id": span.span_id,
+            "parent_id": span.parent.span_id if span.parent is not None else None,
+            "name": span.name,
+            "service": self.service,
+            "start": span.start_ns / 1e9,
+            "duration_ms": round(duration * 1000, 3),
+            "self_ms": round(max(duration - span.child_seconds, 0.0) * 1000, 3),
+            "attributes": {**span.attributes, **span.counters},
+        }
+        if span.error is not None:
+            record["error"] = span.error
+        return record
+
+    def _otlp_request(self, spans):
+        return {"resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", self.service)]},
+            "scopeSpans": [{"scope": {"name": __name__}, "spans": [self._otlp_span(span, duration) for span, duration in spans]}],
+        }]}
+
+    def _otlp_span(self, span, duration):
+        record = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.start_ns + int(duration * 1e9)),
+            "attributes": [_otlp_attribute(key, value) for key, value in {**span.attributes, **span.counters}.items()],
+        }
+        if span.parent is not None:
+            record["parentSpanId"] = span.parent.span_id
+        if span.error is not None:
+            record["status"] = {"code": 2, "message": span.error}
+        return record
+
+    def report(self):
+        # One line per stage, slowest self time first
+        with self._lock:
+            stages = sorted(self.metrics.items(), key=lambda item: item[1].self_seconds, reverse=True)
+            lines = [f"{'stage':<24} {'count':>7} {'errors':>6} {'total s':>9} {'self s':>9} {'p50 ms':>9} {'p95 ms':>9}  counters"]
+            for name, stage in stages:
+                samples = sorted(stage.samples)
+                counters = ", ".join(f"{key} {value:,}" if isinstance(value, int) else f"{key} {value:,.1f}"
+                                     for key, value in sorted(stage.counters.items()))
+                lines.append(f"{name:<24} {stage.count:>7} {stage.errors:>6} {stage.seconds:>9.2f} {stage.self_seconds:>9.2f} "
+                             f"{percentile(samples, 0.50) * 1000:>9.1f} {percentile(samples, 0.95) * 1000:>9.1f}  {counters}")
+        return lines
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._flush()
+                self._file.close()
+                self._file = None
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+def configure(path=None, sample_rate=1.0, format="jsonl", service="agentplayground"):
+    """Turn tracing on; sampled spans are appended to path, and without a path only the metrics are kept."""
+    global _tracer
+    shutdown()
+    _tracer = Tracer(path, sample_rate=sample_rate, format=format, service=service)
+    atexit.register(shutdown)
+    return _tracer
+
+
+def enabled():
+    return _tracer is not None
+
+
+def shutdown():
+    # Logs the stage metrics and writes the remaining spans; tracing is off afterwards
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is None:
+        return
+    if tracer.metrics:
+        logger.info("Stage metrics:\n%s", "\n".join(tracer.report()))
+    tracer.close()
+    if tracer.path and tracer.written:
+        logger.info("Wrote %d spans to %s", tracer.written, tracer.path)
+
+
+def span(name, **attributes):
+    """Time a stage: `with span("embed", inputs=16) as s: ... s.usage(response.usage)`."""
+    tracer = _tracer
+    if tracer is None:
+        return _NOOP
+    return Span(tracer, name, attributes)
+
+
+def current_span():
+    return _current.get() or _NOOP
+
+
+def bind(fn):
+    # Runs fn in a copy of the current context, so work submitted to a thread pool nests under the current span.
+    # Bind once per submitted call: one context cannot be entered by two threads at once.
+    if _tracer is None:
+        return fn
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+def traced_iter(iterable, name, size=len, **attributes):
+    """Yield the items of iterable with one span per item, e.g. for pages from the PDF extractor.
+
+    The span covers producing the item (the next() call), not consuming it, and size(item) is
+    counted as "chars". Nothing is wrapped while tracing is off.
+    """
+    if _tracer is None:
+        return iterable
+    return _traced_iter(iter(iterable), name, size, attributes)
+
+
+def _traced_iter(iterator, name, size, attributes):
+    index = 0
+    while True:
+        tracer = _tracer
+        if tracer is None:
+            yield from iterator
+            return
+        item_span = Span(tracer, name, dict(attributes, index=index))
+        item_span.__enter__()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            # Reaching the end is not a stage of its own
+            item_span._detach()
+            return
+        except BaseException as e:
+            item_span.__exit__(type(e), e, e.__traceback__)
+            raise
+        if size is not None:
+            item_span.add(chars=size(item))
+        item_span.__exit__(None, None, None)
+        index += 1
+        yield item
+
+
+def setup_logging(level="INFO"):
+    logging.basicConfig(level=level, format="%(asctime)s %(levelname)-7s %(message)s", datefmt="%H:%M:%S")
+    if logging.getLogger().getEffectiveLevel() > logging.DEBUG:
+        # The SDKs log every request and response at INFO
+        for name in ("azure", "httpx", "openai"):
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("logging and tracing")
+    group.add_argument("--log-level", type=str.upper, choices=LOG_LEVELS, default=os.environ.get("LOG_LEVEL", "INFO").upper(),
+                       help="log messages of this level and above (default: LOG_LEVEL or INFO)")
+    group.add_argument("--trace", metavar="FILE", default=os.environ.get("TRACE_FILE") or None,
+                       help="time every pipeline stage, log the stage metrics at the end and write the spans to FILE")
+    group.add_argument("--trace-format", choices=TRACE_FORMATS, default=os.environ.get("TRACE_FORMAT", "jsonl"),
+                       help="one JSON object per span, or OTLP/JSON export requests")
+    group.add_argument("--trace-sample", type=float, default=float(os.environ.get("TRACE_SAMPLE_RATE") or 1.0),
+                       help="fraction of traces written to the file; 0 only keeps the stage metrics")
+
+
+def setup(args, service):
+    # Logging and tracing from the add_arguments() options
+    setup_logging(args.log_level)
+    if args.trace:
+        configure(args.trace, sample_rate=args.trace_sample, format=args.trace_format, service=service)
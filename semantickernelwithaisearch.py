@@ -2,28 +2,40 @@
 # The code initializes the kernel, adds the Azure OpenAI chat completion service, and sets the execution settings for the chat prompt. It also creates a history of the conversation and initiates a back-and-forth chat between the user and the AI assistant. The user can input messages, and the AI assistant will respond based on the conversation history and the Azure OpenAI chat completion service. The conversation continues until the user enters "exit" to terminate the chat.
 # The main function runs the chat loop and processes user input and AI responses using the Azure OpenAI chat completion service. The chat history is updated with user messages, and the AI responses are added to the history. The chat loop continues until the user enters "exit" to end the conversation.
 # The asyncio.run() function is used to run the main function asynchronously and handle the chat interactions.
+# User input is read on a worker thread so the event loop keeps running while the script waits for the user.
+# With --stream the response is requested with get_streaming_chat_message_contents and printed as it arrives; every turn records
+# the time to first token and the total latency, and a summary is printed on exit.
+# The conversation is kept in a token-budgeted history (lib/chathistory.py): the most recent turns are sent verbatim and
+# older turns are folded into a rolling summary in the background once the prompt goes over --max-prompt-tokens, so
+# prompt size, latency and cost stop growing with every turn. The prompt tokens of every turn are printed.
 # The code demonstrates how to integrate the Azure OpenAI chat completion service with the semantic kernel to create a conversational AI agent that can engage in dialogues with users.
 # The Azure OpenAI chat completion service provides responses to user messages based on the conversation history and the AI model's training. The execution settings control the behavior of the chat prompt, such as function choice and response generation.
 # The chat history stores the messages exchanged between the user and the AI assistant, allowing for context-aware responses and maintaining the conversational flow.
 # The Azure AI Search integration enables the AI assistant to retrieve additional information from an Azure Search index based on user queries, enhancing the responses with relevant data.
+# The index is exposed to the model as the search plugin from lib/searchplugin.py, which runs hybrid keyword and vector queries;
+# searches requested together run concurrently and repeated searches are answered from a short-lived cache.
+# Chat and search requests go through the adaptive rate limiter in lib/ratelimit.py, which retries throttled requests
+# and adjusts the requests in flight.
+# The conversation is printed on stdout and per-turn latency and the reports are logged on stderr (--log-level). With --trace
+# every turn is a trace of its completion, searches and HTTP requests (lib/tracing.py), and the time spent in each stage is
+# logged at the end.
 # Overall, the code showcases how to build a chatbot using the Azure OpenAI chat completion service and integrate it with the semantic kernel for advanced conversational capabilities.
 # The chatbot can handle user queries, provide responses based on the chat history and external data sources, and engage users in meaningful conversations on various topics.
 
 
+import argparse
 import asyncio
 import logging
 import os
+import time
 
 from semantic_kernel import Kernel
-from semantic_kernel.utils.logging import setup_logging
-from semantic_kernel.functions import kernel_function
 from semantic_kernel.connectors.ai.open_ai import AzureChatCompletion
 from semantic_kernel.connectors.ai.function_choice_behavior import FunctionChoiceBehavior
-from semantic_kernel.connectors.ai.chat_completion_client_base import ChatCompletionClientBase
-from semantic_kernel.contents.chat_history import ChatHistory
-from semantic_kernel.functions.kernel_arguments import KernelArguments
-from azure.search.documents.indexes import SearchIndexClient
-from semantic_kernel.connectors.memory.azure_ai_search import AzureAISearchStore
+from semantic_kernel.contents.chat_message_content import ChatMessageContent
+from semantic_kernel.contents.function_call_content import FunctionCallContent
+from semantic_kernel.contents.function_result_content import FunctionResultContent
+from semantic_kernel.contents.utils.author_role import AuthorRole
 
 
 from semantic_kernel.connectors.ai.open_ai.prompt_execution_settings.azure_chat_prompt_execution_settings import (
@@ -32,69 +44,146 @@ from semantic_kernel.connectors.ai.open_ai.prompt_execution_settings.azure_chat_
 
 import dotenv
 
+from lib.chathistory import TokenBudgetHistory, chat_summarizer
+from lib.clients import async_openai_client, async_search_client, run_main
+from lib.searchplugin import SearchPlugin
+from lib.stats import format_latency_summary, latency_summary
+from lib import tracing
+
 dotenv.load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 
-async def main():
+async def main(args):
     # Initialize the kernel
     kernel = Kernel()
     deployment_name = os.environ.get("AZURE_OPENAI_DEPLOYMENT")
-    api_key = os.environ.get("AZURE_OPENAI_KEY")
     base_url = os.environ.get("AZURE_OPENAI_ENDPOINT")
-    api_version = os.environ.get("AZURE_OPENAI_API_VERSION")
-    search_endpoint = os.environ.get("AZURE_SEARCH_SERVICE_ENDPOINT")
-    search_index = os.environ.get("AZURE_SEARCH_INDEX")
-    search_credentials = os.environ.get("AZURE_SEARCH_ADMIN_KEY")
 
 
-    # Add Azure OpenAI chat completion
+    # Add Azure OpenAI chat completion; the shared client (lib/clients.py) reads the key and API version and goes
+    # through the rate limiter, which retries throttled requests itself
     chat_completion = AzureChatCompletion(
         deployment_name=deployment_name,
-        api_key=api_key,
-        base_url=base_url,
-        api_version=api_version
+        async_client=async_openai_client(base_url=base_url),
     )
     kernel.add_service(chat_completion)
 
 
-    search_client = SearchIndexClient(endpoint=search_endpoint, credential=search_credentials)
-    vector_store = AzureAISearchStore(search_index_client=search_client)
-    kernel.add_service(vector_store)
-    
+    # Register the search plugin so the model can query the index through function calling
+    search_plugin = SearchPlugin(async_search_client(), top_k=args.top_k, max_content_chars=args.max_content_chars,
+                                 ttl_seconds=args.search_cache_ttl)
+    kernel.add_plugin(search_plugin, plugin_name="search")
+
 
     # Set the execution settings for the chat prompt
     execution_settings = AzureChatPromptExecutionSettings()
     execution_settings.function_choice_behavior = FunctionChoiceBehavior.Auto()
 
-    # Create a history of the conversation
-    history = ChatHistory()
+    # Create a history of the conversation, summarized with function calling turned off
+    summary_settings = AzureChatPromptExecutionSettings(max_tokens=args.max_summary_tokens)
+    history = TokenBudgetHistory(
+        chat_summarizer(chat_completion, summary_settings),
+        max_prompt_tokens=args.max_prompt_tokens,
+        max_summary_tokens=args.max_summary_tokens,
+        min_recent_turns=args.keep_turns,
+    )
+
+    # Per-turn time to first token and total latency
+    first_token_latencies = []
+    turn_latencies = []
 
     # Initiate a back-and-forth chat
     userInput = None
-    while True:
-        # Collect user input
-        userInput = input("User > ")
-
-        # Terminate the loop if the user says "exit"
-        if userInput == "exit":
-            break
-
-        # Add user input to the history
-        history.add_user_message(userInput)
-
-        # Get the response from the AI
-        result = await chat_completion.get_chat_message_content(
-            chat_history=history,
-            settings=execution_settings,
-            kernel=kernel,
-        )
-
-        # Print the results
-        print("Assistant > " + str(result))
-
-        # Add the message from the agent to the chat history
-        history.add_message(result)
+    try:
+        while True:
+            # Collect user input on a worker thread so the event loop is not blocked while waiting
+            userInput = await asyncio.to_thread(input, "User > ")
+
+            # Terminate the loop if the user says "exit"
+            if userInput == "exit":
+                break
+
+            # Add user input to the history
+            history.add_message(ChatMessageContent(role=AuthorRole.USER, content=userInput))
+
+            start = time.perf_counter()
+            prompt = await history.prompt()
+            first_token = None
+            with tracing.span("complete", stream=args.stream) as complete_span:
+                if args.stream:
+                    # Print the response as it arrives and collect the chunks into one message
+                    print("Assistant > ", end="", flush=True)
+                    result = None
+                    async for messages in chat_completion.get_streaming_chat_message_contents(
+                        chat_history=prompt,
+                        settings=execution_settings,
+                        kernel=kernel,
+                    ):
+                        for message in messages:
+                            # With auto function calling the stream also carries the function calls and their results,
+                            # which add_prompt_messages records from the prompt; only the answer text is kept here
+                            if message.role != AuthorRole.ASSISTANT or any(
+                                isinstance(item, (FunctionCallContent, FunctionResultContent)) for item in message.items
+                            ):
+                                continue
+                            text = str(message)
+                            if text:
+                                if first_token is None:
+                                    first_token = time.perf_counter() - start
+                                print(text, end="", flush=True)
+                            result = message if result is None else result + message
+                    print()
+                else:
+                    # Get the response from the AI
+                    result = await chat_completion.get_chat_message_content(
+                        chat_history=prompt,
+                        settings=execution_settings,
+                        kernel=kernel,
+                    )
+                    first_token = time.perf_counter() - start
+
+                    # Print the results
+                    print("Assistant > " + str(result))
+                usage = result.metadata.get("usage") if result is not None else None
+                complete_span.usage(usage)
+            total = time.perf_counter() - start
+
+            if first_token is not None:
+                first_token_latencies.append(first_token)
+            turn_latencies.append(total)
+            first_token_ms = f"{first_token * 1000:.0f} ms" if first_token is not None else "n/a"
+            sent = f", {usage.prompt_tokens} billed" if getattr(usage, "prompt_tokens", None) else ""
+            logger.info("First token %s, total %.0f ms, %s%s", first_token_ms, total * 1000, history.report(), sent)
+
+            # Keep any function calls made during the turn, then the message from the agent
+            history.add_prompt_messages(prompt)
+            if result is not None:
+                history.add_message(result)
+            # Fold old turns into the summary while the user types the next message
+            history.compact()
+    finally:
+        await history.close()
+        logger.info(search_plugin.report())
+        if turn_latencies:
+            logger.info("Time to first token: " + format_latency_summary(latency_summary(first_token_latencies), unit="turns"))
+            logger.info("Total latency: " + format_latency_summary(latency_summary(turn_latencies), unit="turns"))
+            logger.info("Prompt tokens: mean %.0f, max %d over %d turns; %d history summaries, %d turns dropped",
+                        sum(history.prompt_tokens) / len(history.prompt_tokens), max(history.prompt_tokens),
+                        len(history.prompt_tokens), history.compactions, history.dropped_turns)
 
 # Run the main function
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Chat with Azure OpenAI through Semantic Kernel with Azure AI Search.")
+    parser.add_argument("--stream", action="store_true", help="stream responses and record time to first token")
+    parser.add_argument("--max-prompt-tokens", type=int, default=3000, help="token budget for the history sent each turn")
+    parser.add_argument("--max-summary-tokens", type=int, default=500, help="maximum length of the rolling summary of older turns")
+    parser.add_argument("--keep-turns", type=int, default=2, help="most recent turns that are always sent verbatim")
+    parser.add_argument("--top-k", type=int, default=5, help="passages returned by each search")
+    parser.add_argument("--max-content-chars", type=int, default=1500, help="characters of each passage returned to the model")
+    parser.add_argument("--search-cache-ttl", type=float, default=300, help="seconds search results are reused within the session")
+    tracing.add_arguments(parser)
+    args = parser.parse_args()
+    tracing.setup(args, "semantickernelwithaisearch")
+    run_main(main, args)